@@ -0,0 +1,444 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from indexing_pipeline import DELETE
+
+# Indexing every Slack message as its own document costs an API call and a
+# document per chat line.  With VECTARA_AGGREGATE set, messages are grouped
+# into documents with one section per message instead:
+#
+# - replies to a thread, by thread
+# - everything else, by channel and VECTARA_AGGREGATE_WINDOW second window
+#
+# A group is indexed once it holds VECTARA_AGGREGATE_MAX_MESSAGES messages or
+# VECTARA_AGGREGATE_MAX_CHARS characters of text, or VECTARA_AGGREGATE_MAX_AGE seconds
+# after its first message; later messages start a new document.  Each
+# section carries its message's poster, link and timestamp, which is what
+# search results show and filter on.  Messages are only journaled once their
+# document is submitted, so a crash loses up to MAX_AGE seconds of them.
+#
+# Which document each message went into is kept in SQLite at
+# VECTARA_AGGREGATE_PATH, shared by every worker and the backfill, so an
+# edit or delete reaching any of them, or the next run, rewrites the right
+# document.  Set it to an empty string to keep it in memory instead, which is
+# only safe with a single worker.
+
+# what each section keeps of its message's metadata
+SECTION_METADATA = ('poster', 'message_link', 'timestamp')
+# what the document keeps of its first message's metadata
+DOCUMENT_METADATA = ('channel', 'channel_type', 'message_type', 'thread_ts')
+
+def aggregation_enabled() -> bool:
+    return bool(os.environ.get('VECTARA_AGGREGATE'))
+
+class AggregationStore:
+    """Which document each aggregated message is a section of, in SQLite.
+
+    Every worker opens the same file, so an edit or delete of a message finds
+    its document whichever worker it reaches, and so does the next run.  A
+    group's sections are stored as its messages arrive and read back when
+    it's indexed, so a change made meanwhile by another worker is included.
+    Only the last ``remember`` indexed documents are kept, and groups that
+    were never indexed (their worker died) are dropped after ``stale_after``
+    seconds.
+    """
+
+    def __init__(self, path: str, remember: int, stale_after: float, busy_timeout: float = 5.0):
+        self.path = path
+        self.remember = remember
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                     timeout=busy_timeout)
+        if path != ':memory:':
+            self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                request TEXT NOT NULL,
+                created REAL NOT NULL,
+                indexed INTEGER NOT NULL DEFAULT 0
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sections (
+                message_id TEXT PRIMARY KEY,
+                document_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                section TEXT NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS sections_document ON sections (document_id, position)")
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers can't both
+        # read a document and then each write their own version of it
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def open(self, document_request: dict):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO documents (id, request, created) VALUES (?, ?, ?)",
+                         (document_request['id'], json.dumps(document_request), time.time()))
+
+    def add(self, document_id: str, message_id: str, section: dict):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sections (message_id, document_id, position, section) "
+                "VALUES (?, ?, (SELECT COALESCE(MAX(position), 0) + 1 FROM sections "
+                "WHERE document_id = ?), ?)",
+                (message_id, document_id, document_id, json.dumps(section)))
+
+    @staticmethod
+    def _sections(conn, document_id: str) -> list:
+        return [json.loads(section) for section, in conn.execute(
+            "SELECT section FROM sections WHERE document_id = ? ORDER BY position", (document_id,))]
+
+    def _drop(self, conn, document_ids: str):
+        """Deletes the documents the ``document_ids`` query selects, and their sections."""
+        conn.execute("DELETE FROM sections WHERE document_id IN ({})".format(document_ids))
+        conn.execute("DELETE FROM documents WHERE id IN ({})".format(document_ids))
+
+    def close(self, document_id: str):
+        """Marks a group indexed and returns the request that indexes it, or
+        None if every message in it has been deleted."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT request FROM documents WHERE id = ?",
+                               (document_id,)).fetchone()
+            sections = self._sections(conn, document_id) if row != None else []
+            if sections:
+                conn.execute("UPDATE documents SET indexed = 1 WHERE id = ?", (document_id,))
+            else:
+                conn.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+            self._drop(conn, "SELECT id FROM documents WHERE indexed = 1 "
+                             "ORDER BY rowid DESC LIMIT -1 OFFSET {:d}".format(self.remember))
+            self._drop(conn, "SELECT id FROM documents WHERE indexed = 0 "
+                             "AND created < {:f}".format(time.time() - self.stale_after))
+        if not sections:
+            return None
+        return dict(json.loads(row[0]), sections=sections)
+
+    def rewrite(self, message_id: str, section):
+        """Replaces a message's section, or deletes it if ``section`` is None.
+
+        Returns None if the message isn't in a document we know of, else the
+        requests that bring its document up to date: none while its group is
+        still pending, an upsert, or a deletion once no section is left.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT document_id FROM sections WHERE message_id = ?",
+                               (message_id,)).fetchone()
+            if row == None:
+                return None
+            document_id = row[0]
+            if section == None:
+                conn.execute("DELETE FROM sections WHERE message_id = ?", (message_id,))
+            else:
+                conn.execute("UPDATE sections SET section = ? WHERE message_id = ?",
+                             (json.dumps(section), message_id))
+            request, indexed = conn.execute("SELECT request, indexed FROM documents WHERE id = ?",
+                                            (document_id,)).fetchone()
+            if not indexed:
+                # whichever worker has the group indexes what's stored when it closes
+                return []
+            document_request = json.loads(request)
+            sections = self._sections(conn, document_id)
+            if not sections:
+                conn.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+                return [{"customer_id": document_request['customer_id'],
+                         "corpus_id": document_request['corpus_id'],
+                         "id": document_id, "action": DELETE}]
+            return [dict(document_request, sections=sections, upsert=True)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            documents, = self._conn.execute(
+                "SELECT COUNT(*) FROM documents WHERE indexed = 1").fetchone()
+            sections, = self._conn.execute("SELECT COUNT(*) FROM sections").fetchone()
+        return {"remembered_documents": documents, "remembered_messages": sections}
+
+class _Group:
+    """A document still taking messages; the messages themselves are in the store."""
+
+    def __init__(self, id: str, deadline: float, seq: int):
+        self.id = id
+        self.deadline = deadline
+        self.seq = seq
+        self.messages = 0
+        self.chars = 0
+
+class _Aggregation:
+    """The bookkeeping shared by ``MessageAggregator`` and ``AsyncMessageAggregator``.
+
+    ``_add`` returns the requests that are ready to submit; the subclasses
+    decide when groups age out and do the submitting.
+    """
+
+    def __init__(self, window: float = None, max_messages: int = None,
+                 max_chars: int = None, max_age: float = None, remember: int = None,
+                 path: str = None):
+        if window == None:
+            window = float(os.environ.get('VECTARA_AGGREGATE_WINDOW', 600))
+        if max_messages == None:
+            max_messages = int(os.environ.get('VECTARA_AGGREGATE_MAX_MESSAGES', 50))
+        if max_chars == None:
+            max_chars = int(os.environ.get('VECTARA_AGGREGATE_MAX_CHARS', 20000))
+        if max_age == None:
+            max_age = float(os.environ.get('VECTARA_AGGREGATE_MAX_AGE', 30))
+        if remember == None:
+            remember = int(os.environ.get('VECTARA_AGGREGATE_REMEMBER', 10000))
+        if path == None:
+            path = os.environ.get('VECTARA_AGGREGATE_PATH', 'aggregation.sqlite3')
+        self.window = window
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.max_age = max_age
+        self.remember = remember
+        self._groups = {}
+        # an empty path keeps the store in this process's memory
+        self.store = AggregationStore(path or ':memory:', remember, stale_after=max(3600.0, 2 * max_age))
+        self._seq = itertools.count()
+        self.messages = 0
+        self.documents = 0
+        self.sections = 0
+        self.rewrites = 0
+        self.passed_through = 0
+
+    def _group_key(self, request: dict):
+        metadata = request['metadata']
+        if metadata.get('thread_ts') != None:
+            return ('thread', metadata['channel'], metadata['thread_ts'])
+        return ('window', metadata['channel'], int(metadata['timestamp'] // self.window))
+
+    def _new_group(self, key, request: dict) -> _Group:
+        metadata = request['metadata']
+        if key[0] == 'thread':
+            id = "thread-{}-{}-{}".format(metadata['channel'], metadata['thread_ts'], metadata['timestamp'])
+            title = "Thread {} in <#{}>".format(metadata['thread_ts'], metadata['channel'])
+        else:
+            id = "window-{}-{}".format(metadata['channel'], metadata['timestamp'])
+            title = "Messages in <#{}> from {}".format(metadata['channel'], metadata['timestamp'])
+        self.store.open({
+            "customer_id": request['customer_id'],
+            "corpus_id": request['corpus_id'],
+            "text": None,
+            "id": id,
+            "title": title,
+            "metadata": {name: metadata[name] for name in DOCUMENT_METADATA if name in metadata},
+        })
+        group = _Group(id, time.monotonic() + self.max_age, next(self._seq))
+        self._groups[key] = group
+        return group
+
+    @staticmethod
+    def _section(request: dict) -> dict:
+        metadata = request['metadata']
+        return {"text": request['text'],
+                "metadata": {name: metadata[name] for name in SECTION_METADATA if name in metadata}}
+
+    def _add(self, request: dict):
+        """Takes an ``index_message`` or ``delete_document`` request.
+
+        Returns ``(ready, group)``: the requests to submit now, and the group
+        the message joined if it opened one that needs an age timer.
+        """
+        id = request['id']
+        if request.get('action') == DELETE or request.get('upsert'):
+            ready = self.store.rewrite(id, None if request.get('action') == DELETE else self._section(request))
+            if ready == None:
+                # from before aggregation, or long enough ago that it's forgotten
+                self.passed_through += 1
+                return [request], None
+            self.rewrites += len(ready)
+            return ready, None
+        self.messages += 1
+        key = self._group_key(request)
+        group = self._groups.get(key)
+        opened = None
+        if group == None:
+            group = opened = self._new_group(key, request)
+        self.store.add(group.id, id, self._section(request))
+        group.messages += 1
+        group.chars += len(request['text'])
+        if group.messages >= self.max_messages or group.chars >= self.max_chars:
+            return self._close_all([key]), None
+        return [], opened
+
+    def _close(self, key):
+        """Turns a group into the request that indexes it, or None if its
+        messages have all been deleted."""
+        group = self._groups.pop(key)
+        request = self.store.close(group.id)
+        if request != None:
+            self.documents += 1
+            self.sections += len(request['sections'])
+        return request
+
+    def _close_all(self, keys=None) -> list:
+        """The requests that index the groups ``keys``, or every group."""
+        if keys == None:
+            keys = list(self._groups)
+        return [request for request in map(self._close, keys) if request != None]
+
+    def _due(self, key, seq: int):
+        """The request for group ``key`` if it's still the group that timer was set for."""
+        group = self._groups.get(key)
+        if group == None or group.seq != seq:
+            return None
+        return self._close(key)
+
+    def _stats(self) -> dict:
+        return {
+            **self.store.stats(),
+            "pending_documents": len(self._groups),
+            "pending_messages": sum(group.messages for group in self._groups.values()),
+            "aggregated_messages": self.messages,
+            "aggregated_documents": self.documents,
+            "avg_sections": self.sections / self.documents if self.documents else 0.0,
+            "rewrites": self.rewrites,
+            "passed_through": self.passed_through,
+        }
+
+class MessageAggregator(_Aggregation):
+    """Groups index requests into multi-section documents before they reach ``submit``.
+
+    ``submit`` is ``IndexingPipeline.submit``, and ``submit`` here takes the
+    same requests, so one stands in for the other.  Edits (``upsert``) and
+    deletions of a message rewrite the document it went into, as long as
+    the store still remembers it; other ones are passed to ``submit`` as
+    they are.  Groups that age out are submitted from a
+    background thread, and ``stop`` submits the rest.
+    """
+
+    def __init__(self, submit, **limits):
+        super().__init__(**limits)
+        self._submit = submit
+        self._cond = threading.Condition()
+        self._deadlines = []
+        self._thread = None
+        self._stopping = False
+
+    def submit(self, **request) -> bool:
+        """Adds a message, or applies an edit or delete, returning False if it was dropped."""
+        with self._cond:
+            if self._thread == None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name="vectara-aggregator",
+                                                daemon=True)
+                self._thread.start()
+            ready, opened = self._add(request)
+            if opened != None:
+                heapq.heappush(self._deadlines, (opened.deadline, opened.seq, self._group_key(request)))
+                self._cond.notify()
+            if self._stopping:
+                ready.extend(self._close_all())
+        return all([self._submit(**r) for r in ready])
+
+    def _next_due(self):
+        """Waits for the next group to age out and returns its request, or None once stopped."""
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                if not self._deadlines:
+                    self._cond.wait()
+                    continue
+                deadline, seq, key = self._deadlines[0]
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._deadlines)
+                request = self._due(key, seq)
+                if request != None:
+                    return request
+
+    def _run(self):
+        while True:
+            request = self._next_due()
+            if request == None:
+                return
+            try:
+                self._submit(**request)
+            except Exception:
+                logging.exception("Submitting aggregated document %s failed", request.get('id'))
+
+    def stop(self):
+        """Submits every pending group without waiting for it to age out."""
+        with self._cond:
+            self._stopping = True
+            thread = self._thread
+            ready = self._close_all()
+            self._cond.notify()
+        if thread != None:
+            thread.join()
+        for request in ready:
+            self._submit(**request)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return self._stats()
+
+class AsyncMessageAggregator(_Aggregation):
+    """The asyncio counterpart of ``MessageAggregator``, ``submit`` is awaited."""
+
+    def __init__(self, submit, **limits):
+        super().__init__(**limits)
+        self._submit = submit
+        self._timers = {}
+        self._tasks = set()
+        self._stopping = False
+
+    async def submit(self, **request) -> bool:
+        """Adds a message, or applies an edit or delete, returning False if it was dropped."""
+        ready, opened = self._add(request)
+        if opened != None:
+            key = self._group_key(request)
+            self._timers[opened.seq] = asyncio.get_running_loop().call_later(
+                self.max_age, self._flush, key, opened.seq)
+        if self._stopping:
+            ready.extend(self._close_all())
+        return all([await self._submit(**r) for r in ready])
+
+    def _flush(self, key, seq: int):
+        del self._timers[seq]
+        request = self._due(key, seq)
+        if request == None:
+            return
+        task = asyncio.ensure_future(self._submit_aged(request))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _submit_aged(self, request):
+        try:
+            await self._submit(**request)
+        except Exception:
+            logging.exception("Submitting aggregated document %s failed", request.get('id'))
+
+    async def stop(self):
+        """Submits every pending group without waiting for it to age out."""
+        self._stopping = True
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+        for request in self._close_all():
+            await self._submit(**request)
+
+    def stats(self) -> dict:
+        return self._stats()
@@ -0,0 +1,206 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from slack_helpers import index_request_for_message
+from content_filter import ContentFilter
+from indexing_pipeline import IndexingPipeline
+from aggregation import MessageAggregator, aggregation_enabled
+from index_journal import IndexJournal
+from local_index import LocalIndex, open_local_index
+
+# Indexes the history of channels from before the bot joined them.
+#
+#   python3 backfill.py C03V4NCQJK2 C03V4NCQJK3
+#
+# Without channel IDs it backfills every public channel the bot is a member
+# of.  Channels are paged through concurrently; progress is checkpointed after
+# every page, so an interrupted backfill picks up where it stopped.
+
+class RateLimiter:
+    """A token bucket allowing ``rate_per_minute`` calls, shared by all threads."""
+
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        self.interval = 60.0 / rate_per_minute
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.interval
+            time.sleep(wait)
+
+class Checkpoint:
+    """Remembers, per channel, the history cursor of the next page to fetch."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._state = json.load(f)
+
+    def get(self, channel):
+        with self._lock:
+            return dict(self._state.get(channel, {}))
+
+    def update(self, channel, **values):
+        with self._lock:
+            self._state.setdefault(channel, {}).update(values)
+            # write-then-rename so a crash never leaves a torn checkpoint
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._state, f)
+            os.replace(tmp_path, self.path)
+
+class Backfill:
+    """Pages through channel history and thread replies and indexes them to
+    Vectara, and to ``local_index`` if there is one, as the bot does."""
+
+    def __init__(self, client: WebClient, indexer: IndexingPipeline, checkpoint: Checkpoint,
+                 rate_per_minute: float = None, page_size: int = 200,
+                 content_filter: ContentFilter = None, local_index: LocalIndex = None):
+        if rate_per_minute == None:
+            # conversations.history and conversations.replies are Tier 3
+            rate_per_minute = float(os.environ.get('SLACK_HISTORY_RATE_PER_MINUTE', 50))
+        self.client = client
+        self.indexer = indexer
+        self.checkpoint = checkpoint
+        self.page_size = page_size
+        self.content_filter = content_filter if content_filter != None else ContentFilter()
+        self.local_index = local_index
+        self._history_limiter = RateLimiter(rate_per_minute)
+        self._replies_limiter = RateLimiter(rate_per_minute)
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.skipped = 0
+        self.started = None
+
+    def run(self, channels, concurrency: int = 4):
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for channel, future in [(c, pool.submit(self.backfill_channel, c)) for c in channels]:
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception("Backfilling %s failed, rerun to resume it", channel)
+        self.report()
+
+    def backfill_channel(self, channel):
+        state = self.checkpoint.get(channel)
+        if state.get('done'):
+            logging.info("%s was already backfilled", channel)
+            return
+        cursor = state.get('cursor')
+        while True:
+            self._history_limiter.acquire()
+            response = self.client.conversations_history(channel=channel, cursor=cursor,
+                                                         limit=self.page_size)
+            for message in response['messages']:
+                self._index(channel, message)
+                if message.get('reply_count'):
+                    self._backfill_thread(channel, message['ts'])
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                self.checkpoint.update(channel, cursor=None, done=True)
+                logging.info("Finished backfilling %s", channel)
+                return
+            self.checkpoint.update(channel, cursor=cursor)
+            self.report()
+
+    def _backfill_thread(self, channel, thread_ts):
+        cursor = None
+        while True:
+            self._replies_limiter.acquire()
+            response = self.client.conversations_replies(channel=channel, ts=thread_ts,
+                                                         cursor=cursor, limit=self.page_size)
+            for message in response['messages']:
+                # the parent comes back too, and was indexed from the history
+                if message['ts'] != thread_ts:
+                    self._index(channel, message)
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                return
+
+    def _index(self, channel, message):
+        # history messages lack the event fields read_message relies on
+        event = dict(message, channel=channel, channel_type='channel',
+                     event_ts=message['ts'], type=message.get('type', 'message'))
+        # the same messages read_message skips: joins, bot posts, "ok"s, repeats
+        if not message.get('text') or self.content_filter.skip_reason(event) != None:
+            with self._lock:
+                self.skipped += 1
+            return
+        request = index_request_for_message(event)
+        self.indexer.submit(**request)
+        if self.local_index != None:
+            self.local_index.add(request)
+        with self._lock:
+            self.messages += 1
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            messages, skipped = self.messages, self.skipped
+        logging.info("Backfilled %d messages (%d skipped) in %.1fs, %.1f messages/sec",
+                     messages, skipped, elapsed, messages / elapsed if elapsed else 0.0)
+        logging.info("Skipped: %s", {reason: count for reason, count
+                                     in self.content_filter.stats().items()
+                                     if reason.startswith('skipped_')})
+
+def member_channels(client: WebClient):
+    """Lists the public channels the bot has been invited to."""
+    channels = []
+    cursor = None
+    while True:
+        response = client.users_conversations(types="public_channel", cursor=cursor,
+                                              exclude_archived=True, limit=200)
+        channels.extend(c['id'] for c in response['channels'])
+        cursor = (response.get('response_metadata') or {}).get('next_cursor')
+        if not cursor:
+            return channels
+
+def main():
+    parser = argparse.ArgumentParser(description="Index Slack history from before the bot joined.")
+    parser.add_argument('channels', nargs='*', help="channel IDs, defaults to every channel the bot is in")
+    parser.add_argument('--concurrency', type=int, default=4, help="channels backfilled at once")
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.json')
+    parser.add_argument('--journal', default=os.environ.get('VECTARA_BACKFILL_JOURNAL_PATH', 'backfill_journal.sqlite3'),
+                        help="journal of pending index requests, an empty string disables it")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    client = WebClient(token=os.environ.get('SLACK_BOT_TOKEN'))
+    # sleeps for Retry-After when Slack answers 429
+    client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=10))
+    indexer = IndexingPipeline(journal=IndexJournal(args.journal) if args.journal else None)
+    # with VECTARA_AGGREGATE set, history is indexed in groups like live messages
+    aggregator = MessageAggregator(indexer.submit) if aggregation_enabled() else None
+    backfill = Backfill(client, aggregator if aggregator != None else indexer, Checkpoint(args.checkpoint),
+                        local_index=open_local_index())
+    try:
+        backfill.run(args.channels or member_channels(client), concurrency=args.concurrency)
+    finally:
+        if aggregator != None:
+            aggregator.stop()
+            logging.info("Aggregation: %s", aggregator.stats())
+        indexer.stop()
+        logging.info("Indexing: %s", indexer.stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Local stand-ins for Vectara and Slack, for load testing the bot.
+
+Run them on their own from the repository root:
+
+    python3 -m benchmarks.fake_servers --latency 0.05 --error-rate 0.01
+
+and point the bot at them with the environment variables it prints, or
+start them in-process with ``ServerThread`` as ``load_benchmark`` does.
+
+``FakeVectara`` serves ``/v1/query``, ``/v1/index``, ``/v1/delete-doc`` and
+the OAuth token endpoint, with a configurable delay and share of 500s and 429s.  Queries
+return the sections of the most recently indexed documents, not a relevance
+ranking, so the server's own cost stays flat as the corpus grows.  ``FakeSlack`` accepts the
+Web API calls the bot makes and ``response_url`` posts.
+
+Both report what they served to a ``Recorder``, keyed by the id the
+benchmark gave each request: the document id of an indexed message, the
+channel a result was posted to, or the last part of a ``response_url``.
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from aiohttp import web
+
+class Recorder:
+    """Remembers when each keyed request was served, or failed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.completed = {}
+        self.failed = {}
+
+    def complete(self, key):
+        with self._lock:
+            self.completed.setdefault(key, time.monotonic())
+
+    def fail(self, key):
+        with self._lock:
+            self.failed.setdefault(key, time.monotonic())
+
+    def outstanding(self, keys) -> int:
+        with self._lock:
+            return sum(1 for key in keys if key not in self.completed and key not in self.failed)
+
+def _metadata_list(metadata: dict) -> list:
+    return [{"name": name, "value": str(value)} for name, value in metadata.items()]
+
+class FakeVectara:
+    """Answers Vectara's query, index and token APIs after ``latency`` seconds.
+
+    The delay is drawn uniformly from ``latency`` +/- ``jitter``.  A share
+    ``error_rate`` of calls fail with a 500 and ``rate_limit_rate`` with a 429.
+    """
+
+    def __init__(self, recorder: Recorder = None, latency: float = 0.02, jitter: float = 0.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: float = 1.0, token_lifetime: int = 3600, seed: int = None):
+        self.recorder = recorder if recorder != None else Recorder()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.token_lifetime = token_lifetime
+        self._random = random.Random(seed)
+        self.documents = []
+        self.counts = {"token": 0, "query": 0, "index": 0, "delete": 0, "errors": 0, "rate_limited": 0}
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/oauth2/token', self.token)
+        app.router.add_post('/v1/query', self.query)
+        app.router.add_post('/v1/index', self.index)
+        app.router.add_post('/v1/delete-doc', self.delete)
+        return app
+
+    async def _respond_later(self):
+        """Waits out the latency, then returns an error response if this call fails."""
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        draw = self._random.random()
+        if draw < self.rate_limit_rate:
+            self.counts["rate_limited"] += 1
+            return web.json_response({"message": "Too many requests"}, status=429,
+                                     headers={"Retry-After": str(self.retry_after)})
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.counts["errors"] += 1
+            return web.json_response({"message": "Internal error"}, status=500)
+        return None
+
+    async def token(self, request):
+        self.counts["token"] += 1
+        return web.json_response({"access_token": "fake-token", "token_type": "Bearer",
+                                  "expires_in": self.token_lifetime})
+
+    async def query(self, request):
+        self.counts["query"] += 1
+        query = (await request.json())['query'][0]
+        error = await self._respond_later()
+        if error != None:
+            return error
+        start = query.get('start', 0)
+        num_results = query.get('num_results', 10)
+        # newest first, then each document's sections in order
+        results = [(document, section) for document in self.documents[::-1]
+                   for section in document["sections"]][start:start + num_results]
+        if not results and start == 0:
+            results = [({"id": "fake-doc", "metadata": {}}, {"text": "Nothing has been indexed yet"})]
+        documents = []
+        for document, _ in results:
+            if not documents or documents[-1] is not document:
+                documents.append(document)
+        return web.json_response({"responseSet": [{
+            "response": [{"text": section["text"], "score": 1.0 / (start + i + 1),
+                          "metadata": _metadata_list(section.get("metadata") or {}),
+                          "documentIndex": next(j for j, d in enumerate(documents) if d is document)}
+                         for i, (document, section) in enumerate(results)],
+            "document": [{"id": document["id"], "metadata": _metadata_list(document["metadata"])}
+                         for document in documents],
+        }]})
+
+    async def index(self, request):
+        self.counts["index"] += 1
+        document = (await request.json())['document']
+        error = await self._respond_later()
+        if error != None:
+            return error
+        self.documents.append({"id": document['document_id'],
+                               "sections": [{"text": section['text'],
+                                             "metadata": json.loads(section.get('metadata_json') or 'null')}
+                                            for section in document['section']],
+                               "metadata": json.loads(document.get('metadata_json') or 'null') or {}})
+        self.recorder.complete(document['document_id'])
+        return web.json_response({"status": {"code": "OK", "statusDetail": "Success"}})
+
+    async def delete(self, request):
+        self.counts["delete"] += 1
+        document_id = (await request.json())['document_id']
+        error = await self._respond_later()
+        if error != None:
+            return error
+        self.documents = [document for document in self.documents if document["id"] != document_id]
+        return web.json_response({})
+
+class FakeSlack:
+    """Accepts the bot's Slack Web API calls and ``response_url`` posts."""
+
+    bot_user_id = "U0BENCHBOT"
+    team_id = "T0BENCH"
+
+    def __init__(self, recorder: Recorder = None, latency: float = 0.0):
+        self.recorder = recorder if recorder != None else Recorder()
+        self.latency = latency
+        self.counts = {}
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/api/{method}', self.api)
+        app.router.add_post('/response/{key}', self.response_url)
+        return app
+
+    async def _arguments(self, request) -> dict:
+        # auth.test comes with a JSON content type and no body
+        if not await request.read():
+            return {}
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def api(self, request):
+        method = request.match_info['method']
+        self.counts[method] = self.counts.get(method, 0) + 1
+        arguments = await self._arguments(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'auth.test':
+            return web.json_response({"ok": True, "url": "https://bench.slack.com/", "team": "Bench",
+                                      "user": "bench-bot", "team_id": self.team_id,
+                                      "user_id": self.bot_user_id, "bot_id": "B0BENCHBOT"})
+        if method == 'chat.postMessage':
+            self.recorder.complete(arguments.get('channel'))
+            return web.json_response({"ok": True, "channel": arguments.get('channel'),
+                                      "ts": "{:.6f}".format(time.time()),
+                                      "message": {"text": arguments.get('text')}})
+        return web.json_response({"ok": True})
+
+    async def response_url(self, request):
+        self.counts['response_url'] = self.counts.get('response_url', 0) + 1
+        await request.read()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.recorder.complete(request.match_info['key'])
+        return web.Response(text="ok")
+
+class ServerThread:
+    """Serves an aiohttp application from a background thread with its own event loop."""
+
+    def __init__(self, application: web.Application, host: str = '127.0.0.1', port: int = 0):
+        self.application = application
+        self.host = host
+        self.port = port
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(self.host, self.port)
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.application, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # port 0 picks a free port
+        self.port = self._runner.addresses[0][1]
+
+    def start(self) -> str:
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self.url
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve stand-ins for Vectara and Slack.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--vectara-port', type=int, default=8081)
+    parser.add_argument('--slack-port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per Vectara call")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of Vectara calls answered with a 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share answered with a 429")
+    args = parser.parse_args()
+
+    vectara = ServerThread(FakeVectara(latency=args.latency, jitter=args.jitter,
+                                       error_rate=args.error_rate,
+                                       rate_limit_rate=args.rate_limit_rate).application(),
+                           args.host, args.vectara_port)
+    slack = ServerThread(FakeSlack().application(), args.host, args.slack_port)
+    vectara.start()
+    slack.start()
+    print("VECTARA_API_URL={0} VECTARA_AUTH_URL={0} SLACK_API_URL={1}/api/".format(vectara.url, slack.url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        vectara.stop()
+        slack.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Builds synthetic Slack payloads and feeds them to the bot's ``App``.
+
+The payloads are what Socket Mode delivers: ``message`` events, ``/vectara``
+commands and ``block_actions``.  Each carries a unique ``key`` where the
+stand-ins in ``fake_servers`` will see it again, so a benchmark can match
+every request to the moment it was served:
+
+- a message's ``client_msg_id``, which becomes its Vectara document id
+- the channel of a mention or a button click, where the result is posted
+- the last part of a command's ``response_url``
+"""
+import time
+from slack_bolt.request import BoltRequest
+from slack_bolt.request.async_request import AsyncBoltRequest
+from benchmarks.fake_servers import FakeSlack, Recorder
+
+def _ts() -> str:
+    return "{:.6f}".format(time.time())
+
+def message_event(key: str, text: str, channel: str = "C0BENCH", user: str = "U0BENCHUSER",
+                  channel_type: str = "channel") -> dict:
+    """A message posted by ``user``; ``key`` is its ``client_msg_id``."""
+    ts = _ts()
+    return {
+        "type": "event_callback",
+        "team_id": FakeSlack.team_id,
+        "api_app_id": "A0BENCH",
+        "event_id": "Ev" + key,
+        "event_time": int(time.time()),
+        "event": {
+            "type": "message",
+            "client_msg_id": key,
+            "user": user,
+            "text": text,
+            "ts": ts,
+            "event_ts": ts,
+            "channel": channel,
+            "channel_type": channel_type,
+            "team": FakeSlack.team_id,
+        },
+    }
+
+def message_changed_event(key: str, text: str, previous_text: str, channel: str = "C0BENCH",
+                          user: str = "U0BENCHUSER") -> dict:
+    """An edit of message ``key`` from ``previous_text`` to ``text``."""
+    body = message_event(key, text, channel=channel, user=user)
+    original = body["event"]
+    body["event_id"] = "Ev{}-{}".format(key, time.monotonic_ns())
+    body["event"] = {
+        "type": "message",
+        "subtype": "message_changed",
+        "hidden": True,
+        "channel": channel,
+        "channel_type": "channel",
+        "ts": _ts(),
+        "event_ts": _ts(),
+        "message": dict(original, edited={"user": user, "ts": _ts()}),
+        "previous_message": dict(original, text=previous_text),
+    }
+    return body
+
+def message_deleted_event(key: str, channel: str = "C0BENCH", user: str = "U0BENCHUSER") -> dict:
+    """The deletion of message ``key``."""
+    body = message_event(key, "", channel=channel, user=user)
+    original = body["event"]
+    body["event_id"] = "Ev{}-deleted".format(key)
+    body["event"] = {
+        "type": "message",
+        "subtype": "message_deleted",
+        "hidden": True,
+        "channel": channel,
+        "channel_type": "channel",
+        "ts": _ts(),
+        "event_ts": _ts(),
+        "deleted_ts": original["ts"],
+        "previous_message": original,
+    }
+    return body
+
+def mention_event(key: str, search_text: str, user: str = "U0BENCHUSER") -> dict:
+    """A message mentioning the bot in channel ``key``, which is a search."""
+    return message_event(key, "<@{}> {}".format(FakeSlack.bot_user_id, search_text),
+                         channel=key, user=user)
+
+def command_body(key: str, text: str, slack_url: str, channel: str = "C0BENCH",
+                 user: str = "U0BENCHUSER") -> dict:
+    """``/vectara text``, answered through ``{slack_url}/response/{key}``."""
+    return {
+        "token": "bench",
+        "team_id": FakeSlack.team_id,
+        "api_app_id": "A0BENCH",
+        "channel_id": channel,
+        "user_id": user,
+        "command": "/vectara",
+        "text": text,
+        "response_url": "{}/response/{}".format(slack_url.rstrip('/'), key),
+        "trigger_id": "trigger-" + key,
+    }
+
+def block_actions_body(key: str, action_id: str, value: str = None, search_text: str = "",
+                       state_values: dict = None, user: str = "U0BENCHUSER") -> dict:
+    """A click on ``action_id`` in a results message posted to channel ``key``."""
+    action = {"action_id": action_id, "block_id": "bench", "type": "button", "action_ts": _ts()}
+    if value != None:
+        action["value"] = value
+    return {
+        "type": "block_actions",
+        "team": {"id": FakeSlack.team_id},
+        "user": {"id": user},
+        "api_app_id": "A0BENCH",
+        "channel": {"id": key},
+        "container": {"type": "message", "channel_id": key},
+        "message": {"type": "message", "ts": _ts(), "blocks": [
+            {"type": "section", "text": {"type": "mrkdwn", "text": "Search results for: *{}*".format(search_text)}},
+        ]},
+        "state": {"values": state_values or {}},
+        "actions": [action],
+    }
+
+def request_key(body: dict) -> str:
+    """The key a payload built here was given."""
+    if 'command' in body:
+        return body['response_url'].rsplit('/', 1)[1]
+    if 'actions' in body:
+        return body['channel']['id']
+    event = body['event']
+    if 'subtype' in event:
+        return (event.get('message') or event['previous_message'])['client_msg_id']
+    if event['channel_type'] == 'channel' and not event['text'].startswith('<@'):
+        return event['client_msg_id']
+    return event['channel']
+
+class Harness:
+    """Dispatches payloads into an ``App`` the way Socket Mode would.
+
+    Bolt acks first and runs the listener afterwards, so ``dispatch`` returns
+    once the request is acked.  Listener errors are reported to ``recorder``
+    as failures of the payload's key.
+    """
+
+    def __init__(self, app, recorder: Recorder):
+        self.app = app
+        self.recorder = recorder
+        app.error(self._record_error)
+
+    def _record_error(self, error, body, logger):
+        logger.warning("Benchmark request failed: %s", error)
+        self.recorder.fail(request_key(body))
+
+    def dispatch(self, body: dict):
+        return self.app.dispatch(BoltRequest(body=body, mode="socket_mode"))
+
+class AsyncHarness(Harness):
+    """The ``AsyncApp`` version of ``Harness``."""
+
+    async def _record_error(self, error, body, logger):
+        Harness._record_error(self, error, body, logger)
+
+    async def dispatch(self, body: dict):
+        return await self.app.async_dispatch(AsyncBoltRequest(body=body, mode="socket_mode"))
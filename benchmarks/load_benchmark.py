@@ -0,0 +1,230 @@
+"""Load test of indexing and search against local stand-ins for Vectara and Slack.
+
+Run from the repository root:
+
+    python3 -m benchmarks.load_benchmark --messages 1000 --searches 200
+    python3 -m benchmarks.load_benchmark --mode async --latency 0.1 --error-rate 0.01
+
+The stand-ins from ``fake_servers`` run in-process and the bot (``slackbot`` or
+``slackbot_async``) is imported pointing at them.  Each scenario dispatches
+its payloads through ``harness`` and waits for them to be served:
+
+- index: channel messages, done when the fake Vectara has indexed them
+- search: ``/vectara`` commands, done when the result reaches the response_url
+- more_results: "More results" clicks, done when the result is posted
+
+and reports throughput and p50/p99 latency from dispatch to done.  Rate
+limits default to effectively unlimited so they don't cap the numbers; set
+``VECTARA_QUERY_RATE`` and friends to benchmark with them.
+"""
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import tempfile
+import time
+from benchmarks.fake_servers import FakeSlack, FakeVectara, Recorder, ServerThread
+from benchmarks.harness import (AsyncHarness, Harness, block_actions_body, command_body,
+                                message_event, request_key)
+from slack_helpers import encode_cursor
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+def scenarios(args, slack_url):
+    # every search is different so the search cache can't answer it
+    return [
+        ("index", [message_event("msg-{}".format(i), "the deploy of build {} failed on step {}".format(i, i % 7))
+                   for i in range(args.messages)]),
+        ("search", [command_body("cmd-{}".format(i), "why did build {} fail".format(i), slack_url)
+                    for i in range(args.searches)]),
+        ("more_results", [block_actions_body("CACT{}".format(i), "more_results",
+                                             value=encode_cursor("which step failed {}".format(i), 1),
+                                             search_text="which step failed {}".format(i))
+                          for i in range(args.actions)]),
+    ]
+
+class Phase:
+    """The timings of one scenario."""
+
+    def __init__(self, name, bodies):
+        self.name = name
+        self.bodies = bodies
+        self.dispatched = {}
+        self.started = None
+
+    def summary(self, recorder: Recorder) -> dict:
+        latencies = sorted(recorder.completed[key] - sent
+                           for key, sent in self.dispatched.items() if key in recorder.completed)
+        failed = sum(1 for key in self.dispatched if key in recorder.failed and key not in recorder.completed)
+        if latencies:
+            last = max(recorder.completed[key] for key in self.dispatched if key in recorder.completed)
+            throughput = len(latencies) / max(last - self.started, 1e-9)
+        else:
+            throughput = 0.0
+        return {
+            "scenario": self.name,
+            "requests": len(self.dispatched),
+            "done": len(latencies),
+            "failed": failed,
+            "timed_out": len(self.dispatched) - len(latencies) - failed,
+            "throughput": throughput,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+        }
+
+def _delay_before(started, sent, rate):
+    """Seconds until request number ``sent`` is due at ``rate`` per second (0 is no pacing)."""
+    if rate:
+        delay = started + sent / rate - time.monotonic()
+        if delay > 0:
+            return delay
+    return 0.0
+
+def run_phase(harness, phase, recorder, rate, timeout):
+    phase.started = time.monotonic()
+    for sent, body in enumerate(phase.bodies):
+        delay = _delay_before(phase.started, sent, rate)
+        if delay:
+            time.sleep(delay)
+        phase.dispatched[request_key(body)] = time.monotonic()
+        harness.dispatch(body)
+    deadline = time.monotonic() + timeout
+    while recorder.outstanding(phase.dispatched) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return phase.summary(recorder)
+
+async def run_phase_async(harness, phase, recorder, rate, timeout):
+    phase.started = time.monotonic()
+    for sent, body in enumerate(phase.bodies):
+        # always yield, so listeners start while we keep dispatching
+        await asyncio.sleep(_delay_before(phase.started, sent, rate))
+        phase.dispatched[request_key(body)] = time.monotonic()
+        await harness.dispatch(body)
+    deadline = time.monotonic() + timeout
+    while recorder.outstanding(phase.dispatched) and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return phase.summary(recorder)
+
+def configure_environment(vectara_url, slack_url, journal_path, dedup_path, local_index_path):
+    os.environ.update({
+        'SLACK_SIGNING_SECRET': 'bench',
+        'SLACK_BOT_TOKEN': 'xoxb-bench',
+        'SLACK_API_URL': slack_url + '/api/',
+        'SLACK_WORKSPACE_SUBDOMAIN': 'bench',
+        'VECTARA_API_URL': vectara_url,
+        'VECTARA_AUTH_URL': vectara_url,
+        'VECTARA_CUSTOMER_ID': '1',
+        'VECTARA_CORPUS_ID': '1',
+        'VECTARA_APP_ID': 'bench',
+        'VECTARA_APP_SECRET': 'bench',
+        'VECTARA_JOURNAL_PATH': journal_path,
+        # payload keys repeat from run to run, so a shared store would drop them
+        'SLACKBOT_DEDUP_PATH': dedup_path,
+        'LOCAL_INDEX_PATH': local_index_path,
+    })
+    for name in ('VECTARA_QUERY_RATE', 'VECTARA_INDEX_RATE'):
+        os.environ.setdefault(name, '1000000')
+
+def print_report(results, bot_stats):
+    print("{:<14}{:>10}{:>8}{:>8}{:>11}{:>14}{:>10}{:>10}".format(
+        "scenario", "requests", "done", "failed", "timed out", "throughput/s", "p50 ms", "p99 ms"))
+    for r in results:
+        print("{:<14}{:>10}{:>8}{:>8}{:>11}{:>14.1f}{:>10.1f}{:>10.1f}".format(
+            r["scenario"], r["requests"], r["done"], r["failed"], r["timed_out"],
+            r["throughput"], r["p50"] * 1000, r["p99"] * 1000))
+    for name, stats in bot_stats.items():
+        print("{}: {}".format(name, stats))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark indexing and search against local stand-ins.")
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--messages', type=int, default=500, help="messages to index")
+    parser.add_argument('--searches', type=int, default=200, help="/vectara commands")
+    parser.add_argument('--actions', type=int, default=100, help="\"More results\" clicks")
+    parser.add_argument('--rate', type=float, default=0, help="requests/sec to dispatch at, 0 for as fast as possible")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for a scenario to finish")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per Vectara call")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of Vectara calls answered with a 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share answered with a 429")
+    parser.add_argument('--slack-latency', type=float, default=0.0, help="seconds per Slack call")
+    parser.add_argument('--no-journal', action='store_true', help="index without the on-disk journal")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    recorder = Recorder()
+    vectara = FakeVectara(recorder, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                          rate_limit_rate=args.rate_limit_rate, retry_after=0.1)
+    slack = FakeSlack(recorder, latency=args.slack_latency)
+    vectara_server = ServerThread(vectara.application())
+    slack_server = ServerThread(slack.application())
+    vectara_server.start()
+    slack_server.start()
+    journal_dir = tempfile.TemporaryDirectory()
+    try:
+        configure_environment(vectara_server.url, slack_server.url,
+                              '' if args.no_journal else os.path.join(journal_dir.name, 'journal.sqlite3'),
+                              os.path.join(journal_dir.name, 'events.sqlite3'),
+                              os.path.join(journal_dir.name, 'local_index.sqlite3'))
+        phases = [Phase(name, bodies) for name, bodies in scenarios(args, slack_server.url)]
+        if args.mode == 'sync':
+            results, bot_stats = run_sync(phases, recorder, args)
+        else:
+            results, bot_stats = asyncio.run(run_async(phases, recorder, args))
+        bot_stats["fake vectara"] = vectara.counts
+        bot_stats["fake slack"] = slack.counts
+        print_report(results, bot_stats)
+    finally:
+        vectara_server.stop()
+        slack_server.stop()
+        journal_dir.cleanup()
+
+def run_sync(phases, recorder, args):
+    # imported late, since the bot reads its configuration at import
+    bot = importlib.import_module('slackbot')
+    import vectara_functions
+    from scheduler import scheduler
+    harness = Harness(bot.app, recorder)
+    bot.indexer.start()
+    try:
+        results = [run_phase(harness, phase, recorder, args.rate, args.timeout) for phase in phases]
+    finally:
+        bot.indexer.stop()
+        vectara_functions.token_manager.close()
+    bot_stats = {"indexer": bot.indexer.stats(), "search cache": bot.search_cache.stats(),
+                 "content filter": bot.content_filter.stats(),
+                 "scheduler waits": scheduler.stats()["waits"]}
+    if bot.local_index != None:
+        bot_stats["local index"] = bot.local_index.stats()
+    if vectara_functions.reranker != None:
+        bot_stats["reranker"] = vectara_functions.reranker.stats()
+    return results, bot_stats
+
+async def run_async(phases, recorder, args):
+    bot = importlib.import_module('slackbot_async')
+    import vectara_async
+    from scheduler import scheduler
+    harness = AsyncHarness(bot.app, recorder)
+    bot.indexer.start()
+    try:
+        results = [await run_phase_async(harness, phase, recorder, args.rate, args.timeout) for phase in phases]
+    finally:
+        await bot.indexer.stop()
+        await vectara_async.token_manager.close()
+        await vectara_async.transport.close()
+    bot_stats = {"indexer": bot.indexer.stats(), "search cache": bot.search_cache.stats(),
+                 "content filter": bot.content_filter.stats(),
+                 "scheduler waits": scheduler.stats()["waits"]}
+    if bot.local_index != None:
+        bot_stats["local index"] = bot.local_index.stats()
+    if vectara_async.reranker != None:
+        bot_stats["reranker"] = vectara_async.reranker.stats()
+    return results, bot_stats
+
+if __name__ == "__main__":
+    main()
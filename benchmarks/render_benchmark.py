@@ -0,0 +1,82 @@
+"""Micro-benchmarks for escaping and rendering search results.
+
+Run from the repository root:
+
+    python3 -m benchmarks.render_benchmark
+
+Each case is timed at growing input sizes; per-character time should stay flat
+for the current escaper.  The original per-call regex implementation is timed
+alongside as a baseline, up to the size where it becomes too slow to wait for.
+"""
+import re
+import timeit
+from result_renderer import escape_markdown, render_search_results
+
+def legacy_escape_markdown(text, *, as_needed=False, ignore_links=True):
+    """The escaper as it was before result_renderer, kept as a baseline."""
+    _MARKDOWN_ESCAPE_SUBREGEX = '|'.join(r'\{0}(?=([\s\S]*((?<!\{0})\{0})))'.format(c)
+                                                for c in ('*', '`', '_', '~', '|'))
+    _MARKDOWN_ESCAPE_COMMON = r'^>(?:>>)?\s|\[.+\]\(.+\)'
+    _MARKDOWN_ESCAPE_REGEX = re.compile(r'(?P<markdown>%s|%s)' % (_MARKDOWN_ESCAPE_SUBREGEX, _MARKDOWN_ESCAPE_COMMON))
+
+    if not as_needed:
+        url_regex = r'(?P<url><[^: >]+:\/[^ >]+>|(?:https?|steam):\/\/[^\s<]+[^<.,:;\"\'\]\s])'
+        def replacement(match):
+            groupdict = match.groupdict()
+            is_url = groupdict.get('url')
+            if is_url:
+                return is_url
+            return '\\' + groupdict['markdown']
+
+        regex = r'(?P<markdown>[_\\~|\*`]|%s)' % _MARKDOWN_ESCAPE_COMMON
+        if ignore_links:
+            regex = '(?:%s|%s)' % (url_regex, regex)
+        return re.sub(regex, replacement, text)
+    else:
+        text = re.sub(r'\\', r'\\\\', text)
+        return _MARKDOWN_ESCAPE_REGEX.sub(r'\\\1', text)
+
+# name -> (function of size returning the input, keyword arguments)
+CASES = {
+    "chat message": (lambda n: ("ok so the *deploy* failed, see https://ci.example.com/build_123 " * n)[:n], {}),
+    "emphasis, as needed": (lambda n: ("*_" * n)[:n], {"as_needed": True}),
+    "unclosed links": (lambda n: "[" * n, {}),
+    "unclosed angle links": (lambda n: "<" * n, {}),
+    "link soup": (lambda n: ("[a](b) " * n)[:n], {}),
+}
+SIZES = (1000, 10000, 100000)
+# the legacy escaper is quadratic on most of the cases above
+LEGACY_MAX_SIZE = 10000
+
+def bench(function, text, kwargs, min_time=0.2):
+    timer = timeit.Timer(lambda: function(text, **kwargs))
+    number, elapsed = timer.autorange()
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    return elapsed / number
+
+def bench_render():
+    search_results = {'responseSet': [{
+        'response': [{'text': 'the oncall doc is at https://wiki.example.com/on_call *pinned*', 'documentIndex': 0}],
+        'document': [{'metadata': [{'name': 'poster', 'value': 'U012AB3CD'},
+                                   {'name': 'message_link', 'value': 'https://example.slack.com/archives/C1/p1'},
+                                   {'name': 'timestamp', 'value': '1664900000.0'}]}]
+    }]}
+    timer = timeit.Timer(lambda: render_search_results(search_results, "where is the oncall doc"))
+    number, elapsed = timer.autorange()
+    print("render_search_results: {:.1f}us".format(elapsed / number * 1e6))
+
+def main():
+    print("{:<22} {:>8} {:>14} {:>14}".format("case", "size", "us/call", "legacy us/call"))
+    for name, (make_text, kwargs) in CASES.items():
+        for size in SIZES:
+            text = make_text(size)
+            current = bench(escape_markdown, text, kwargs)
+            legacy = bench(legacy_escape_markdown, text, kwargs, min_time=0) if size <= LEGACY_MAX_SIZE else None
+            print("{:<22} {:>8} {:>14.1f} {:>14}".format(
+                name, size, current * 1e6, "{:.1f}".format(legacy * 1e6) if legacy != None else "-"))
+    bench_render()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from slack_helpers import document_id
+import metrics
+
+# Not every channel message is worth a Vectara document.  ContentFilter skips,
+# before anything is sent:
+#
+# - posts by bots and integrations
+# - subtype messages (joins, topic changes, ...) other than the ones in
+#   VECTARA_INDEX_SUBTYPES, which are people's messages with extras
+# - messages with fewer than VECTARA_FILTER_MIN_WORDS words once mentions,
+#   links and emoji are left out, or only acknowledgements like "ok thanks"
+# - messages that repeat one of the last VECTARA_DEDUP_CAPACITY messages
+#   of their channel, word for word or nearly (an alert pasted again with a
+#   new timestamp), judged by 64-bit SimHash fingerprints
+#
+# A message that's edited or deleted is forgotten, so its next copy counts
+# as new.
+
+BOT = 'bot'
+SUBTYPE = 'subtype'
+LOW_INFORMATION = 'low_information'
+DUPLICATE = 'duplicate'
+NEAR_DUPLICATE = 'near_duplicate'
+REASONS = (BOT, SUBTYPE, LOW_INFORMATION, DUPLICATE, NEAR_DUPLICATE)
+
+ACKNOWLEDGEMENTS = frozenset("""
+    ok okay k kk yes yep yeah yup no nope sure thanks thank you thx ty np cool nice
+    great awesome lol haha done ack agreed same this indeed wow oh ah
+""".split())
+# <@U123>, <#C123|name>, <https://...|text> and :emoji:
+_NOISE_REGEX = re.compile(r'<[^>]*>|(?<!\w):[a-z0-9_+\-\']+:(?!\w)')
+_WORD_REGEX = re.compile(r'\w+')
+_DIGITS_REGEX = re.compile(r'\d+')
+_BITS = 64
+# SimHash of a handful of words swings too much to compare
+_NEAR_DUPLICATE_MIN_WORDS = 8
+
+def _words(text: str) -> list:
+    return _WORD_REGEX.findall(_NOISE_REGEX.sub(' ', text).lower())
+
+def _hash64(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'big')
+
+def simhash(words: list) -> int:
+    """The 64-bit SimHash of ``words``, with every number counted as the same word.
+
+    Every word's hash votes on each bit, so texts that share most of their
+    words end up a few bits apart: one word changed in a 20 word message
+    moves about 5, two unrelated messages about 30.  Numbers are timestamps,
+    counts and IDs often enough that an alert repeated with new ones
+    shouldn't count as new.
+    """
+    votes = [0] * _BITS
+    for word in words:
+        hashed = _hash64(_DIGITS_REGEX.sub('0', word))
+        for bit in range(_BITS):
+            votes[bit] += 1 if hashed >> bit & 1 else -1
+    return sum(1 << bit for bit in range(_BITS) if votes[bit] > 0)
+
+class _FingerprintIndex:
+    """The fingerprints of the last ``capacity`` messages, by message id.
+
+    Near-duplicates are found without comparing against every fingerprint:
+    the 64 bits are cut into ``distance + 1`` bands, and two fingerprints
+    at most ``distance`` bits apart must agree on at least one whole band.
+    """
+
+    def __init__(self, capacity: int, distance: int):
+        self.capacity = capacity
+        self.distance = distance
+        self._bands = [(_BITS * i // (distance + 1), _BITS * (i + 1) // (distance + 1))
+                       for i in range(distance + 1)]
+        # id -> (scope, digest, fingerprint or None), least recently seen first
+        self._entries = OrderedDict()
+        self._by_digest = {}
+        self._by_band = [{} for _ in self._bands]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _band_keys(self, scope, fingerprint: int):
+        for band, (low, high) in enumerate(self._bands):
+            yield band, (scope, fingerprint >> low & ((1 << (high - low)) - 1))
+
+    def find(self, scope, digest: bytes, fingerprint):
+        """The reason a message with this digest and fingerprint is a repeat, or None."""
+        original = self._by_digest.get((scope, digest))
+        if original != None:
+            # a message that keeps being repeated stays remembered
+            self._entries.move_to_end(original)
+            return DUPLICATE
+        if fingerprint == None:
+            return None
+        for band, key in self._band_keys(scope, fingerprint):
+            for id in self._by_band[band].get(key, ()):
+                other = self._entries[id][2]
+                if bin(other ^ fingerprint).count('1') <= self.distance:
+                    self._entries.move_to_end(id)
+                    return NEAR_DUPLICATE
+        return None
+
+    def add(self, id: str, scope, digest: bytes, fingerprint):
+        self.forget(id)
+        self._entries[id] = (scope, digest, fingerprint)
+        self._by_digest[(scope, digest)] = id
+        if fingerprint != None:
+            for band, key in self._band_keys(scope, fingerprint):
+                self._by_band[band].setdefault(key, set()).add(id)
+        while len(self._entries) > self.capacity:
+            self.forget(next(iter(self._entries)))
+
+    def forget(self, id: str):
+        entry = self._entries.pop(id, None)
+        if entry == None:
+            return
+        scope, digest, fingerprint = entry
+        if self._by_digest.get((scope, digest)) == id:
+            del self._by_digest[(scope, digest)]
+        if fingerprint != None:
+            for band, key in self._band_keys(scope, fingerprint):
+                ids = self._by_band[band].get(key)
+                ids.discard(id)
+                if not ids:
+                    del self._by_band[band][key]
+
+class ContentFilter:
+    """Decides which channel messages are worth indexing, see the top of this module.
+
+    ``skip_reason`` is called once per new message and remembers the ones it
+    lets through; ``forget`` drops a message that's been edited or deleted.
+    """
+
+    def __init__(self, min_words: int = None, subtypes=None, capacity: int = None,
+                 distance: int = None):
+        if min_words == None:
+            min_words = int(os.environ.get('VECTARA_FILTER_MIN_WORDS', 2))
+        if subtypes == None:
+            subtypes = os.environ.get('VECTARA_INDEX_SUBTYPES', 'thread_broadcast,file_share,me_message')
+            subtypes = [subtype.strip() for subtype in subtypes.split(',') if subtype.strip()]
+        if capacity == None:
+            capacity = int(os.environ.get('VECTARA_DEDUP_CAPACITY', 10000))
+        if distance == None:
+            distance = int(os.environ.get('VECTARA_DEDUP_DISTANCE', 3))
+        self.min_words = min_words
+        self.subtypes = frozenset(subtypes)
+        self._fingerprints = _FingerprintIndex(capacity, distance) if capacity > 0 else None
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.skipped = dict.fromkeys(REASONS, 0)
+
+    def _reason(self, message: dict):
+        if message.get('bot_id') or message.get('subtype') == 'bot_message' or 'user' not in message:
+            return BOT
+        if message.get('subtype') and message['subtype'] not in self.subtypes:
+            return SUBTYPE
+        words = _words(message.get('text') or '')
+        if len(words) < self.min_words or all(word in ACKNOWLEDGEMENTS for word in words):
+            return LOW_INFORMATION
+        if self._fingerprints == None:
+            return None
+        scope = message.get('channel')
+        digest = hashlib.blake2b(' '.join(words).encode(), digest_size=16).digest()
+        # numbers all look alike to simhash, so they don't count towards the minimum
+        near_duplicates = sum(1 for word in words if not word.isdigit()) >= _NEAR_DUPLICATE_MIN_WORDS
+        fingerprint = simhash(words) if near_duplicates else None
+        reason = self._fingerprints.find(scope, digest, fingerprint)
+        if reason == None:
+            self._fingerprints.add(document_id(message), scope, digest, fingerprint)
+        return reason
+
+    def skip_reason(self, message: dict):
+        """Why ``message`` shouldn't be indexed, one of ``REASONS``, or None to index it."""
+        with self._lock:
+            self.checked += 1
+            reason = self._reason(message)
+            if reason != None:
+                self.skipped[reason] += 1
+        if reason != None:
+            metrics.count_skipped_message(reason)
+        return reason
+
+    def forget(self, id: str):
+        if self._fingerprints != None:
+            with self._lock:
+                self._fingerprints.forget(id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "fingerprints": len(self._fingerprints) if self._fingerprints != None else 0,
+                **{"skipped_" + reason: count for reason, count in self.skipped.items()},
+            }
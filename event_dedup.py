@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import threading
+import time
+
+def event_key(body: dict):
+    """The idempotency key of a Slack request, or None if it has none.
+
+    Messages are keyed on their ``client_msg_id``, so a message that reaches
+    us as two events (a retry, or two socket connections) counts once; other
+    events on ``event_id``; commands and interactions on ``trigger_id``.
+    """
+    event = body.get('event')
+    if event != None:
+        if event.get('client_msg_id'):
+            return "{}:{}".format(event.get('type'), event['client_msg_id'])
+        if body.get('event_id'):
+            return "event:" + body['event_id']
+        return None
+    if body.get('trigger_id'):
+        return "trigger:" + body['trigger_id']
+    return None
+
+class EventDeduplicator:
+    """Remembers which Slack requests were already handled, shared by every process.
+
+    The keys live in a SQLite table that all workers open, and the first
+    process to ``claim`` a key handles the request.  Keys are forgotten
+    ``ttl`` seconds after they're claimed, which only needs to outlast
+    Slack's retries, or as soon as handling the request fails and its claim
+    is ``release``d.
+    """
+
+    def __init__(self, path: str, ttl: float = None, evict_interval: float = 60.0,
+                 busy_timeout: float = 5.0):
+        if ttl == None:
+            ttl = float(os.environ.get('SLACKBOT_DEDUP_TTL', 3600))
+        self.path = path
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                     timeout=busy_timeout)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS claimed (
+                key TEXT PRIMARY KEY,
+                expires REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS claimed_expires ON claimed (expires)")
+        self._next_eviction = 0.0
+        self.claimed = 0
+        self.duplicates = 0
+        self.released = 0
+        self.evicted = 0
+
+    def claim(self, key: str) -> bool:
+        """Returns True if nobody has claimed ``key`` within the TTL, claiming it."""
+        now = time.time()
+        with self._lock:
+            if now >= self._next_eviction:
+                self._evict(now)
+            # an expired claim can be taken over; a live one leaves the row as is
+            cursor = self._conn.execute(
+                "INSERT INTO claimed (key, expires) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET expires = excluded.expires "
+                "WHERE claimed.expires <= ?",
+                (key, now + self.ttl, now))
+            if cursor.rowcount:
+                self.claimed += 1
+                return True
+            self.duplicates += 1
+            return False
+
+    def release(self, key: str):
+        """Forgets a claim whose request failed, so a redelivery is handled."""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM claimed WHERE key = ?", (key,))
+            self.released += cursor.rowcount
+
+    def _evict(self, now: float):
+        cursor = self._conn.execute("DELETE FROM claimed WHERE expires <= ?", (now,))
+        self.evicted += cursor.rowcount
+        self._next_eviction = now + self.evict_interval
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = self._conn.execute("SELECT COUNT(*) FROM claimed").fetchone()[0]
+        return {
+            "keys": keys,
+            "claimed": self.claimed,
+            "duplicates": self.duplicates,
+            "released": self.released,
+            "evicted": self.evicted,
+        }
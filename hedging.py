@@ -0,0 +1,156 @@
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+class LatencyTracker:
+    """The latencies of the last ``window`` calls of one kind."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction: float, min_samples: int = 1):
+        """Nearest-rank percentile, or None with fewer than ``min_samples`` samples."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[max(0, math.ceil(fraction * len(samples)) - 1)]
+
+class Hedger:
+    """Sends a second copy of a slow call and takes whichever answers first.
+
+    A call that hasn't answered once it's been running for the 95th
+    percentile of recent calls of its ``kind`` is sent again; until
+    ``min_samples`` calls have been timed, ``default_delay`` stands in for
+    that.  Either way the whole thing gives up with a ``TimeoutError`` at
+    the ``deadline`` (a ``time.monotonic()`` timestamp).  A failure is only
+    raised once no copy is left running.
+    """
+
+    def __init__(self, default_delay: float = None, min_samples: int = 20, window: int = 200):
+        if default_delay == None:
+            default_delay = float(os.environ.get('VECTARA_HEDGE_DELAY', 2.0))
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.window = window
+        self._trackers = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self.timeouts = 0
+
+    def _tracker(self, kind: str) -> LatencyTracker:
+        with self._lock:
+            if kind not in self._trackers:
+                self._trackers[kind] = LatencyTracker(self.window)
+            return self._trackers[kind]
+
+    def hedge_delay(self, kind: str) -> float:
+        p95 = self._tracker(kind).percentile(0.95, self.min_samples)
+        return p95 if p95 != None else self.default_delay
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _timed(self, kind: str, function, *args):
+        started = time.monotonic()
+        result = function(*args)
+        self._tracker(kind).record(time.monotonic() - started)
+        return result
+
+    async def _timed_async(self, kind: str, function, *args):
+        started = time.monotonic()
+        result = await function(*args)
+        self._tracker(kind).record(time.monotonic() - started)
+        return result
+
+    def call(self, executor, kind: str, function, *args, deadline: float):
+        """Runs ``function(*args)`` on ``executor``, hedged, and returns its result."""
+        self._count('calls')
+        hedge_at = time.monotonic() + self.hedge_delay(kind)
+        # the copies keep our scheduler priority and metrics labels
+        first = executor.submit(contextvars.copy_context().run, self._timed, kind, function, *args)
+        running = {first}
+        hedged = False
+        error = None
+        while running:
+            now = time.monotonic()
+            if now >= deadline:
+                self._count('timeouts')
+                raise TimeoutError("No answer within the deadline")
+            timeout = deadline - now
+            if not hedged and hedge_at < deadline:
+                timeout = max(0.0, min(timeout, hedge_at - now))
+            done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() == None:
+                    if future is not first:
+                        self._count('hedges_won')
+                    return future.result()
+                error = future.exception()
+            if running and not hedged and time.monotonic() >= hedge_at:
+                hedged = True
+                self._count('hedged')
+                running.add(executor.submit(contextvars.copy_context().run, self._timed, kind,
+                                            function, *args))
+        raise error
+
+    async def call_async(self, kind: str, function, *args, deadline: float):
+        """The asyncio version of ``call``: ``function`` is a coroutine function,
+        and the copy still running when one answers is cancelled."""
+        self._count('calls')
+        hedge_at = time.monotonic() + self.hedge_delay(kind)
+        first = asyncio.ensure_future(self._timed_async(kind, function, *args))
+        running = {first}
+        hedged = False
+        error = None
+        try:
+            while running:
+                now = time.monotonic()
+                if now >= deadline:
+                    self._count('timeouts')
+                    raise TimeoutError("No answer within the deadline")
+                timeout = deadline - now
+                if not hedged and hedge_at < deadline:
+                    timeout = max(0.0, min(timeout, hedge_at - now))
+                done, running = await asyncio.wait(running, timeout=timeout,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() == None:
+                        if task is not first:
+                            self._count('hedges_won')
+                        return task.result()
+                    error = task.exception()
+                if running and not hedged and time.monotonic() >= hedge_at:
+                    hedged = True
+                    self._count('hedged')
+                    running.add(asyncio.ensure_future(self._timed_async(kind, function, *args)))
+            raise error
+        finally:
+            for task in running:
+                task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            kinds = list(self._trackers)
+            stats = {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedges_won": self.hedges_won,
+                "timeouts": self.timeouts,
+            }
+        for kind in kinds:
+            stats["{}_p95".format(kind)] = self._tracker(kind).percentile(0.95)
+        return stats
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from slack_helpers import homepage_blocks
+import metrics
+
+# Every time someone opens the App Home tab, Slack sends app_home_opened and
+# the bot answers with views.publish.  The view hardly ever changes, so
+# HomeView builds it once per version, a hash of its JSON, and skips the call
+# for a user who already has that version:
+#
+# - for the last SLACKBOT_HOME_MAX_USERS users it published to, it remembers
+#   which version each got, for SLACKBOT_HOME_TTL seconds
+# - the version is also stamped into the view's private_metadata, which the
+#   event carries back, so a restart or another worker doesn't publish again
+#
+# With SLACKBOT_HOME_STATS_INTERVAL set, the view also shows the stats its
+# ``corpus_stats`` returns, fetched at most once per that many seconds.  Only
+# a change in them makes a new version.
+
+class HomeView:
+    """The App Home view, and who's been sent which version of it, see the top of this module.
+
+    ``corpus_stats`` returns a dict of labels to values to show under the
+    welcome text, or None if there's nothing to show.
+    """
+
+    def __init__(self, corpus_stats=None, ttl: float = None, max_users: int = None,
+                 stats_interval: float = None):
+        if ttl == None:
+            ttl = float(os.environ.get('SLACKBOT_HOME_TTL', 86400))
+        if max_users == None:
+            max_users = int(os.environ.get('SLACKBOT_HOME_MAX_USERS', 10000))
+        if stats_interval == None:
+            stats_interval = float(os.environ.get('SLACKBOT_HOME_STATS_INTERVAL', 0))
+        self.corpus_stats = corpus_stats if stats_interval > 0 else None
+        self.ttl = ttl
+        self.max_users = max_users
+        self.stats_interval = stats_interval
+        self._lock = threading.Lock()
+        # user -> (version, expires_at), least recently published first
+        self._published = OrderedDict()
+        self._next_stats = 0.0
+        self._stats = None
+        self.version = None
+        self._view = None
+        self.builds = 0
+        self.published = 0
+        self.skipped = 0
+        self._build()
+
+    def _build(self):
+        """Builds the view for the current stats, if that changes it."""
+        blocks = homepage_blocks()
+        if self._stats:
+            blocks = blocks + [
+                {"type": "divider"},
+                {"type": "context", "elements": [
+                    {"type": "mrkdwn", "text": "*{}:* {}".format(label, value)}
+                    for label, value in self._stats.items()]},
+            ]
+        content = json.dumps(blocks, sort_keys=True)
+        version = hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+        if version == self.version:
+            return
+        self.version = version
+        # a dict, as views_publish takes; slack_sdk serializes the request itself
+        self._view = {"type": "home", "callback_id": "home_view",
+                      "private_metadata": version, "blocks": blocks}
+        self.builds += 1
+
+    def _refresh_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.corpus_stats == None or now < self._next_stats:
+                return
+            self._next_stats = now + self.stats_interval
+        try:
+            stats = self.corpus_stats()
+        except Exception:
+            logging.exception("Couldn't get the corpus stats for the App Home")
+            return
+        with self._lock:
+            self._stats = stats
+            self._build()
+
+    def to_publish(self, event: dict):
+        """The ``(version, view)`` to publish for an app_home_opened ``event``,
+        or None if the user already has it.  The view is shared, so it mustn't
+        be changed."""
+        self._refresh_stats()
+        user = event['user']
+        shown = (event.get('view') or {}).get('private_metadata')
+        now = time.monotonic()
+        with self._lock:
+            version, view = self.version, self._view
+            entry = self._published.get(user)
+            current = shown == version or (entry != None and entry[0] == version and entry[1] > now)
+            if current:
+                self.skipped += 1
+                if entry == None:
+                    # published by another worker, or before a restart
+                    self._remember(user, version, now)
+        if current:
+            metrics.count_home_view("skipped")
+            return None
+        return version, view
+
+    def _remember(self, user: str, version: str, now: float):
+        self._published.pop(user, None)
+        self._published[user] = (version, now + self.ttl)
+        while len(self._published) > self.max_users:
+            self._published.popitem(last=False)
+
+    def sent(self, user: str, version: str):
+        """Records that ``version`` was published to ``user``."""
+        with self._lock:
+            self.published += 1
+            self._remember(user, version, time.monotonic())
+        metrics.count_home_view("published")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "version": self.version,
+                "builds": self.builds,
+                "published": self.published,
+                "skipped": self.skipped,
+                "users": len(self._published),
+            }
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+class IndexJournal:
+    """A durable SQLite write-ahead journal of pending index requests.
+
+    Every request is appended before it is sent to Vectara and deleted once
+    Vectara accepts it, so anything left in the journal after an outage or a
+    restart is replayed.  Failed requests are retried with exponential
+    backoff.  The journal holds at most ``max_entries`` requests; beyond that
+    the oldest are evicted so a long outage can't fill the disk.
+    """
+
+    def __init__(self, path: str, max_entries: int = None,
+                 retry_base: float = None, retry_max: float = None):
+        if max_entries == None:
+            max_entries = int(os.environ.get('VECTARA_JOURNAL_MAX_ENTRIES', 100000))
+        if retry_base == None:
+            retry_base = float(os.environ.get('VECTARA_JOURNAL_RETRY_BASE', 1.0))
+        if retry_max == None:
+            retry_max = float(os.environ.get('VECTARA_JOURNAL_RETRY_MAX', 300.0))
+        self.path = path
+        self.max_entries = max_entries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # auto_vacuum only takes effect on a new database, which is the only
+        # time we need to set it
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pending (
+                entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS pending_next_attempt ON pending (next_attempt)")
+        self._pending = self._conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+        self.appended = 0
+        self.acked = 0
+        self.retried = 0
+        self.evicted = 0
+
+    def append(self, index_kwargs: dict) -> int:
+        """Durably records an ``index_message`` call and returns its entry id."""
+        now = time.time()
+        payload = json.dumps(index_kwargs)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO pending (payload, created, next_attempt) VALUES (?, ?, ?)",
+                (payload, now, now))
+            self.appended += 1
+            self._pending += 1
+            self._evict_overflow()
+            return cursor.lastrowid
+
+    def _evict_overflow(self):
+        overflow = self._pending - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM pending WHERE entry_id IN "
+                "(SELECT entry_id FROM pending ORDER BY entry_id LIMIT ?)", (overflow,))
+            self._pending -= overflow
+            self.evicted += overflow
+            logging.error("Index journal is full, evicted the %d oldest messages", overflow)
+
+    def ack(self, entry_id: int):
+        """Removes an entry once Vectara has accepted it (or rejected it for good)."""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM pending WHERE entry_id = ?", (entry_id,))
+            if cursor.rowcount:
+                self._pending -= 1
+                self.acked += 1
+
+    def retry_later(self, entry_id: int) -> float:
+        """Schedules another attempt with exponential backoff, returning the delay."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT attempts FROM pending WHERE entry_id = ?", (entry_id,)).fetchone()
+            if row == None:
+                return 0.0
+            attempts = row[0] + 1
+            delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+            # jitter, so a backlog doesn't all come due in the same instant
+            delay *= random.uniform(0.5, 1.0)
+            self._conn.execute(
+                "UPDATE pending SET attempts = ?, next_attempt = ? WHERE entry_id = ?",
+                (attempts, time.time() + delay, entry_id))
+            self.retried += 1
+            return delay
+
+    def due(self, limit: int = 100, exclude=()) -> list:
+        """Returns up to ``limit`` ``(entry_id, index_kwargs)`` ready to be sent."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entry_id, payload FROM pending WHERE next_attempt <= ? "
+                "ORDER BY next_attempt, entry_id LIMIT ?",
+                (time.time(), limit + len(exclude))).fetchall()
+        return [(entry_id, json.loads(payload)) for entry_id, payload in rows
+                if entry_id not in exclude][:limit]
+
+    def compact(self):
+        """Returns the space freed by acknowledged entries to the filesystem."""
+        with self._lock:
+            # it frees one page per step, and execute() only takes the first,
+            # where executescript() runs it to the end
+            self._conn.executescript("PRAGMA incremental_vacuum;")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        """Reports how far behind indexing is."""
+        with self._lock:
+            pending = self._pending
+            oldest = self._conn.execute(
+                "SELECT created FROM pending ORDER BY entry_id LIMIT 1").fetchone()
+            page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "pending": pending,
+            "oldest_pending_age": time.time() - oldest[0] if oldest != None else 0.0,
+            "appended": self.appended,
+            "acked": self.acked,
+            "retried": self.retried,
+            "evicted": self.evicted,
+            "size_bytes": page_count * page_size,
+        }
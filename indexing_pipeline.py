@@ -0,0 +1,556 @@
+import asyncio
+import heapq
+import logging
+import os
+import queue
+import threading
+import time
+from vectara_functions import index_message, delete_document
+from scheduler import INDEXING, set_priority
+
+# Placed on the queue to tell a worker to exit once it reaches it
+_STOP = object()
+
+# The ``action`` of a request to delete a document rather than index it
+DELETE = 'delete'
+
+def _perform(index_fn, delete_fn, request):
+    """Calls ``index_fn`` with a queued request, or ``delete_fn`` if it's a deletion."""
+    if request.get('action') == DELETE:
+        return delete_fn(**{name: value for name, value in request.items() if name != 'action'})
+    return index_fn(**request)
+
+class IndexingPipeline:
+    """Indexes messages to Vectara on background worker threads.
+
+    The Slack event handler only calls ``submit``, which puts the request on
+    a bounded queue.  Each worker takes up to ``drain_size`` requests off the
+    queue at a time, or what has arrived once the first has waited
+    ``max_drain_age`` seconds, and sends them one after another: Vectara's
+    index API takes one document per call, so this bounds how long a worker
+    holds messages back rather than batching the calls.  The ``drains`` stats
+    time each of these rounds.  When the queue is full, ``submit`` blocks for
+    up to ``enqueue_timeout`` seconds (backpressure) and then drops the
+    message.  ``stop`` flushes everything already queued.
+
+    With a ``journal`` (see ``IndexJournal``) every message is written to
+    disk before it is queued and acknowledged once Vectara accepts it.
+    Failed messages, messages that didn't fit on the queue and messages left
+    over from a previous run are replayed from the journal instead of lost.
+
+    A request with ``action`` set to ``DELETE`` is a ``delete_fn`` call.
+    ``on_indexed`` is called with the arguments of each request Vectara
+    accepts.
+    """
+
+    def __init__(self, index_fn=index_message, delete_fn=delete_document, num_workers: int = None,
+                 drain_size: int = None, max_drain_age: float = None,
+                 max_queue_size: int = None, enqueue_timeout: float = None,
+                 journal=None, replay_interval: float = 1.0,
+                 compact_interval: float = 60.0, on_indexed=None):
+        if num_workers == None:
+            num_workers = int(os.environ.get('VECTARA_INDEX_WORKERS', 2))
+        if drain_size == None:
+            drain_size = int(os.environ.get('VECTARA_INDEX_DRAIN_SIZE', 20))
+        if max_drain_age == None:
+            max_drain_age = float(os.environ.get('VECTARA_INDEX_DRAIN_MAX_AGE', 1.0))
+        if max_queue_size == None:
+            max_queue_size = int(os.environ.get('VECTARA_INDEX_QUEUE_SIZE', 10000))
+        if enqueue_timeout == None:
+            enqueue_timeout = float(os.environ.get('VECTARA_INDEX_ENQUEUE_TIMEOUT', 5.0))
+        self.index_fn = index_fn
+        self.delete_fn = delete_fn
+        self.num_workers = num_workers
+        self.drain_size = drain_size
+        self.max_drain_age = max_drain_age
+        self.enqueue_timeout = enqueue_timeout
+        self.journal = journal
+        self.on_indexed = on_indexed
+        self.replay_interval = replay_interval
+        self.compact_interval = compact_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._workers = []
+        self._replayer = None
+        self._stop_replay = threading.Event()
+        # journal entries currently on the queue or being indexed
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.submitted = 0
+        self.dropped = 0
+        self.indexed = 0
+        self.failed = 0
+        self.drains = 0
+        self.last_drain_latency = 0.0
+        self.max_drain_latency = 0.0
+        self._total_drain_latency = 0.0
+
+    def start(self):
+        """Starts the worker threads; calling it again is a no-op."""
+        with self._lock:
+            if self._workers or self._stopping:
+                return
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._run,
+                                          name="vectara-indexer-{}".format(i),
+                                          daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            if self.journal != None:
+                self._replayer = threading.Thread(target=self._replay,
+                                                  name="vectara-index-replay",
+                                                  daemon=True)
+                self._replayer.start()
+
+    def submit(self, **index_kwargs) -> bool:
+        """Queues an ``index_message`` call, returning False if it was dropped."""
+        if self._stopping:
+            logging.error("Indexing pipeline is stopped, dropping %s", index_kwargs.get('id'))
+            return False
+        self.start()
+        entry_id = None
+        if self.journal != None:
+            # the replayer only looks for due entries under the same lock, so
+            # it can't catch this one between the journal and the queue
+            with self._lock:
+                entry_id = self.journal.append(index_kwargs)
+                self._in_flight.add(entry_id)
+        try:
+            self._queue.put((time.monotonic(), entry_id, index_kwargs), timeout=self.enqueue_timeout)
+        except queue.Full:
+            if entry_id != None:
+                # it's safe on disk, the replayer will pick it up later
+                with self._lock:
+                    self._in_flight.discard(entry_id)
+                    self.submitted += 1
+                logging.warning("Indexing queue is full, deferring %s", index_kwargs.get('id'))
+                return True
+            with self._lock:
+                self.dropped += 1
+            logging.error("Indexing queue is full, dropping %s", index_kwargs.get('id'))
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _replay(self):
+        """Re-queues journal entries that are due: retries and leftovers from a previous run."""
+        last_compaction = time.monotonic()
+        while not self._stop_replay.is_set():
+            with self._lock:
+                due = self.journal.due(limit=self.drain_size * self.num_workers,
+                                       exclude=self._in_flight)
+                self._in_flight.update(entry_id for entry_id, _ in due)
+            for i, (entry_id, index_kwargs) in enumerate(due):
+                try:
+                    self._queue.put_nowait((time.monotonic(), entry_id, index_kwargs))
+                except queue.Full:
+                    with self._lock:
+                        self._in_flight.difference_update(entry_id for entry_id, _ in due[i:])
+                    break
+            if time.monotonic() - last_compaction >= self.compact_interval:
+                self.journal.compact()
+                last_compaction = time.monotonic()
+            self._stop_replay.wait(self.replay_interval)
+
+    def _next_drain(self):
+        """Blocks for the first item, then takes more until there are ``drain_size``
+        or the first is ``max_drain_age`` old."""
+        drained = []
+        item = self._queue.get()
+        if item is _STOP:
+            return drained, True
+        drained.append(item)
+        deadline = item[0] + self.max_drain_age
+        while len(drained) < self.drain_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return drained, True
+            drained.append(item)
+        return drained, False
+
+    def _run(self):
+        # searches go ahead of us in the scheduler
+        set_priority(INDEXING)
+        stop = False
+        while not stop:
+            drained, stop = self._next_drain()
+            if drained:
+                self._index_drained(drained)
+
+    def _index_drained(self, drained):
+        start = time.monotonic()
+        indexed = 0
+        for _, entry_id, index_kwargs in drained:
+            response = None
+            try:
+                response, success = _perform(self.index_fn, self.delete_fn, index_kwargs)
+            except Exception:
+                logging.exception("Indexing %s failed", index_kwargs.get('id'))
+                success = False
+            if success:
+                indexed += 1
+                if self.on_indexed != None:
+                    self.on_indexed(index_kwargs)
+            if entry_id != None:
+                self._settle(entry_id, index_kwargs, response, success)
+        latency = time.monotonic() - start
+        with self._lock:
+            self.drains += 1
+            self.indexed += indexed
+            self.failed += len(drained) - indexed
+            self.last_drain_latency = latency
+            self.max_drain_latency = max(self.max_drain_latency, latency)
+            self._total_drain_latency += latency
+        logging.debug("Indexed %d drained messages in %.3fs (%d failed), queue depth %d",
+                      len(drained), latency, len(drained) - indexed, self._queue.qsize())
+
+    def _settle(self, entry_id, index_kwargs, response, success):
+        _settle_journal_entry(self.journal, entry_id, index_kwargs, response, success)
+        with self._lock:
+            self._in_flight.discard(entry_id)
+
+    def stop(self, timeout: float = None):
+        """Stops accepting messages and waits for the queued ones to be indexed."""
+        with self._lock:
+            self._stopping = True
+            workers = list(self._workers)
+        self._stop_replay.set()
+        if self._replayer != None:
+            self._replayer.join()
+        # Each worker exits when it reaches its own marker, which sits behind
+        # everything that was already queued.
+        for _ in workers:
+            self._queue.put(_STOP)
+        deadline = time.monotonic() + timeout if timeout != None else None
+        for worker in workers:
+            worker.join(None if deadline == None else max(deadline - time.monotonic(), 0))
+        unflushed = self._queue.qsize()
+        if unflushed:
+            logging.error("Indexing pipeline stopped with %d messages still queued", unflushed)
+
+    def stats(self) -> dict:
+        journal_stats = self.journal.stats() if self.journal != None else {}
+        with self._lock:
+            return {
+                **journal_stats,
+                "queue_depth": self._queue.qsize(),
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "indexed": self.indexed,
+                "failed": self.failed,
+                "drains": self.drains,
+                "last_drain_latency": self.last_drain_latency,
+                "max_drain_latency": self.max_drain_latency,
+                "avg_drain_latency": self._total_drain_latency / self.drains if self.drains else 0.0,
+            }
+
+def _is_permanent_failure(response) -> bool:
+    """A 4xx other than timeouts and rate limiting won't succeed on retry."""
+    status_code = getattr(response, 'status_code', None)
+    return status_code != None and 400 <= status_code < 500 and status_code not in (408, 429)
+
+def _settle_journal_entry(journal, entry_id, index_kwargs, response, success):
+    """Acknowledges or reschedules a journal entry after an attempt."""
+    if success:
+        journal.ack(entry_id)
+    elif _is_permanent_failure(response):
+        logging.error("Vectara rejected %s with %d, not retrying",
+                      index_kwargs.get('id'), response.status_code)
+        journal.ack(entry_id)
+    else:
+        delay = journal.retry_later(entry_id)
+        logging.warning("Retrying %s in %.1fs", index_kwargs.get('id'), delay)
+
+class AsyncIndexingPipeline:
+    """The asyncio counterpart of ``IndexingPipeline``.
+
+    Instead of worker threads, each submitted message becomes a task running
+    the async ``index_fn``, with at most ``max_in_flight`` running at once.
+    ``submit`` waits up to ``enqueue_timeout`` seconds for a free slot
+    (backpressure).  Deletions and the optional ``journal`` and ``on_indexed``
+    behave as in ``IndexingPipeline``.
+    """
+
+    def __init__(self, index_fn, delete_fn=None, max_in_flight: int = None,
+                 enqueue_timeout: float = None, journal=None,
+                 replay_interval: float = 1.0, compact_interval: float = 60.0,
+                 on_indexed=None):
+        if max_in_flight == None:
+            max_in_flight = int(os.environ.get('VECTARA_INDEX_MAX_IN_FLIGHT', 64))
+        if enqueue_timeout == None:
+            enqueue_timeout = float(os.environ.get('VECTARA_INDEX_ENQUEUE_TIMEOUT', 5.0))
+        self.index_fn = index_fn
+        self.delete_fn = delete_fn
+        self.max_in_flight = max_in_flight
+        self.enqueue_timeout = enqueue_timeout
+        self.journal = journal
+        self.on_indexed = on_indexed
+        self.replay_interval = replay_interval
+        self.compact_interval = compact_interval
+        self._slots = None
+        self._tasks = set()
+        self._replayer = None
+        self._stopping = False
+        # journal entries currently being indexed
+        self._in_flight = set()
+        self.submitted = 0
+        self.dropped = 0
+        self.indexed = 0
+        self.failed = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+
+    def start(self):
+        """Starts the journal replayer; must be called from the running event loop."""
+        if self._slots != None or self._stopping:
+            return
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        if self.journal != None:
+            self._replayer = asyncio.ensure_future(self._replay())
+
+    async def submit(self, **index_kwargs) -> bool:
+        """Starts indexing a message in the background, returning False if it was dropped."""
+        if self._stopping:
+            logging.error("Indexing pipeline is stopped, dropping %s", index_kwargs.get('id'))
+            return False
+        self.start()
+        entry_id = None
+        if self.journal != None:
+            entry_id = self.journal.append(index_kwargs)
+            self._in_flight.add(entry_id)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            if entry_id != None:
+                # it's safe on disk, the replayer will pick it up later
+                self._in_flight.discard(entry_id)
+                self.submitted += 1
+                logging.warning("Too many messages being indexed, deferring %s", index_kwargs.get('id'))
+                return True
+            self.dropped += 1
+            logging.error("Too many messages being indexed, dropping %s", index_kwargs.get('id'))
+            return False
+        self.submitted += 1
+        self._spawn(entry_id, index_kwargs)
+        return True
+
+    def _spawn(self, entry_id, index_kwargs):
+        task = asyncio.ensure_future(self._index(entry_id, index_kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _index(self, entry_id, index_kwargs):
+        # this task's context only, searches go ahead of us in the scheduler
+        set_priority(INDEXING)
+        start = time.monotonic()
+        response = None
+        try:
+            response, success = await _perform(self.index_fn, self.delete_fn, index_kwargs)
+        except Exception:
+            logging.exception("Indexing %s failed", index_kwargs.get('id'))
+            success = False
+        finally:
+            self._slots.release()
+        latency = time.monotonic() - start
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self._total_latency += latency
+        if success:
+            self.indexed += 1
+            if self.on_indexed != None:
+                self.on_indexed(index_kwargs)
+        else:
+            self.failed += 1
+        if entry_id != None:
+            _settle_journal_entry(self.journal, entry_id, index_kwargs, response, success)
+            self._in_flight.discard(entry_id)
+
+    async def _replay(self):
+        """Starts indexing journal entries that are due: retries and leftovers from a previous run."""
+        last_compaction = time.monotonic()
+        while not self._stopping:
+            # submit appends and claims its entry without awaiting in
+            # between, and so does this, so neither can take the other's
+            due = self.journal.due(limit=self.max_in_flight, exclude=self._in_flight)
+            for entry_id, index_kwargs in due:
+                if self._slots.locked():
+                    break
+                self._in_flight.add(entry_id)
+                await self._slots.acquire()
+                self._spawn(entry_id, index_kwargs)
+            if time.monotonic() - last_compaction >= self.compact_interval:
+                self.journal.compact()
+                last_compaction = time.monotonic()
+            await asyncio.sleep(self.replay_interval)
+
+    async def stop(self, timeout: float = None):
+        """Stops accepting messages and waits for the ones being indexed."""
+        self._stopping = True
+        if self._replayer != None:
+            self._replayer.cancel()
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def stats(self) -> dict:
+        journal_stats = self.journal.stats() if self.journal != None else {}
+        completed = self.indexed + self.failed
+        return {
+            **journal_stats,
+            "in_flight": len(self._tasks),
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "indexed": self.indexed,
+            "failed": self.failed,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self._total_latency / completed if completed else 0.0,
+        }
+
+class EditDebouncer:
+    """Coalesces bursts of changes to the same message into one update.
+
+    The first change to a message (by ``key``) opens a ``window`` second
+    window, later ones replace the pending one, and once the window closes
+    the latest is passed to ``submit`` on a background thread.  A deletion
+    is a change too, so it replaces a pending edit rather than racing it,
+    and it doesn't overtake the message's own indexing, which a pipeline
+    worker may hold back for up to ``max_drain_age``.  ``stop`` submits
+    everything still pending.
+    """
+
+    def __init__(self, submit, window: float = None):
+        if window == None:
+            window = float(os.environ.get('VECTARA_EDIT_DEBOUNCE', 2.0))
+        self.submit = submit
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._deadlines = []
+        self._thread = None
+        self._stopping = False
+        self.edits = 0
+        self.coalesced = 0
+
+    def add(self, key, request: dict):
+        """Schedules ``request``, replacing any pending change to the same message."""
+        with self._cond:
+            stopping = self._stopping
+            if self._thread == None and not stopping:
+                self._thread = threading.Thread(target=self._run, name="vectara-edit-debouncer",
+                                                daemon=True)
+                self._thread.start()
+            self.edits += 1
+            if stopping:
+                pass
+            elif key in self._pending:
+                self.coalesced += 1
+                self._pending[key][1] = request
+            else:
+                deadline = time.monotonic() + self.window
+                heapq.heappush(self._deadlines, (deadline, key))
+                self._pending[key] = [deadline, request]
+                self._cond.notify()
+        if stopping:
+            self.submit(**request)
+
+    def _due(self):
+        """Waits for the next closed window and returns its request, or None once stopped."""
+        with self._cond:
+            while True:
+                if self._deadlines:
+                    deadline, key = self._deadlines[0]
+                    wait = deadline - time.monotonic()
+                    if wait <= 0 or self._stopping:
+                        heapq.heappop(self._deadlines)
+                        return self._pending.pop(key)[1]
+                elif self._stopping:
+                    return None
+                else:
+                    wait = None
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            request = self._due()
+            if request == None:
+                return
+            try:
+                self.submit(**request)
+            except Exception:
+                logging.exception("Submitting the edit of %s failed", request.get('id'))
+
+    def stop(self):
+        """Submits the pending edits without waiting out their windows."""
+        with self._cond:
+            self._stopping = True
+            thread = self._thread
+            self._cond.notify()
+        if thread != None:
+            thread.join()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "pending_edits": len(self._pending),
+                "edits": self.edits,
+                "coalesced_edits": self.coalesced,
+            }
+
+class AsyncEditDebouncer:
+    """The asyncio counterpart of ``EditDebouncer``, ``submit`` is awaited."""
+
+    def __init__(self, submit, window: float = None):
+        if window == None:
+            window = float(os.environ.get('VECTARA_EDIT_DEBOUNCE', 2.0))
+        self.submit = submit
+        self.window = window
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+        self.edits = 0
+        self.coalesced = 0
+
+    def add(self, key, request: dict):
+        """Schedules ``request``, replacing any pending change to the same message."""
+        self.edits += 1
+        if key in self._pending:
+            self.coalesced += 1
+        else:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+        self._pending[key] = request
+
+    def _flush(self, key):
+        del self._timers[key]
+        task = asyncio.ensure_future(self._submit(self._pending.pop(key)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _submit(self, request):
+        try:
+            await self.submit(**request)
+        except Exception:
+            logging.exception("Submitting the edit of %s failed", request.get('id'))
+
+    async def stop(self):
+        """Submits the pending edits without waiting out their windows."""
+        for key in list(self._timers):
+            self._timers[key].cancel()
+            self._flush(key)
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def stats(self) -> dict:
+        return {
+            "pending_edits": len(self._pending),
+            "edits": self.edits,
+            "coalesced_edits": self.coalesced,
+        }
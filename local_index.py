@@ -0,0 +1,284 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Every message the bot indexes to Vectara is also kept in a local SQLite
+# FTS5 index, which answers three kinds of search without Vectara:
+#
+# - exact-token queries (a ticket ID, an error code, a "quoted phrase"),
+#   which Vectara's semantic search is poor at, are answered from it alone
+#   when it has a match
+# - other queries get its keyword matches, messages holding every word of
+#   the query, blended into Vectara's results by reciprocal rank fusion
+# - when Vectara doesn't answer in time, its matches for any of the words
+#   are shown instead, marked ``degraded``
+#
+# Only the last LOCAL_INDEX_MAX_MESSAGES messages of the last
+# LOCAL_INDEX_MAX_AGE_DAYS days are kept.
+
+# a single token with a digit, inner punctuation or a capital after its first
+# letter: JIRA-1234, 0x7f3a, ECONNREFUSED, NullPointerException, v2.3.1
+_EXACT_TOKEN_REGEX = re.compile(r'\S*(?:\d|\w[-_.:/#]\w|\w[A-Z])\S*')
+_QUOTED_REGEX = re.compile(r'"[^"]+"')
+_WORD_REGEX = re.compile(r'\w+')
+# the metadata filters slack_helpers builds, e.g. doc.channel = 'C03V4NCQJK2'
+_FILTER_REGEX = re.compile(r"(?:doc|part)\.(channel|poster|timestamp) (=|>=|<=) (?:'([^']*)'|(-?[\d.]+))")
+# what a local result carries, as Vectara document metadata
+_RESULT_METADATA = ('poster', 'channel', 'message_link', 'timestamp')
+# reciprocal rank fusion's damping constant, the usual one
+_RRF_K = 60
+
+def exact_token_query(search_text: str) -> bool:
+    """Whether a query is one exact token or a quoted phrase, rather than a question."""
+    search_text = search_text.strip()
+    return bool(_QUOTED_REGEX.fullmatch(search_text) or _EXACT_TOKEN_REGEX.fullmatch(search_text))
+
+def _match_expression(search_text: str, match: str):
+    """An FTS5 query for the words of ``search_text``: as a ``phrase``, ``all``
+    of them or ``any`` of them.  None if there are no words."""
+    words = _WORD_REGEX.findall(search_text)
+    if not words:
+        return None
+    if match == 'phrase':
+        return '"{}"'.format(' '.join(words))
+    return (' OR ' if match == 'any' else ' ').join('"{}"'.format(word) for word in words)
+
+def _filter_clauses(filters: list):
+    """SQL conditions and parameters for Vectara metadata filters, or None if
+    one of them isn't something the local index can apply."""
+    clauses = []
+    params = []
+    for filter in filters:
+        parsed = _FILTER_REGEX.fullmatch(filter)
+        if parsed == None:
+            return None
+        column, operator, text, number = parsed.groups()
+        clauses.append("m.{} {} ?".format(column, operator))
+        params.append(float(number) if number != None else text)
+    return clauses, params
+
+def _response_set(hits: list) -> dict:
+    """A Vectara search response from ``(response, document)`` pairs, in order."""
+    documents = []
+    indexes = {}
+    responses = []
+    for response, document in hits:
+        index = indexes.get(id(document))
+        if index == None:
+            index = indexes[id(document)] = len(documents)
+            documents.append(document)
+        responses.append(dict(response, documentIndex=index))
+    return {"responseSet": [{"response": responses, "document": documents}]}
+
+def _hits(search_results: dict) -> list:
+    """The ``(response, document)`` pairs of a Vectara search response."""
+    if not search_results.get('responseSet'):
+        return []
+    response_set = search_results['responseSet'][0]
+    return [(response, response_set['document'][response['documentIndex']])
+            for response in response_set['response']]
+
+def _message_link(response: dict, document: dict):
+    """What identifies the message a result is, even inside an aggregated document."""
+    for metadata in (response.get('metadata') or (), document.get('metadata') or ()):
+        for item in metadata:
+            if item['name'] == 'message_link':
+                return item['value']
+    return document['id']
+
+def page_of(search_results: dict, start: int, num_results: int) -> dict:
+    """The results from ``start``, at most ``num_results`` of them, flags kept."""
+    page = _response_set(_hits(search_results)[start:start + num_results])
+    for flag in ('partial', 'degraded'):
+        if search_results.get(flag):
+            page[flag] = True
+    return page
+
+def blend_results(search_results: dict, local_results: dict, exact: bool = False) -> dict:
+    """Merges Vectara's results with the local index's, each message once.
+
+    Exact-token matches go first.  Otherwise the two rankings are combined by
+    reciprocal rank fusion: a result scores ``1 / (60 + rank)`` for each list
+    it's in, so one both agree on rises above either's own favourite.
+    """
+    if exact:
+        ranked = _hits(local_results) + _hits(search_results)
+    else:
+        scores = {}
+        first_seen = {}
+        for hits in (_hits(search_results), _hits(local_results)):
+            for rank, (response, document) in enumerate(hits):
+                link = _message_link(response, document)
+                scores[link] = scores.get(link, 0.0) + 1.0 / (_RRF_K + rank + 1)
+                first_seen.setdefault(link, (response, document))
+        ranked = [(dict(first_seen[link][0], score=scores[link]), first_seen[link][1])
+                  for link in sorted(scores, key=scores.get, reverse=True)]
+    seen = set()
+    blended = []
+    for response, document in ranked:
+        link = _message_link(response, document)
+        if link not in seen:
+            seen.add(link)
+            blended.append((response, document))
+    results = _response_set(blended)
+    # and what the search was, see rerank_planner.py
+    for key in ('partial', 'rerank_decision'):
+        if search_results.get(key):
+            results[key] = search_results[key]
+    return results
+
+def open_local_index():
+    """The ``LocalIndex`` at LOCAL_INDEX_PATH, or None if that's set to an
+    empty string or this Python's SQLite was built without FTS5."""
+    path = os.environ.get('LOCAL_INDEX_PATH', 'local_index.sqlite3')
+    if not path:
+        return None
+    try:
+        return LocalIndex(path)
+    except sqlite3.OperationalError as e:
+        logging.warning("The local index is off, SQLite can't create it: %s", e)
+        return None
+
+class LocalIndex:
+    """A SQLite FTS5 index of the messages sent to Vectara.
+
+    ``add`` takes the same requests as ``index_message``, one message each,
+    and ``delete`` the id of one.  ``search`` answers with a Vectara-shaped
+    response.  Messages older than ``max_age_days``, and the oldest beyond
+    ``max_messages``, are pruned every ``prune_interval`` seconds.
+    """
+
+    def __init__(self, path: str, max_messages: int = None, max_age_days: float = None,
+                 prune_interval: float = 60.0):
+        if max_messages == None:
+            max_messages = int(os.environ.get('LOCAL_INDEX_MAX_MESSAGES', 100000))
+        if max_age_days == None:
+            max_age_days = float(os.environ.get('LOCAL_INDEX_MAX_AGE_DAYS', 90))
+        self.path = path
+        self.max_messages = max_messages
+        self.max_age_days = max_age_days
+        self.prune_interval = prune_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                text TEXT NOT NULL,
+                poster TEXT,
+                channel TEXT,
+                message_link TEXT,
+                timestamp REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp)")
+        # the full-text index only holds the text, the rows hold everything else
+        self._conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                text, content='messages', content_rowid='rowid', tokenize='porter unicode61'
+            )""")
+        self._conn.executescript("""
+            CREATE TRIGGER IF NOT EXISTS messages_added AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_deleted AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_edited AFTER UPDATE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+                INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+            END;""")
+        self._next_prune = 0.0
+        self.added = 0
+        self.deleted = 0
+        self.pruned = 0
+        self.searches = 0
+
+    def add(self, request: dict):
+        """Adds an ``index_message`` request's message, or replaces its earlier version."""
+        metadata = request.get('metadata') or {}
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (id, text, poster, channel, message_link, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET text = excluded.text, poster = excluded.poster, "
+                "channel = excluded.channel, message_link = excluded.message_link, "
+                "timestamp = excluded.timestamp",
+                (request['id'], request['text'], metadata.get('poster'), metadata.get('channel'),
+                 metadata.get('message_link'), float(metadata.get('timestamp', now))))
+            self.added += 1
+            if now >= self._next_prune:
+                self._prune(now)
+
+    def delete(self, id: str):
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM messages WHERE id = ?", (id,))
+            self.deleted += cursor.rowcount
+
+    def _prune(self, now: float):
+        cursor = self._conn.execute("DELETE FROM messages WHERE timestamp < ?",
+                                    (now - self.max_age_days * 86400,))
+        pruned = cursor.rowcount
+        count = self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if count > self.max_messages:
+            cursor = self._conn.execute(
+                "DELETE FROM messages WHERE rowid IN "
+                "(SELECT rowid FROM messages ORDER BY timestamp LIMIT ?)",
+                (count - self.max_messages,))
+            pruned += cursor.rowcount
+        self.pruned += pruned
+        self._next_prune = now + self.prune_interval
+
+    def search(self, search_text: str, filters: list, limit: int, match: str = 'all'):
+        """The best ``limit`` messages for ``search_text`` as a Vectara response.
+
+        ``match`` is ``'phrase'``, ``'all'`` or ``'any'`` of its words, see
+        ``_match_expression``.  Returns None if one of ``filters`` can't be
+        applied here, since the results would include what it excludes.
+        """
+        expression = _match_expression(search_text.strip().strip('"'), match)
+        clauses = _filter_clauses(filters)
+        if clauses == None:
+            logging.debug("Can't search the local index with filters %s", filters)
+            return None
+        if expression == None:
+            return _response_set([])
+        conditions, params = clauses
+        sql = ("SELECT m.id, m.text, m.poster, m.channel, m.message_link, m.timestamp, "
+               "bm25(messages_fts) FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid "
+               "WHERE messages_fts MATCH ?{} ORDER BY bm25(messages_fts) LIMIT ?").format(
+                   ''.join(" AND " + condition for condition in conditions))
+        with self._lock:
+            rows = self._conn.execute(sql, [expression] + params + [limit]).fetchall()
+            self.searches += 1
+        hits = []
+        for id, text, poster, channel, message_link, timestamp, rank in rows:
+            values = dict(zip(_RESULT_METADATA, (poster, channel, message_link, timestamp)))
+            document = {"id": id, "metadata": [{"name": name, "value": str(value)}
+                                               for name, value in values.items() if value != None]}
+            # bm25() is lower for better matches
+            hits.append(({"text": text, "score": -rank, "metadata": []}, document))
+        return _response_set(hits)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            messages = self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "messages": messages,
+            "added": self.added,
+            "deleted": self.deleted,
+            "pruned": self.pruned,
+            "searches": self.searches,
+            "size_bytes": page_count * page_size,
+        }
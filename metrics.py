@@ -0,0 +1,229 @@
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import time
+
+# Prometheus metrics for the bot, served on METRICS_PORT.
+#
+# Handlers are wrapped with ``timed``, which records their total latency and
+# any exception, and makes them the ``handler`` label of every ``stage``
+# timed while they run, so a stage shared by several handlers (the Vectara
+# query, the ``say`` call) is broken down by who was waiting on it.
+#
+# Components that keep their own counters (the token cache, the indexer and
+# its journal, the search cache, the scheduler...) report them in ``stats()``.
+# ``register_stats`` exports those as the slackbot_component_stats gauge,
+# read at every scrape, one series per component and number reported.
+#
+# Metrics are switched on at import, by METRICS_PORT.  Without it ``timed``
+# hands back the function untouched and ``stage`` a shared do-nothing context
+# manager, so the instrumentation costs a global lookup per call.
+
+_current_handler = contextvars.ContextVar('metrics_handler', default='other')
+
+# filled in by enable()
+_stage_seconds = None
+_errors = None
+_empty_results = None
+_payload_bytes = None
+_corpus_misses = None
+_local_searches = None
+_skipped_messages = None
+_rerank_decisions = None
+_home_views = None
+# component name -> its stats() method, see register_stats
+_stats_sources = {}
+
+def enabled() -> bool:
+    return _stage_seconds != None
+
+def enable(registry=None):
+    """Creates the metrics, in ``registry`` or prometheus_client's default one."""
+    global _stage_seconds, _errors, _empty_results, _payload_bytes, _corpus_misses, _local_searches
+    global _skipped_messages, _rerank_decisions, _home_views
+    from prometheus_client import REGISTRY, Counter, Histogram
+    if registry == None:
+        registry = REGISTRY
+    _stage_seconds = Histogram(
+        'slackbot_stage_seconds', "Latency of each stage of a handler",
+        ['handler', 'stage'], registry=registry,
+        buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+    _errors = Counter('slackbot_errors', "Handler calls that failed", ['handler'], registry=registry)
+    _empty_results = Counter('slackbot_empty_results', "Searches that found nothing",
+                             ['handler'], registry=registry)
+    _payload_bytes = Histogram(
+        'slackbot_payload_bytes', "Size of Vectara requests and responses", ['kind'],
+        registry=registry, buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+    _corpus_misses = Counter('slackbot_corpus_misses',
+                             "Searches a corpus didn't answer in time, or failed", ['corpus'],
+                             registry=registry)
+    _local_searches = Counter('slackbot_local_searches',
+                              "Searches the local index answered (exact), added to (blended) "
+                              "or stood in for Vectara in (fallback)", ['outcome'],
+                              registry=registry)
+    _skipped_messages = Counter('slackbot_skipped_messages', "Messages not indexed, by why",
+                                ['reason'], registry=registry)
+    _rerank_decisions = Counter('slackbot_rerank_decisions',
+                                "Reranked searches, by whether the reranker ran and how "
+                                "their candidates were counted", ['decision', 'sizing'],
+                                registry=registry)
+    _home_views = Counter('slackbot_home_views', "App Home opens, by whether the view was "
+                          "published or the user already had it", ['outcome'], registry=registry)
+    registry.register(_StatsCollector())
+
+def _numbers(stats: dict, prefix: str = ""):
+    """``(name, value)`` for every number in ``stats``, nested dicts' names
+    joined with dots, e.g. ``waits.search.avg_wait``."""
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            yield from _numbers(value, "{}{}.".format(prefix, name))
+        elif isinstance(value, (int, float)):
+            yield prefix + str(name), float(value)
+
+class _StatsCollector:
+    """Reads every registered component's ``stats()`` when Prometheus scrapes."""
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+        family = GaugeMetricFamily('slackbot_component_stats',
+                                   "What each component reports in its stats()",
+                                   labels=['component', 'stat'])
+        for component, stats in list(_stats_sources.items()):
+            try:
+                values = stats()
+            except Exception:
+                logging.exception("Couldn't read the stats of %s", component)
+                continue
+            for stat, value in _numbers(values):
+                family.add_metric([component, stat], value)
+        yield family
+
+def register_stats(component: str, stats):
+    """Exports what ``stats``, a component's ``stats()`` method, returns as
+    the slackbot_component_stats gauge, labelled ``component``."""
+    _stats_sources[component] = stats
+
+def start_server():
+    """Serves /metrics on METRICS_PORT, if metrics are enabled."""
+    if enabled():
+        from prometheus_client import start_http_server
+        port = int(os.environ['METRICS_PORT'])
+        start_http_server(port, addr=os.environ.get('METRICS_ADDR', '0.0.0.0'))
+        logging.info("Serving metrics on port %d", port)
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _stage_seconds.labels(_current_handler.get(), self.stage).observe(time.perf_counter() - self.started)
+        return False
+
+def stage(name: str):
+    """Times the block as stage ``name`` of the running handler."""
+    if _stage_seconds == None:
+        return _NULL_STAGE
+    return _Stage(name)
+
+def _start_handler(name: str):
+    return _current_handler.set(name), time.perf_counter()
+
+def _finish_handler(name: str, token, started: float, failed: bool):
+    _stage_seconds.labels(name, 'total').observe(time.perf_counter() - started)
+    if failed:
+        _errors.labels(name).inc()
+    _current_handler.reset(token)
+
+def timed(name: str):
+    """Decorates a handler, sync or async, to be timed and labelled ``name``.
+
+    It uses functools.wraps, so Bolt still sees the handler's own arguments.
+    """
+    def decorate(function):
+        if _stage_seconds == None:
+            return function
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                token, started = _start_handler(name)
+                failed = True
+                try:
+                    result = await function(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    _finish_handler(name, token, started, failed)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            token, started = _start_handler(name)
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _finish_handler(name, token, started, failed)
+        return wrapper
+    return decorate
+
+def count_error():
+    """Counts a failure the running handler reported without raising."""
+    if _errors != None:
+        _errors.labels(_current_handler.get()).inc()
+
+def count_empty_result():
+    if _empty_results != None:
+        _empty_results.labels(_current_handler.get()).inc()
+
+def observe_payload(kind: str, size: int):
+    """Records the size in bytes of a ``kind`` of payload, e.g. ``query_request``."""
+    if _payload_bytes != None:
+        _payload_bytes.labels(kind).observe(size)
+
+def count_corpus_miss(corpus_id):
+    """Counts a corpus left out of a multi-corpus search."""
+    if _corpus_misses != None:
+        _corpus_misses.labels(str(corpus_id)).inc()
+
+def count_local_search(outcome: str):
+    """Counts a search the local index took part in, see local_index.py."""
+    if _local_searches != None:
+        _local_searches.labels(outcome).inc()
+
+def count_skipped_message(reason: str):
+    """Counts a message content_filter kept out of the index."""
+    if _skipped_messages != None:
+        _skipped_messages.labels(reason).inc()
+
+def count_rerank_decision(decision: str, sizing: str):
+    """Counts a reranked search rerank_planner planned."""
+    if _rerank_decisions != None:
+        _rerank_decisions.labels(decision, sizing).inc()
+
+def count_home_view(outcome: str):
+    """Counts an App Home open, see home_view.py."""
+    if _home_views != None:
+        _home_views.labels(outcome).inc()
+
+if os.environ.get('METRICS_PORT'):
+    try:
+        enable()
+    except ImportError:
+        logging.warning("METRICS_PORT is set but prometheus_client isn't installed, metrics are off")
@@ -0,0 +1,67 @@
+import logging
+from scheduler import (scheduler, per_channel, SLACK_RESPONSE_URL, SLACK_UPDATE_MESSAGE)
+
+# Chat messages are updated through chat.update, which only takes the
+# message's own fields
+_UPDATE_FIELDS = ('text', 'blocks', 'attachments')
+
+class ProgressiveReply:
+    """A reply that's posted once and then updated in place.
+
+    ``say`` is what the handler was given: a ``say``, whose message is then
+    changed with chat.update, or a ``respond``, whose message is replaced
+    through the response_url.  Calls wait their turn in the scheduler, the
+    post on ``post_endpoint``.  An update that fails, say because the first
+    post did, is posted as a new message instead.
+    """
+
+    def __init__(self, say, post_endpoint: str):
+        self.say = say
+        self.post_endpoint = post_endpoint
+        self.channel = getattr(say, 'channel', None)
+        self.ts = None
+
+    def _updates_by_response_url(self) -> bool:
+        return getattr(self.say, 'response_url', None) != None
+
+    def post(self, **message):
+        response = scheduler.call(per_channel(self.post_endpoint, self.channel), self.say, **message)
+        if not self._updates_by_response_url():
+            self.channel = response['channel']
+            self.ts = response['ts']
+
+    def update(self, **message):
+        try:
+            if self._updates_by_response_url():
+                scheduler.call(per_channel(SLACK_RESPONSE_URL, self.channel), self.say,
+                               replace_original=True, **message)
+            else:
+                scheduler.call(SLACK_UPDATE_MESSAGE, self.say.client.chat_update,
+                               channel=self.channel, ts=self.ts,
+                               **{name: value for name, value in message.items() if name in _UPDATE_FIELDS})
+        except Exception:
+            logging.exception("Updating the reply failed, posting it instead")
+            self.post(**message)
+
+class AsyncProgressiveReply(ProgressiveReply):
+    """The asyncio version of ``ProgressiveReply``, for ``AsyncSay`` and ``AsyncRespond``."""
+
+    async def post(self, **message):
+        response = await scheduler.call_async(per_channel(self.post_endpoint, self.channel), self.say, **message)
+        if not self._updates_by_response_url():
+            self.channel = response['channel']
+            self.ts = response['ts']
+
+    async def update(self, **message):
+        try:
+            if self._updates_by_response_url():
+                await scheduler.call_async(per_channel(SLACK_RESPONSE_URL, self.channel), self.say,
+                                           replace_original=True, **message)
+            else:
+                await scheduler.call_async(SLACK_UPDATE_MESSAGE, self.say.client.chat_update,
+                                           channel=self.channel, ts=self.ts,
+                                           **{name: value for name, value in message.items()
+                                              if name in _UPDATE_FIELDS})
+        except Exception:
+            logging.exception("Updating the reply failed, posting it instead")
+            await self.post(**message)
@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+import metrics
+
+# Reranking is most of a reranked search's latency, and it grows with the
+# number of candidates.  Always reranking the top 100, as build_search_request
+# does, pays for 100 when most searches only ever show the first few.  With
+# VECTARA_RERANK_ADAPTIVE=true a RerankPlanner sizes the pool instead:
+#
+# - the first page reranks as many candidates as fit in VECTARA_RERANK_BUDGET
+#   seconds, going by how long reranking has been taking per candidate and
+#   what the query costs without it, or VECTARA_RERANK_INITIAL_CANDIDATES
+#   until that's been measured; never fewer than 5
+# - paging past the end of the pool reranks a pool twice the size, up to
+#   VECTARA_RERANK_MAX_CANDIDATES, and its new results go after the ones
+#   already shown
+# - with VECTARA_RERANK_SKIP_MARGIN set, the candidates are fetched without
+#   the reranker first, and when the top one's score is at least that far
+#   ahead of the second's, those are the results and reranking is skipped
+#
+# Each search's plan ends up in its results as ``rerank_decision``, and is
+# logged and counted.
+
+_MIN_CANDIDATES = 5
+
+def _responses(search_results: dict) -> list:
+    if not search_results.get('responseSet'):
+        return []
+    return search_results['responseSet'][0]['response']
+
+def extend_pool(previous: dict, widened: dict) -> dict:
+    """``widened`` with the results of the ``previous``, narrower pool first, in
+    their order, so the pages already shown don't change when it's reranked."""
+    hits = []
+    for search_results in (previous, widened):
+        documents = search_results['responseSet'][0]['document'] if search_results.get('responseSet') else []
+        hits.extend((response, documents[response['documentIndex']]) for response in _responses(search_results))
+    seen = set()
+    documents = []
+    indexes = {}
+    responses = []
+    for response, document in hits:
+        key = (document['id'], response['text'])
+        if key in seen:
+            continue
+        seen.add(key)
+        index = indexes.get(id(document))
+        if index == None:
+            index = indexes[id(document)] = len(documents)
+            documents.append(document)
+        responses.append(dict(response, documentIndex=index))
+    return dict(widened, responseSet=[{"response": responses, "document": documents}])
+
+def adaptive_reranking() -> bool:
+    return os.environ.get('VECTARA_RERANK_ADAPTIVE') == 'true'
+
+class RerankPlanner:
+    """Picks how many candidates a reranked search reranks, see the top of this module.
+
+    Latencies are smoothed with an exponentially weighted moving average:
+    ``base`` for queries without the reranker, ``per_candidate`` for what
+    the reranker adds per candidate.
+    """
+
+    def __init__(self, budget: float = None, initial: int = None, maximum: int = None,
+                 skip_margin: float = None, smoothing: float = 0.2):
+        if budget == None:
+            budget = float(os.environ.get('VECTARA_RERANK_BUDGET', 1.5))
+        if initial == None:
+            initial = int(os.environ.get('VECTARA_RERANK_INITIAL_CANDIDATES', 10))
+        if maximum == None:
+            maximum = int(os.environ.get('VECTARA_RERANK_MAX_CANDIDATES', 100))
+        if skip_margin == None and os.environ.get('VECTARA_RERANK_SKIP_MARGIN'):
+            skip_margin = float(os.environ['VECTARA_RERANK_SKIP_MARGIN'])
+        self.budget = budget
+        self.initial = initial
+        self.maximum = maximum
+        self.skip_margin = skip_margin
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self.base = None
+        self.per_candidate = None
+        self.decisions = {"reranked": 0, "skipped": 0}
+        self.candidates_total = 0
+
+    def _average(self, current, sample: float) -> float:
+        if current == None:
+            return sample
+        return current + self.smoothing * (sample - current)
+
+    def observe(self, candidates: int, seconds: float, reranked: bool):
+        """Records how long a query for ``candidates`` results took."""
+        with self._lock:
+            if not reranked:
+                self.base = self._average(self.base, seconds)
+            elif candidates:
+                # what the reranker added, as far as we know what the query costs without it
+                self.per_candidate = self._average(
+                    self.per_candidate, max(0.0, seconds - (self.base or 0.0)) / candidates)
+
+    def plan(self, page: int = 0, search_results: dict = None):
+        """How many candidates to rerank to show result ``page`` (counting from 0).
+
+        ``search_results`` is the cached pool of an earlier page, if there is
+        one.  Returns the start of a ``rerank_decision``, or None if that pool
+        already reaches ``page`` or holds every result there is.
+        """
+        if search_results != None:
+            decision = search_results.get('rerank_decision')
+            if len(_responses(search_results)) > page or decision == None or not decision['more']:
+                return None
+            candidates, sizing = decision['candidates'] * 2, "widened"
+        else:
+            with self._lock:
+                base, per_candidate = self.base, self.per_candidate
+            if per_candidate:
+                # with a skip margin the unreranked query runs first, and
+                # its round trip comes out of the budget too
+                spent = (base or 0.0) * (2 if self.skip_margin != None else 1)
+                candidates, sizing = int((self.budget - spent) / per_candidate), "budget"
+            else:
+                candidates, sizing = self.initial, "initial"
+        # a budget that's already spent still gets the smallest pool, and
+        # the pool has to reach the page asked for
+        candidates = max(_MIN_CANDIDATES, candidates)
+        while candidates <= page:
+            candidates *= 2
+        return {"candidates": max(_MIN_CANDIDATES, min(self.maximum, candidates)), "sizing": sizing}
+
+    def top_score_margin(self, search_results: dict):
+        """How far the first result's score is ahead of the second's, or None
+        if there aren't two."""
+        responses = _responses(search_results)
+        if len(responses) < 2:
+            return None
+        return responses[0]['score'] - responses[1]['score']
+
+    def should_skip(self, search_results: dict) -> bool:
+        """Whether first-stage results are clear enough that reranking can't help much."""
+        margin = self.top_score_margin(search_results)
+        return self.skip_margin != None and margin != None and margin >= self.skip_margin
+
+    def record(self, search_text: str, decision: dict, search_results: dict):
+        """Finishes ``decision`` for the pool in ``search_results``, then counts and logs it."""
+        decision['returned'] = len(_responses(search_results))
+        # a full pool may have been cut short, and a wider one would have more
+        decision['more'] = decision['returned'] >= decision['candidates'] and decision['candidates'] < self.maximum
+        search_results['rerank_decision'] = decision
+        outcome = "reranked" if decision['reranked'] else "skipped"
+        with self._lock:
+            self.decisions[outcome] += 1
+            self.candidates_total += decision['candidates']
+        metrics.count_rerank_decision(outcome, decision['sizing'])
+        logging.info("Rerank decision for %r: %s", search_text, decision)
+
+    def stats(self) -> dict:
+        with self._lock:
+            searches = sum(self.decisions.values())
+            return {
+                **self.decisions,
+                "avg_candidates": self.candidates_total / searches if searches else 0.0,
+                "base_latency": self.base,
+                "per_candidate_latency": self.per_candidate,
+            }
@@ -0,0 +1,320 @@
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+from slack_helpers import encode_cursor, search_window
+import metrics
+
+# Everything here runs once per search result, so the patterns are compiled
+# once at import and the escaper makes a single left-to-right pass: regexes
+# only find candidate positions, and the link checks that used to backtrack
+# (``\[.+\]\(.+\)`` and ``<[^: >]+:/[^ >]+>``) are done with str.find and
+# remember their failures, so no input makes them quadratic.
+
+_MARKDOWN_CHARS = '_\\~|*`'
+_AS_NEEDED_CHARS = '*`_~|'
+_QUOTE_REGEX = re.compile(r'>(?:>>)?\s')
+_URL_REGEX = re.compile(r'(?:https?|steam):\/\/[^\s<]+[^<.,:;\"\'\]\s]')
+_ANGLE_URL_STOP_REGEX = re.compile(r'[: >]')
+_ANGLE_URL_END_REGEX = re.compile(r'[ >]')
+# positions where an escape or a link may start
+_TRIGGER_REGEX = re.compile(r'[_\\~|*`\[]')
+_TRIGGER_WITH_LINKS_REGEX = re.compile(r'[_\\~|*`\[<]|(?:https?|steam)://')
+_AS_NEEDED_TRIGGER_REGEX = re.compile(r'[*`_~|\[]')
+
+class _Scanner:
+    """Finds the spans the escaper leaves alone or escapes as a whole.
+
+    Each lookup remembers how far its failure extends, so a run of ``[`` or
+    ``<`` with no link after it is only scanned once.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._no_link_until = -1
+        self._no_angle_url_until = -1
+
+    def markdown_link_end(self, pos):
+        """Where ``\\[.+\\]\\(.+\\)`` starting at ``pos`` ends, or -1."""
+        if pos < self._no_link_until:
+            return -1
+        text = self.text
+        line_end = text.find('\n', pos)
+        if line_end == -1:
+            line_end = len(text)
+        # Greedy matching ends the link at the line's last ')', with the
+        # line's last usable '](' in between; both parts must be non-empty.
+        close = text.rfind(')', pos, line_end)
+        if close != -1 and text.rfind('](', pos + 2, close - 1) != -1:
+            return close + 1
+        # a later '[' on this line can only see less of it
+        self._no_link_until = line_end
+        return -1
+
+    def angle_url_end(self, pos):
+        """Where ``<[^: >]+:/[^ >]+>`` starting at ``pos`` ends, or -1."""
+        if pos < self._no_angle_url_until:
+            return -1
+        text = self.text
+        stop = _ANGLE_URL_STOP_REGEX.search(text, pos + 1)
+        stop = stop.start() if stop != None else len(text)
+        if stop > pos + 1 and text.startswith(':/', stop):
+            end = _ANGLE_URL_END_REGEX.search(text, stop + 2)
+            if end != None and end.start() > stop + 2 and text[end.start()] == '>':
+                return end.start() + 1
+        # any '<' before the stop shares the same (failing) tail
+        self._no_angle_url_until = stop
+        return -1
+
+def _escape_all(text, ignore_links):
+    scanner = _Scanner(text)
+    trigger_regex = _TRIGGER_WITH_LINKS_REGEX if ignore_links else _TRIGGER_REGEX
+    pieces = []
+    done = 0
+    quote = _QUOTE_REGEX.match(text)
+    if quote != None:
+        pieces.append('\\' + quote.group())
+        done = quote.end()
+    trigger = trigger_regex.search(text, done)
+    while trigger != None:
+        pos = trigger.start()
+        char = text[pos]
+        if char in _MARKDOWN_CHARS:
+            pieces.append(text[done:pos])
+            pieces.append('\\' + char)
+            done = pos + 1
+        elif char == '[':
+            end = scanner.markdown_link_end(pos)
+            if end != -1:
+                pieces.append(text[done:pos])
+                pieces.append('\\' + text[pos:end])
+                done = end
+        else:
+            if char == '<':
+                end = scanner.angle_url_end(pos)
+            else:
+                url = _URL_REGEX.match(text, pos)
+                end = url.end() if url != None else -1
+            if end != -1:
+                # URLs are copied untouched
+                pieces.append(text[done:end])
+                done = end
+        # resume after whatever we just consumed
+        trigger = trigger_regex.search(text, max(done, pos + 1))
+    pieces.append(text[done:])
+    return ''.join(pieces)
+
+def _last_unrepeated(text, char):
+    """The last position of ``char`` that doesn't directly follow another ``char``."""
+    pos = text.rfind(char)
+    while pos > 0 and text[pos - 1] == char:
+        pos = text.rfind(char, 0, pos)
+    return pos
+
+def _escape_as_needed(text):
+    text = text.replace('\\', '\\\\')
+    scanner = _Scanner(text)
+    # A character only needs escaping if it can pair with a later one, which
+    # is the case when it comes before that character's last unrepeated use.
+    last = {char: _last_unrepeated(text, char) for char in _AS_NEEDED_CHARS}
+    pieces = []
+    done = 0
+    quote = _QUOTE_REGEX.match(text)
+    if quote != None:
+        pieces.append('\\' + quote.group())
+        done = quote.end()
+    trigger = _AS_NEEDED_TRIGGER_REGEX.search(text, done)
+    while trigger != None:
+        pos = trigger.start()
+        char = text[pos]
+        if char == '[':
+            end = scanner.markdown_link_end(pos)
+        else:
+            end = pos + 1 if last[char] > pos else -1
+        if end != -1:
+            pieces.append(text[done:pos])
+            pieces.append('\\' + text[pos:end])
+            done = end
+        trigger = _AS_NEEDED_TRIGGER_REGEX.search(text, max(done, pos + 1))
+    pieces.append(text[done:])
+    return ''.join(pieces)
+
+def escape_markdown(text, *, as_needed=False, ignore_links=True):
+    """A helper function that escapes Discord's/Slack's markdown.
+
+    Parameters
+    -----------
+    text: :class:`str`
+        The text to escape markdown from.
+    as_needed: :class:`bool`
+        Whether to escape the markdown characters as needed. This
+        means that it does not escape extraneous characters if it's
+        not necessary, e.g. ``**hello**`` is escaped into ``\\*\\*hello**``
+        instead of ``\\*\\*hello\\*\\*``. Note however that this can open
+        you up to some clever syntax abuse. Defaults to ``False``.
+    ignore_links: :class:`bool`
+        Whether to leave links alone when escaping markdown. For example,
+        if a URL in the text contains characters such as ``_`` then it will
+        be left alone. This option is not supported with ``as_needed``.
+        Defaults to ``True``.
+
+    Returns
+    --------
+    :class:`str`
+        The text with the markdown special characters escaped with a slash.
+    """
+    if as_needed:
+        return _escape_as_needed(text)
+    return _escape_all(text, ignore_links)
+
+# blocks are Slack's way of formatting messages.  For a reference, see
+# https://app.slack.com/block-kit-builder/
+#
+# The blocks below never change, so every message shares the same objects.
+# Nothing may modify them after they're built.
+_DIVIDER = {"type": "divider"}
+# results from the local index, when Vectara didn't answer (see local_index.py)
+_DEGRADED_NOTE = {"type": "context", "elements": [
+    {"type": "mrkdwn", "text": "Search is slow right now, these are keyword matches only"}]}
+_HEADER = {"type": "header", "text": {"type": "plain_text", "text": "Search Results"}}
+_USER_CHANNEL_FILTER_BLOCKS = (
+    _DIVIDER,
+    {
+        "type": "section",
+        "text": { "type": "mrkdwn", "text": "User and Channel Filters:" }
+    },
+    {
+        "type": "actions",
+        "elements": [
+            {
+                "type": "users_select",
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": "Filter by user",
+                    "emoji": True
+                },
+                "action_id": "filter_by_user"
+            },
+            {
+                "type": "channels_select",
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": "Filter by channel",
+                    "emoji": True
+                },
+                "action_id": "filter_by_channel"
+            }
+        ]
+    },
+    {
+        "type": "section",
+        "text": { "type": "mrkdwn", "text": "Minimum and Maximum Post Time Filters:" }
+    }
+)
+
+@lru_cache(maxsize=2)
+def _date_filter_block(end_date):
+    """The date pickers, which only change when the default end date does."""
+    return {
+        "type": "actions",
+        "elements": [
+            {
+                "type": "datepicker",
+                "initial_date": "2022-09-01",
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": "Start Date",
+                    "emoji": True
+                },
+                "action_id": "filter_start_date"
+            },
+            {
+                "type": "datepicker",
+                "initial_date": end_date,
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": "End Date",
+                    "emoji": True
+                },
+                "action_id": "filter_end_date"
+            }
+        ]
+    }
+
+def _page_header(page):
+    if page == 0:
+        return _HEADER
+    return {"type": "header", "text": {"type": "plain_text", "text": "Search Results (Result {})".format(page + 1)}}
+
+def _result_metadata(response, document, name):
+    """A result's metadata value, from its section if it has one there.
+
+    Aggregated documents (see aggregation.py) keep each message's poster,
+    link and timestamp on its section, single messages on the document.
+    """
+    for metadata in (response.get('metadata') or (), document['metadata']):
+        for item in metadata:
+            if item['name'] == name:
+                return item['value']
+    return "Unknown"
+
+def render_search_results(search_results, search_text, page = 0, rerank = False,
+                          start_date = None, end_date = None, filter_by_user = None,
+                          filter_by_channel = None):
+    """Turns a Vectara search response into the arguments for ``say``."""
+    filtered = any(x is not None for x in [filter_by_channel, filter_by_user, start_date, end_date])
+    _, result_index = search_window(page, rerank)
+
+    if not (len(search_results['responseSet']) > 0 and len(search_results['responseSet'][0]['response']) > result_index):
+        metrics.count_empty_result()
+        return {"text": "Sorry, I couldn't find any relevant results"}
+
+    response_set = search_results['responseSet'][0]
+    response = response_set['response'][result_index]
+    document = response_set['document'][response['documentIndex']]
+    with metrics.stage("escape"):
+        text = escape_markdown(response['text'])
+
+    # Grab the metadata from Vectara's response
+    link_meta = _result_metadata(response, document, 'message_link')
+    poster = _result_metadata(response, document, 'poster')
+    timestamp = _result_metadata(response, document, 'timestamp')
+
+    blocks = []
+    # Only add the filters if the user hasn't already used one of them.
+    # This is an arbitrary limitation that just simplifies some logic and can
+    # be removed in the future
+    if not filtered or page != 0:
+        blocks.append(_page_header(page))
+    blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": "Search results for: *{}*".format(search_text)}})
+    if search_results.get('degraded'):
+        blocks.append(_DEGRADED_NOTE)
+    blocks.append(_DIVIDER)
+    blocks.append({"type": "section", "fields": [{"type": "mrkdwn", "text": "<@{}> said:\n> {}".format(poster, text)}]})
+    blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": "<{}|Link>".format(link_meta)}})
+
+    # Offer the next page unless we know this was the last result: the last
+    # of a reranked set, unless a wider one could have more (see
+    # rerank_planner.py).  The button carries a cursor with the query and
+    # filters, so the handler doesn't need to reconstruct them from this message.
+    more_candidates = (search_results.get('rerank_decision') or {}).get('more')
+    if not rerank or len(response_set['response']) > result_index + 1 or more_candidates:
+        cursor = encode_cursor(search_text, page + 1,
+                               filter_by_user=filter_by_user,
+                               filter_by_channel=filter_by_channel,
+                               start_date=start_date, end_date=end_date)
+        blocks.append({"type": "actions", "elements": [{
+            "type": "button",
+            "text": {"type": "plain_text", "text": "More results"},
+            "value": cursor,
+            "action_id": "more_results"
+        }]})
+
+    if not filtered:
+        blocks.extend(_USER_CHANNEL_FILTER_BLOCKS)
+        blocks.append(_date_filter_block((datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')))
+    return {
+        "blocks": blocks,
+        "text": "@{} said:\n> {}\n\n at {}".format(poster, text, timestamp),
+        "unfurl_links": False,
+        "unfurl_media": False
+    }
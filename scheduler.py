@@ -0,0 +1,267 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+
+# Priority classes, most urgent first
+INTERACTIVE = 0
+ACTION = 1
+INDEXING = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", ACTION: "action", INDEXING: "indexing"}
+
+# Endpoint names
+VECTARA_QUERY = "vectara:/v1/query"
+VECTARA_INDEX = "vectara:/v1/index"
+SLACK_POST_MESSAGE = "slack:chat.postMessage"
+SLACK_UPDATE_MESSAGE = "slack:chat.update"
+SLACK_RESPONSE_URL = "slack:response_url"
+SLACK_VIEWS_PUBLISH = "slack:views.publish"
+
+_current_priority = contextvars.ContextVar('scheduler_priority', default=INTERACTIVE)
+
+@contextmanager
+def scheduled_as(priority: int):
+    """Makes outbound calls in this block (thread or task) wait as ``priority``."""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+def set_priority(priority: int):
+    """Sets the priority for the rest of the current thread or task."""
+    _current_priority.set(priority)
+
+def current_priority() -> int:
+    return _current_priority.get()
+
+def per_channel(endpoint: str, channel: str = None) -> str:
+    """Names the bucket for ``endpoint`` in one channel; it gets the endpoint's rate."""
+    if channel == None:
+        return endpoint
+    return "{}#{}".format(endpoint, channel)
+
+def retry_after_seconds(headers, default: float = 1.0) -> float:
+    """Reads a 429's Retry-After header, which Slack and Vectara send in seconds."""
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return default
+
+class _Endpoint:
+    """A token bucket plus the queue of callers waiting on it.
+
+    A per-channel bucket's ``parent`` is its endpoint's bucket, whose pauses
+    it honors as well as its own."""
+
+    def __init__(self, rate: float = None, burst: float = 1, parent: '_Endpoint' = None):
+        self.rate = rate
+        self.burst = burst
+        self.parent = parent
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiters = []
+        self.throttled = 0
+
+    def time_until_token(self, now: float) -> float:
+        paused_until = self.paused_until
+        if self.parent != None:
+            paused_until = max(paused_until, self.parent.paused_until)
+        if now < paused_until:
+            return paused_until - now
+        if self.rate == None:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate != None:
+            self.tokens -= 1
+
+class Scheduler:
+    """Coordinates outbound Vectara and Slack calls.
+
+    Every endpoint has a token bucket (``rates`` maps it to ``(calls per
+    second, burst)``; unlisted endpoints are unlimited).  Per-channel
+    endpoints, see ``per_channel``, each get a bucket of their own.  Callers waiting on
+    the same endpoint are served by priority class and then in arrival
+    order, so a burst of indexing can't hold up searches.  ``backoff`` pauses
+    an endpoint, and all its per-channel buckets, after a 429 for as long as
+    its Retry-After asks.
+    """
+
+    def __init__(self, rates: dict = None):
+        if rates == None:
+            # with several worker processes (see workers.py) each gets its share
+            workers = int(os.environ.get('SLACKBOT_WORKERS') or 1)
+            rates = {
+                VECTARA_QUERY: (float(os.environ.get('VECTARA_QUERY_RATE', 20)) / workers, max(1, 20 // workers)),
+                VECTARA_INDEX: (float(os.environ.get('VECTARA_INDEX_RATE', 10)) / workers, max(1, 10 // workers)),
+                # Slack allows about one message per second per channel
+                SLACK_POST_MESSAGE: (float(os.environ.get('SLACK_POST_RATE', 1)) / workers, max(1, 5 // workers)),
+                # chat.update is Tier 3, about 50 a minute for the whole workspace
+                SLACK_UPDATE_MESSAGE: (float(os.environ.get('SLACK_UPDATE_RATE', 0.8)) / workers, max(1, 5 // workers)),
+                # views.publish is Tier 4, about 100 a minute
+                SLACK_VIEWS_PUBLISH: (float(os.environ.get('SLACK_VIEWS_RATE', 1.5)) / workers, max(1, 10 // workers)),
+            }
+        self._rates = rates
+        self._cond = threading.Condition()
+        self._endpoints = {}
+        self._sequence = itertools.count()
+        self._waits = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}
+
+    def _endpoint(self, endpoint: str) -> _Endpoint:
+        state = self._endpoints.get(endpoint)
+        if state == None:
+            base, _, channel = endpoint.partition('#')
+            rate, burst = self._rates.get(base, (None, 1))
+            # a 429 is reported against the endpoint, and holds every channel's bucket
+            parent = self._endpoint(base) if channel else None
+            state = self._endpoints[endpoint] = _Endpoint(rate, burst, parent)
+        return state
+
+    def _enqueue(self, endpoint: str, priority: int):
+        state = self._endpoint(endpoint)
+        ticket = (priority, next(self._sequence))
+        heapq.heappush(state.waiters, ticket)
+        return state, ticket
+
+    def _try_grant(self, state: _Endpoint, ticket) -> float:
+        """Grants ``ticket`` a call if it's next in line, otherwise returns how long to wait.
+
+        Returns None when somebody else is ahead of it."""
+        if state.waiters[0] != ticket:
+            return None
+        wait = state.time_until_token(time.monotonic())
+        if wait > 0:
+            return wait
+        state.take()
+        heapq.heappop(state.waiters)
+        # let the next in line check the bucket
+        self._cond.notify_all()
+        return 0.0
+
+    def _record_wait(self, priority: int, waited: float):
+        stats = self._waits[priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    def acquire(self, endpoint: str, priority: int = None):
+        """Blocks until ``endpoint`` may be called, returning the seconds waited."""
+        if priority == None:
+            priority = current_priority()
+        start = time.monotonic()
+        with self._cond:
+            state, ticket = self._enqueue(endpoint, priority)
+            while True:
+                wait = self._try_grant(state, ticket)
+                if wait == 0.0:
+                    break
+                self._cond.wait(wait)
+            waited = time.monotonic() - start
+            self._record_wait(priority, waited)
+        return waited
+
+    async def acquire_async(self, endpoint: str, priority: int = None):
+        """The asyncio version of ``acquire``."""
+        if priority == None:
+            priority = current_priority()
+        start = time.monotonic()
+        with self._cond:
+            state, ticket = self._enqueue(endpoint, priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_grant(state, ticket)
+                if wait == 0.0:
+                    break
+                # poll, since a thread's notify can't wake a coroutine
+                await asyncio.sleep(wait if wait != None else 0.005)
+        except BaseException:
+            with self._cond:
+                if ticket in state.waiters:
+                    state.waiters.remove(ticket)
+                    heapq.heapify(state.waiters)
+                    self._cond.notify_all()
+            raise
+        waited = time.monotonic() - start
+        with self._cond:
+            self._record_wait(priority, waited)
+        return waited
+
+    def backoff(self, endpoint: str, retry_after: float):
+        """Holds every call to ``endpoint`` for ``retry_after`` seconds."""
+        logging.warning("%s is rate limited, pausing it for %.1fs", endpoint, retry_after)
+        with self._cond:
+            state = self._endpoint(endpoint)
+            state.paused_until = max(state.paused_until, time.monotonic() + retry_after)
+            state.throttled += 1
+            self._cond.notify_all()
+
+    def call(self, endpoint: str, function, *args, **kwargs):
+        """Waits for ``endpoint`` and then calls ``function``."""
+        self.acquire(endpoint)
+        return function(*args, **kwargs)
+
+    async def call_async(self, endpoint: str, function, *args, **kwargs):
+        """Waits for ``endpoint`` and then awaits ``function``."""
+        await self.acquire_async(endpoint)
+        return await function(*args, **kwargs)
+
+    def stats(self) -> dict:
+        """Reports the time each priority class spent waiting, and 429s per endpoint."""
+        with self._cond:
+            waits = {
+                PRIORITY_NAMES[priority]: {
+                    "calls": calls,
+                    "total_wait": total,
+                    "avg_wait": total / calls if calls else 0.0,
+                    "max_wait": longest,
+                }
+                for priority, (calls, total, longest) in self._waits.items()
+            }
+            throttled = {name: state.throttled for name, state in self._endpoints.items() if state.throttled}
+        return {"waits": waits, "throttled": throttled}
+
+scheduler = Scheduler()
+
+def slack_endpoint(url: str) -> str:
+    """Names the scheduler endpoint for a Slack Web API or response_url request."""
+    if '/api/' in url:
+        return "slack:" + url.rsplit('/api/', 1)[1].split('?', 1)[0]
+    return SLACK_RESPONSE_URL
+
+def _slack_retry_after(headers) -> float:
+    # slack_sdk hands us every header as a list of values
+    for name, values in headers.items():
+        if name.lower() == 'retry-after':
+            return retry_after_seconds({'Retry-After': values[0] if isinstance(values, list) else values})
+    return 1.0
+
+class SchedulerRateLimitRetryHandler(RateLimitErrorRetryHandler):
+    """Retries Slack 429s, first pausing the endpoint so queued calls wait too."""
+
+    def prepare_for_next_attempt(self, *, state, request, response=None, error=None):
+        if response is not None:
+            scheduler.backoff(slack_endpoint(request.url), _slack_retry_after(response.headers))
+        super().prepare_for_next_attempt(state=state, request=request, response=response, error=error)
+
+class AsyncSchedulerRateLimitRetryHandler(AsyncRateLimitErrorRetryHandler):
+    """The asyncio version of ``SchedulerRateLimitRetryHandler``."""
+
+    async def prepare_for_next_attempt_async(self, *, state, request, response=None, error=None):
+        if response is not None:
+            scheduler.backoff(slack_endpoint(request.url), _slack_retry_after(response.headers))
+        await super().prepare_for_next_attempt_async(state=state, request=request, response=response, error=error)
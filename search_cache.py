@@ -0,0 +1,118 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_WHITESPACE_REGEX = re.compile(r'\s+')
+
+def normalize_query(search_text: str) -> str:
+    """Folds case, whitespace and trailing punctuation so repeats share a cache entry."""
+    return _WHITESPACE_REGEX.sub(' ', search_text or '').strip().rstrip('?.!').strip().casefold()
+
+class SearchCache:
+    """An in-process LRU cache of Vectara search results with a TTL.
+
+    Entries are bounded both by count and by the approximate size of their
+    JSON.  Each entry can carry tags (the channel filter it was searched
+    with) so that indexing a new message into a channel drops the cached
+    results that were filtered to it.
+    """
+
+    def __init__(self, ttl: float = None, max_entries: int = None, max_bytes: int = None):
+        if ttl == None:
+            ttl = float(os.environ.get('VECTARA_SEARCH_CACHE_TTL', 300))
+        if max_entries == None:
+            max_entries = int(os.environ.get('VECTARA_SEARCH_CACHE_MAX_ENTRIES', 1000))
+        if max_bytes == None:
+            max_bytes = int(os.environ.get('VECTARA_SEARCH_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (expires_at, size, tags, value), oldest first
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    @staticmethod
+    def make_key(search_text: str, filters: list, rerank: bool, start: int = 0):
+        return (normalize_query(search_text), tuple(sorted(filters or [])), bool(rerank), start)
+
+    def get(self, key):
+        """Returns the cached value for ``key``, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry == None or entry[0] < time.monotonic():
+                if entry != None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3]
+
+    def put(self, key, value, tags=()):
+        if not self.enabled:
+            return
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            tags = tuple(t for t in tags if t != None)
+            self._entries[key] = (time.monotonic() + self.ttl, size, tags, value)
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, tags, _ = self._entries.pop(key)
+        self._bytes -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys != None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate_tag(self, tag):
+        """Drops every entry cached with ``tag``, e.g. a channel that just got a new message."""
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
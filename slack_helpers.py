@@ -1,4 +1,6 @@
-import re
+import json
+import os
+from datetime import datetime
 
 def homepage_blocks():
     return ([
@@ -23,7 +25,7 @@ def homepage_blocks():
             "type": "section",
             "text": {
               "type": "mrkdwn",
-              "text": "The slackbot doesn't attempt to index any message history prior to it joining: it will only index Slack messages sent after the bot is in the channel"
+              "text": "The slackbot only indexes Slack messages sent after the bot is in the channel, unless your Slack admin backfills the channel's history"
             }
           },
           {
@@ -38,50 +40,155 @@ def homepage_blocks():
           }
         ])
 
-def escape_markdown(text, *, as_needed=False, ignore_links=True):
-    """A helper function that escapes Discord's/Slack's markdown.
-
-    Parameters
-    -----------
-    text: :class:`str`
-        The text to escape markdown from.
-    as_needed: :class:`bool`
-        Whether to escape the markdown characters as needed. This
-        means that it does not escape extraneous characters if it's
-        not necessary, e.g. ``**hello**`` is escaped into ``\*\*hello**``
-        instead of ``\*\*hello\*\*``. Note however that this can open
-        you up to some clever syntax abuse. Defaults to ``False``.
-    ignore_links: :class:`bool`
-        Whether to leave links alone when escaping markdown. For example,
-        if a URL in the text contains characters such as ``_`` then it will
-        be left alone. This option is not supported with ``as_needed``.
-        Defaults to ``True``.
-
-    Returns
-    --------
-    :class:`str`
-        The text with the markdown special characters escaped with a slash.
+def get_channel_filter(channel):
+    return 'doc.channel = \'{}\''.format(channel)
+
+def _message_metadata_level():
+    """Where a message's poster and timestamp live: its document, or its
+    section of an aggregated document (see aggregation.py)."""
+    return 'part' if os.environ.get('VECTARA_AGGREGATE') else 'doc'
+
+def get_user_filter(user):
+    return '{}.poster = \'{}\''.format(_message_metadata_level(), user)
+
+def get_start_date_filter(date):
+    utc_time = datetime.strptime(date, "%Y-%m-%d")
+    epoch_time = (utc_time - datetime(1970, 1, 1)).total_seconds()
+    return '{}.timestamp >= {}'.format(_message_metadata_level(), epoch_time)
+
+def get_end_date_filter(date):
+    utc_time = datetime.strptime(date, "%Y-%m-%d")
+    epoch_time = (utc_time - datetime(1970, 1, 1)).total_seconds()
+    return '{}.timestamp <= {}'.format(_message_metadata_level(), epoch_time)
+
+def extract_filters_from_state(state):
+    filter_values = {}
+    if state != None:
+        for block in state['values']:
+            filters = state['values'][block]
+            for filter in filters:
+                if filter == 'filter_by_channel' and state['values'][block][filter]['selected_channel'] != None:
+                    filter_values['channel'] = get_channel_filter(state['values'][block][filter]['selected_channel'])
+                elif filter == 'filter_by_user' and state['values'][block][filter]['selected_user'] != None:
+                    filter_values['user'] = get_user_filter(state['values'][block][filter]['selected_user'])
+                elif filter == 'filter_start_date':
+                    filter_values['start_date'] = get_start_date_filter(state['values'][block][filter]['selected_date'])
+                elif filter == 'filter_end_date':
+                    filter_values['end_date'] = get_end_date_filter(state['values'][block][filter]['selected_date'])
+    return filter_values
+
+# Slack limits a button's value to 2000 characters
+MAX_CURSOR_LENGTH = 2000
+
+def encode_cursor(search_text, page, filter_by_user = None, filter_by_channel = None,
+                  start_date = None, end_date = None):
+    """Encodes everything needed to fetch a page of results into a button value.
+
+    If the query is too long to fit, it is left out and the handler falls back
+    to reading it from the result message.
+    """
+    cursor = {"p": page, "u": filter_by_user, "c": filter_by_channel,
+              "s": start_date, "e": end_date, "q": search_text}
+    value = json.dumps(cursor)
+    if len(value) > MAX_CURSOR_LENGTH:
+        del cursor["q"]
+        value = json.dumps(cursor)
+    return value
+
+def decode_cursor(value):
+    return json.loads(value)
+
+def get_original_query_text(message):
+    """Extracts the original query text by looking up"""
+    # TODO: create a better way to grab the original query text
+    for b in message['blocks']:
+        if 'text' in b and 'text' in b['text'] and b['text']['text'].startswith('Search results for:'):
+            original_text = b['text']['text'].replace('Search results for: ','')
+            original_text = original_text.strip('*')
+            return original_text
+    return None
+
+def parse_search_command(text):
+    """Splits ``/vectara`` text into the query and an optional user or channel filter.
+
+    Returns a ``(search_text, user_filter, channel_filter)`` tuple.
+    """
+    channel = None
+    user = None
+    parts = text.split(' ', 1)
+    if parts[0].startswith('<'):
+        channel_or_user = parts[0]
+        channel_or_user_parts = channel_or_user.split('|')
+        channel_or_user_id = channel_or_user_parts[0]
+        # channel is e.g. <#C03V4NCQJK2|foo-bar>.  can also be a person if it starts with @ e.g. <@C03V4NCQJK2|shane>
+        if channel_or_user_id.startswith('<@'):
+            user = get_user_filter(channel_or_user_id[2:])
+        elif channel_or_user_id.startswith('<#'):
+            channel = get_channel_filter(channel_or_user_id[2:])
+        text = parts[1]
+    return text, user, channel
+
+def document_id(message):
+    """The Vectara document id of a message event.
+
+    That's its ``client_msg_id``, or, for messages that don't have one, its
+    channel and timestamp.
     """
+    return message.get('client_msg_id') or '{}-{}'.format(message['channel'], message['ts'])
+
+def edited_message(event):
+    """The new version of the message in a ``message_changed`` event, as a message event."""
+    message = event['message']
+    return dict(message, type='message', channel=event['channel'],
+                channel_type=event.get('channel_type'), event_ts=message['ts'])
 
-    # constants
-    _MARKDOWN_ESCAPE_SUBREGEX = '|'.join(r'\{0}(?=([\s\S]*((?<!\{0})\{0})))'.format(c)
-                                                for c in ('*', '`', '_', '~', '|'))
-    _MARKDOWN_ESCAPE_COMMON = r'^>(?:>>)?\s|\[.+\]\(.+\)'
-    _MARKDOWN_ESCAPE_REGEX = re.compile(r'(?P<markdown>%s|%s)' % (_MARKDOWN_ESCAPE_SUBREGEX, _MARKDOWN_ESCAPE_COMMON))
-
-    if not as_needed:
-        url_regex = r'(?P<url><[^: >]+:\/[^ >]+>|(?:https?|steam):\/\/[^\s<]+[^<.,:;\"\'\]\s])'
-        def replacement(match):
-            groupdict = match.groupdict()
-            is_url = groupdict.get('url')
-            if is_url:
-                return is_url
-            return '\\' + groupdict['markdown']
-
-        regex = r'(?P<markdown>[_\\~|\*`]|%s)' % _MARKDOWN_ESCAPE_COMMON
-        if ignore_links:
-            regex = '(?:%s|%s)' % (url_regex, regex)
-        return re.sub(regex, replacement, text)
-    else:
-        text = re.sub(r'\\', r'\\\\', text)
-        return _MARKDOWN_ESCAPE_REGEX.sub(r'\\\1', text) 
\ No newline at end of file
+def delete_request_for_message(message):
+    """Builds the ``delete_document`` arguments for a message event."""
+    return {
+        "customer_id": int(os.environ.get('VECTARA_CUSTOMER_ID')),
+        "corpus_id": int(os.environ.get('VECTARA_CORPUS_ID')),
+        "id": document_id(message)
+    }
+
+def delete_request_for_event(event):
+    """Builds the ``delete_document`` arguments for a ``message_deleted`` event."""
+    previous = dict(event.get('previous_message') or {},
+                    channel=event['channel'], ts=event['deleted_ts'])
+    return delete_request_for_message(previous)
+
+def index_request_for_message(message):
+    """Builds the ``index_message`` arguments for a Slack message event."""
+    epoch_us = int(float(message['event_ts']) * 10000000)
+    link = 'https://{}.slack.com/archives/{}/p{}'.format(
+        os.environ.get('SLACK_WORKSPACE_SUBDOMAIN'),
+        message['channel'],
+        epoch_us
+    )
+    metadata = {
+        "message_link": link,
+        "message_type": message['type'],
+        "poster": message['user'],
+        "channel": message['channel'],
+        "channel_type": message['channel_type'],
+        "timestamp": float(message['event_ts'])
+    }
+    if message.get('thread_ts') not in (None, message['ts']):
+        metadata["thread_ts"] = message['thread_ts']
+    return {
+        "customer_id": int(os.environ.get('VECTARA_CUSTOMER_ID')),
+        "corpus_id": int(os.environ.get('VECTARA_CORPUS_ID')),
+        "text": message['text'],
+        "id": document_id(message),
+        "title": "Message from <@{}> at {}".format(message['user'], message['event_ts']),
+        "metadata": metadata
+    }
+
+def search_window(page, rerank):
+    """Returns the ``start`` offset to search from and which result of it is ``page``.
+
+    Reranked searches always fetch the same candidate set, so their pages are
+    picked out of it.  Unreranked searches fetch the one result at ``page``.
+    """
+    if rerank:
+        return 0, page
+    return page, 0
@@ -1,69 +1,144 @@
-import json
+import atexit
 import logging
 import os
-from datetime import datetime, timedelta
-from slack_bolt import App
+import signal
+import sys
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from slack_bolt import App, BoltResponse
 from slack_bolt.adapter.socket_mode import SocketModeHandler
-from vectara_functions import get_metadata_value, index_message, search, search_raw
-from slack_helpers import homepage_blocks, escape_markdown
-
-app = App(token=os.environ.get('SLACK_BOT_TOKEN'))
-
-def get_channel_filter(channel):
-  return 'doc.channel = \'{}\''.format(channel)
-
-def get_user_filter(user):
-  return 'doc.poster = \'{}\''.format(user)
-
-def get_start_date_filter(date):
-  utc_time = datetime.strptime(date, "%Y-%m-%d")
-  epoch_time = (utc_time - datetime(1970, 1, 1)).total_seconds()
-  return 'doc.timestamp >= {}'.format(epoch_time)
-
-def get_end_date_filter(date):
-  utc_time = datetime.strptime(date, "%Y-%m-%d")
-  epoch_time = (utc_time - datetime(1970, 1, 1)).total_seconds()
-  return 'doc.timestamp <= {}'.format(epoch_time)
-
-def extract_filters_from_state(state):
-  filter_values = []
-  if state != None:
-      for block in state['values']:
-        filters = state['values'][block]
-        for filter in filters:
-          if filter == 'filter_by_channel' and state['values'][block][filter]['selected_channel'] != None:
-            filter_values['channel'] = get_channel_filter(state['values'][block][filter]['selected_channel'])
-          elif filter == 'filter_by_user' and state['values'][block][filter]['selected_user'] != None:
-            filter_values['user'] = get_user_filter(state['values'][block][filter]['selected_user'])
-          elif filter == 'filter_start_date':
-            filter_values['start_date'] = get_start_date_filter(state['values'][block][filter]['selected_date'])
-          elif filter == 'filter_end_date':
-            filter_values['end_date'] = get_end_date_filter(state['values'][block][filter]['selected_date'])
-  return filter_values
-
-def get_original_query_text(message):
-  """Extracts the original query text by looking up"""
-  # TODO: create a better way to grab the original query text
-  for b in message['blocks']:
-    if 'text' in b and 'text' in b['text'] and b['text']['text'].startswith('Search results for:'):
-      original_text = b['text']['text'].replace('Search results for: ','')
-      original_text = original_text.strip('*')
-      return original_text
-  return None
-
-def standard_query_and_filter(ack, body, say, logger, extract_filters_from_state = True):
+from slack_sdk import WebClient
+from vectara_functions import search, in_background, reranker, token_manager
+from slack_helpers import (get_channel_filter,
+                           extract_filters_from_state, decode_cursor,
+                           get_original_query_text, parse_search_command,
+                           index_request_for_message, edited_message,
+                           delete_request_for_event, delete_request_for_message,
+                           search_window)
+from result_renderer import render_search_results
+from progressive_reply import ProgressiveReply
+from indexing_pipeline import IndexingPipeline, EditDebouncer, DELETE
+from aggregation import MessageAggregator, aggregation_enabled
+from index_journal import IndexJournal
+from search_cache import SearchCache
+from event_dedup import EventDeduplicator, event_key
+from content_filter import ContentFilter, BOT, SUBTYPE
+from local_index import open_local_index, exact_token_query, blend_results, page_of
+from rerank_planner import extend_pool
+from home_view import HomeView
+import metrics
+from scheduler import (scheduler, scheduled_as, per_channel, INTERACTIVE, ACTION,
+                       SLACK_POST_MESSAGE, SLACK_RESPONSE_URL, SLACK_VIEWS_PUBLISH,
+                       SchedulerRateLimitRetryHandler)
+
+if os.environ.get('SLACK_API_URL'):
+  # a stand-in for Slack, see benchmarks/fake_servers.py
+  app = App(client=WebClient(token=os.environ.get('SLACK_BOT_TOKEN'),
+                             base_url=os.environ.get('SLACK_API_URL')))
+else:
+  app = App(token=os.environ.get('SLACK_BOT_TOKEN'))
+# 429s from Slack pause that API method for every handler, not just the caller
+app.client.retry_handlers.append(SchedulerRateLimitRetryHandler())
+search_cache = SearchCache()
+# With SLACKBOT_PROGRESSIVE=true a search posts a placeholder at once, then
+# the top unreranked hit, then the reranked results in place of it, and gives
+# up after VECTARA_QUERY_DEADLINE seconds
+progressive = os.environ.get('SLACKBOT_PROGRESSIVE') == 'true'
+query_deadline = float(os.environ.get('VECTARA_QUERY_DEADLINE', 10))
+# other searches only get that deadline, which also hedges them (see
+# hedging.py), when VECTARA_QUERY_DEADLINE or VECTARA_HEDGE_DELAY is set
+search_timeout = None
+if os.environ.get('VECTARA_QUERY_DEADLINE') or os.environ.get('VECTARA_HEDGE_DELAY'):
+  search_timeout = query_deadline
+# indexed messages are also kept in a local full-text index, for exact-token
+# searches and for when Vectara is slow, see local_index.py; set
+# LOCAL_INDEX_PATH to an empty string to turn this off
+local_index = open_local_index()
+# bot posts, "ok"s and repeats of recent messages aren't indexed, see
+# content_filter.py
+content_filter = ContentFilter()
+
+def corpus_stats():
+  """What the App Home says about the corpus, see home_view.py."""
+  if local_index == None:
+    return None
+  return {"Messages indexed in the last {:g} days".format(local_index.max_age_days):
+          "{:,}".format(local_index.stats()['messages'])}
+
+# the App Home view is built once and only published to users who don't
+# have it yet, see home_view.py
+home_view = HomeView(corpus_stats)
+
+# messages are journaled to disk until Vectara accepts them; set
+# VECTARA_JOURNAL_PATH to an empty string to turn this off
+journal_path = os.environ.get('VECTARA_JOURNAL_PATH', 'index_journal.sqlite3')
+
+def invalidate_cached_results(request):
+  """Drops the cached results a message Vectara just indexed or deleted could change."""
+  if request.get('action') == DELETE:
+    # a deleted message could be in any result, and must stop showing up
+    search_cache.clear()
+  else:
+    # results filtered to a channel are stale once it has a new message
+    search_cache.invalidate_tag(get_channel_filter(request['metadata']['channel']))
+
+indexer = IndexingPipeline(
+  journal=IndexJournal(journal_path) if journal_path else None,
+  on_indexed=invalidate_cached_results)
+# with VECTARA_AGGREGATE set, messages are indexed in groups, see aggregation.py
+aggregator = MessageAggregator(indexer.submit) if aggregation_enabled() else None
+submit_message = aggregator.submit if aggregator != None else indexer.submit
+# a burst of edits to a message, or a deletion, is sent to Vectara once,
+# VECTARA_EDIT_DEBOUNCE seconds after the first
+edits = EditDebouncer(submit_message)
+# Slack retries events, and with several workers (see workers.py) the same
+# event can reach more than one, so requests are claimed in a store all
+# workers share; set SLACKBOT_DEDUP_PATH to an empty string to turn this off
+dedup_path = os.environ.get('SLACKBOT_DEDUP_PATH', 'events.sqlite3')
+deduplicator = EventDeduplicator(dedup_path) if dedup_path else None
+
+def skip_duplicates(body, next, logger):
+  """Acks requests another worker, or an earlier delivery, already claimed."""
+  key = event_key(body)
+  if key != None and not deduplicator.claim(key):
+    logger.info("Skipping %s, it was already handled", key)
+    return BoltResponse(status=200, body="")
+  try:
+    return next()
+  except Exception:
+    if key != None:
+      deduplicator.release(key)
+    raise
+
+def release_failed_claim(error, body, logger):
+  """Logs a listener's error, and releases its request's claim so a retry is handled.
+
+  Listeners run after the middleware has returned, so ``skip_duplicates``
+  doesn't see their errors.
+  """
+  logger.error("Failed to run listener function (error: %s)", error, exc_info=error)
+  key = event_key(body)
+  if key != None:
+    deduplicator.release(key)
+
+if deduplicator != None:
+  app.middleware(skip_duplicates)
+  app.error(release_failed_claim)
+
+def standard_query_and_filter(ack, body, say, logger, use_filter_state = True):
   """Helper function for most of the filters.
   - Extracts the filter state
   - Pulls the original query text
   - Performs the search
   - Responds to the user
   """
-  ack()
+  with metrics.stage("ack"):
+    ack()
   user = None
   channel = None
   start_date = None
   end_date = None
-  if extract_filters_from_state:
+  if use_filter_state:
     filters = extract_filters_from_state(body['state'])
     user = filters['user'] if 'user' in filters else None
     channel = filters['channel'] if 'channel' in filters else None
@@ -71,74 +146,73 @@ def standard_query_and_filter(ack, body, say, logger, extract_filters_from_state
     end_date = filters['end_date'] if 'end_date' in filters else None
 
   original_search = get_original_query_text(body['message'])
-  query_and_respond(say, original_search,
-                    start_date=start_date, end_date=end_date,
-                    filter_by_user=user, filter_by_channel=channel)
+  with scheduled_as(ACTION):
+    query_and_respond(say, original_search,
+                      start_date=start_date, end_date=end_date,
+                      filter_by_user=user, filter_by_channel=channel)
 
 @app.action("filter_by_channel")
+@metrics.timed("filter_by_channel")
 def filter_by_channel(ack, body, say, logger):
   """Triggered when a user asks for the results to be filtered to a specific channel."""
   standard_query_and_filter(ack, body, say, logger)
 
 @app.action("filter_by_user")
+@metrics.timed("filter_by_user")
 def filter_by_user(ack, body, say, logger):
   """Triggered when a user asks for the results to be filtered to a specific user."""
   standard_query_and_filter(ack, body, say, logger)
 
 @app.action("filter_start_date")
+@metrics.timed("filter_by_start_date")
 def filter_by_start_date(ack, body, say, logger):
   """Triggered when a user asks for the results to be filtered >= some date."""
   standard_query_and_filter(ack, body, say, logger)
 
 @app.action("filter_end_date")
+@metrics.timed("filter_by_end_date")
 def filter_by_end_date(ack, body, say, logger):
   """Triggered when a user asks for the results to be filtered <= some date."""
   standard_query_and_filter(ack, body, say, logger)
 
 @app.action("more_results")
+@metrics.timed("more_results")
 def more_results(ack, body, say, logger):
   """Triggered when a user asks for more results."""
-  ack()
-  state = body['state']
-  original_search = get_original_query_text(body['message'])
-  query_and_respond(say, original_search, state=state, num_results = 2)
+  with metrics.stage("ack"):
+    ack()
+  cursor = decode_cursor(body['actions'][0]['value'])
+  search_text = cursor.get('q') or get_original_query_text(body['message'])
+  with scheduled_as(ACTION):
+    query_and_respond(say, search_text, page=cursor['p'],
+                      filter_by_user=cursor['u'], filter_by_channel=cursor['c'],
+                      start_date=cursor['s'], end_date=cursor['e'])
 
 @app.command("/vectara")
+@metrics.timed("command_search")
 def command_search(ack, respond, command):
-    ack()
-    text = command['text']
-    channel = None
-    user = None
-    parts = text.split(' ', 1)
-    if parts[0].startswith('<'):
-      channel_or_user = parts[0]
-      channel_or_user_parts = channel_or_user.split('|')
-      channel_or_user_id = channel_or_user_parts[0]
-      # channel is e.g. <#C03V4NCQJK2|foo-bar>.  can also be a person if it starts with @ e.g. <@C03V4NCQJK2|shane>
-      if channel_or_user_id.startswith('<@'):
-        user = get_user_filter(channel_or_user_id[2:])
-      elif channel_or_user_id.startswith('<#'):
-        channel = get_channel_filter(channel_or_user_id[2:])
-      text = parts[1]
-    query_and_respond(respond, search_text = text,
-                      filter_by_user=user, filter_by_channel=channel)
+    with metrics.stage("ack"):
+      ack()
+    text, user, channel = parse_search_command(command['text'])
+    with scheduled_as(INTERACTIVE):
+      query_and_respond(respond, search_text = text,
+                        filter_by_user=user, filter_by_channel=channel,
+                        post_endpoint=SLACK_RESPONSE_URL)
 
 @app.event('app_home_opened')
 def home(client, event, logger):
-  client.views_publish(
-      # the user that opened your app's app home
-      user_id=event["user"],
-      # the view object that appears in the app home
-      view={
-        "type": "home",
-        "callback_id": "home_view",
-
-        # body of the view
-        "blocks": homepage_blocks()
-      }
-    )
+  # the event also comes for the Messages tab, which the view isn't on
+  if event.get('tab') == 'messages':
+    return
+  publish = home_view.to_publish(event)
+  if publish == None:
+    return
+  version, view = publish
+  scheduler.call(SLACK_VIEWS_PUBLISH, client.views_publish, user_id=event["user"], view=view)
+  home_view.sent(event["user"], version)
 
 @app.event('message')
+@metrics.timed("read_message")
 def read_message(message, context, say):
   """Triggered when a message is posted.
 
@@ -148,7 +222,11 @@ def read_message(message, context, say):
   """
   bot_user_id = context['bot_user_id']
 
-  if 'text' in message:
+  if message.get('subtype') == 'message_changed':
+    update_message(message, bot_user_id)
+  elif message.get('subtype') == 'message_deleted':
+    delete_message(message)
+  elif 'text' in message:
     message_text = message['text']
     bot_user_id_reference = '<@{}>'.format(bot_user_id) #this is how a bot's mention shows up in the text
 
@@ -160,176 +238,275 @@ def read_message(message, context, say):
       if bot_user_id_reference in message_text:
         search_text = message_text.replace(bot_user_id_reference,"").strip()
         query_and_respond(say, search_text, filter_by_channel=get_channel_filter(message['channel']))
-      else:
-        #index the content
-        epoch_us = int(float(message['event_ts']) * 10000000)
-        link = 'https://{}.slack.com/archives/{}/p{}'.format(
-          os.environ.get('SLACK_WORKSPACE_SUBDOMAIN'),
-          message['channel'],
-          epoch_us
-        )
-        metadata = {
-          "message_link": link,
-          "message_type": message['type'],
-          "poster": message['user'],
-          "channel": message['channel'],
-          "channel_type": message['channel_type'],
-          "timestamp": float(message['event_ts'])
-        }
-
-        index_message(
-          customer_id=int(os.environ.get('VECTARA_CUSTOMER_ID')),
-          corpus_id=int(os.environ.get('VECTARA_CORPUS_ID')),
-          text=message_text,
-          id=message['client_msg_id'],
-          title="Message from <@{}> at {}".format(message['user'], message['event_ts']),
-          metadata=metadata
-        )
+      elif content_filter.skip_reason(message) == None:
+        # index in the background so the Bolt worker isn't held up by Vectara
+        request = index_request_for_message(message)
+        with metrics.stage("enqueue"):
+          submit_message(**request)
+        if local_index != None:
+          local_index.add(request)
   else:
     logging.error("Unhandled channel type: %s",message['channel_type'])
 
+def update_message(event, bot_user_id):
+  """Reindexes an edited channel message, once its burst of edits is over.
+
+  An edit that makes the message one content_filter skips, a repeat or an
+  "ok", takes it out of the index instead.
+  """
+  message = edited_message(event)
+  previous = event.get('previous_message') or {}
+  # Only indexed messages need updating: not DMs or searches.  Unfurling a
+  # link also "edits" a message, without changing its text.
+  if (message['channel_type'] != 'channel'
+      or message.get('text') == previous.get('text')
+      or '<@{}>'.format(bot_user_id) in message.get('text', '')):
+    return
+  id = delete_request_for_message(message)['id']
+  # its old text no longer makes a copy of it a repeat
+  content_filter.forget(id)
+  reason = content_filter.skip_reason(message)
+  if reason in (BOT, SUBTYPE):
+    # never indexed; Bolt doesn't ignore edits of bot posts, not even ours
+    return
+  if reason != None:
+    edits.add(id, dict(delete_request_for_message(message), action=DELETE))
+    if local_index != None:
+      local_index.delete(id)
+    return
+  request = index_request_for_message(message)
+  edits.add(id, dict(request, upsert=True))
+  if local_index != None:
+    local_index.add(request)
+
+def delete_message(event):
+  """Removes a deleted channel message from Vectara."""
+  if event.get('channel_type') != 'channel':
+    return
+  request = delete_request_for_event(event)
+  content_filter.forget(request['id'])
+  # replaces a pending edit, which would put the message back
+  edits.add(request['id'], dict(request, action=DELETE))
+  if local_index != None:
+    local_index.delete(request['id'])
+
 def query_and_respond(say, search_text = None, rerank = None,
                       start_date = None, end_date = None, filter_by_user = None,
-                      filter_by_channel = None, num_results = 1):
-    """
+                      filter_by_channel = None, page = 0,
+                      post_endpoint = SLACK_POST_MESSAGE):
+    """Searches Vectara and posts result number ``page`` (counting from 0).
+
+    Reranked searches fetch their whole candidate set once, and it's cached, so
+    later pages are served from the cache.  With adaptive reranking (see
+    rerank_planner.py) a page past the end of the cached candidates reranks
+    a wider set, which replaces it.  Unreranked searches ask Vectara for
+    just the one result at offset ``page``.  Both the search and ``say`` wait
+    their turn in the scheduler, ``say`` on ``post_endpoint`` in its channel.
     """
     if rerank == None and os.environ.get('VECTARA_USE_RERANKER') == 'true':
       rerank = True
     filters = [x for x in [filter_by_channel, filter_by_user, start_date, end_date] if x is not None]
-    
+
+    start, _ = search_window(page, rerank)
+    cache_key = search_cache.make_key(search_text, filters, rerank, start)
+    with metrics.stage("cache"):
+      search_results = search_cache.get(cache_key)
+    previous_results = None
+    rerank_plan = None
+    if rerank and reranker != None:
+      rerank_plan = reranker.plan(page, search_results)
+      if rerank_plan != None:
+        previous_results, search_results = search_results, None
+    if search_results is None:
+      if progressive and page == 0:
+        progressive_query_and_respond(say, search_text, rerank, start_date=start_date,
+                                      end_date=end_date, filter_by_user=filter_by_user,
+                                      filter_by_channel=filter_by_channel,
+                                      post_endpoint=post_endpoint)
+        return
+      with metrics.stage("search"):
+        search_results = search_and_cache(search_text, rerank, filters, start, filter_by_channel,
+                                          rerank_plan=rerank_plan, previous_results=previous_results)
+
+    with metrics.stage("render"):
+      rendered = render_search_results(search_results, search_text, page=page, rerank=rerank,
+                                       start_date=start_date, end_date=end_date,
+                                       filter_by_user=filter_by_user,
+                                       filter_by_channel=filter_by_channel)
+    with metrics.stage("say"):
+      scheduler.call(per_channel(post_endpoint, getattr(say, 'channel', None)), say, **rendered)
+
+def search_and_cache(search_text, rerank, filters, start, filter_by_channel, timeout = None,
+                     rerank_plan = None, previous_results = None):
+  """Searches Vectara, and the local index if there is one, for one page of
+  results and caches them.
+
+  With adaptive reranking a reranked search reranks the candidates
+  ``rerank_plan`` says, or those of a new plan for the first page.  Their
+  results go after ``previous_results``, the narrower set they widen.
+  """
+  if rerank and reranker != None and rerank_plan == None:
+    rerank_plan = reranker.plan()
+  if local_index != None:
+    search_results = search_with_local_index(search_text, rerank, filters, start, timeout,
+                                             rerank_plan=rerank_plan)
+  else:
+    # search() appends to the filter list it's given, so hand it a copy
     search_query, search_results = search(search_text=search_text,
                                           rerank=rerank,
-                                          num_results=num_results,
-                                          metadata_filters=filters)
-    
-    if (len(search_results['responseSet']) > 0 and len(search_results['responseSet'][0]['response']) > 0):
-      # Always grab the last result, because if the user has asked for
-      # "more results", we set the search size and then look at the last result
-      response = search_results['responseSet'][0]['response'][-1]
-      text = response['text']
-      document = search_results['responseSet'][0]['document'][-1]
-      response_metadata = response['metadata']
-      document_metadata = document['metadata']
-      text = escape_markdown(text)
-      
-      # Grab the metadata from Vectara's response
-      link_meta = get_metadata_value(document_metadata, 'message_link')
-      poster = get_metadata_value(document_metadata, 'poster')
-      channel = get_metadata_value(document_metadata, 'channel')
-      timestamp = get_metadata_value(document_metadata, 'timestamp')
-
-      # blocks are Slack's way of formatting messages.  For a reference, see
-      # https://app.slack.com/block-kit-builder/
-      blocks = [
-        {
-          "type": "section",
-          "text": {
-            "type": "mrkdwn",
-            "text": "Search results for: *{}*".format(search_text)
-          }
-        },
-        {
-          "type": "divider"
-        },
-        {
-          "type": "section",
-          "fields": [
-            {
-                "type": "mrkdwn",
-                "text": "<@{}> said:\n> {}".format(poster, text)
-            }
-          ]
-        },
-        {
-          "type": "section",
-          "text": { "type": "mrkdwn", "text": "<{}|Link>".format(link_meta) }
-        }
-      ]
-
-      # Only add the reranker / more results, and filters if the user hasn't
-      # already used one of them.  This is an arbitrary limitation that just
-      # simplifies some logic and can be removed in the future
-      if len(filters) == 0:
-        blocks.append({
-            "type": "divider"
-        })
-        # Add our metadata filters
-        blocks.append({
-          "type": "section",
-          "text": { "type": "mrkdwn", "text": "User and Channel Filters:" }
-        })
-        blocks.append({
-          "type": "actions",
-          "elements": [
-            {
-              "type": "users_select",
-              "placeholder": {
-                "type": "plain_text",
-                "text": "Filter by user",
-                "emoji": True
-              },
-              "action_id": "filter_by_user"
-            },
-            {
-              "type": "channels_select",
-              "placeholder": {
-                "type": "plain_text",
-                "text": "Filter by channel",
-                "emoji": True
-              },
-              "action_id": "filter_by_channel"
-            }
-          ]
-        })
-        blocks.append({
-          "type": "section",
-          "text": { "type": "mrkdwn", "text": "Minimum and Maximum Post Time Filters:" }
-        })
-        blocks.append({
-          "type": "actions",
-          "elements": [
-            {
-              "type": "datepicker",
-              "initial_date": "2022-09-01",
-              "placeholder": {
-                "type": "plain_text",
-                "text": "Start Date",
-                "emoji": True
-              },
-              "action_id": "filter_start_date"
-            },
-            {
-              "type": "datepicker",
-              "initial_date": (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d'),
-              "placeholder": {
-                "type": "plain_text",
-                "text": "End Date",
-                "emoji": True
-              },
-              "action_id": "filter_end_date"
-            }
-          ]
-        })
-        blocks.insert(0, {
-          "type": "header",
-          "text": {
-            "type": "plain_text",
-            "text": "Search Results"
-          }
-        })
-      else:
-        if num_results != 1:
-          blocks.insert(0, {
-            "type": "header",
-            "text": {
-              "type": "plain_text",
-              "text": "Search Results (Result {})".format(num_results)
-            }
-          })
-      say(blocks=blocks, text="@{} said:\n> {}\n\n at {}".format(poster,text,timestamp), unfurl_links=False, unfurl_media=False)
-    else:
-      say("Sorry, I couldn't find any relevant results")
+                                          num_results=1,
+                                          metadata_filters=list(filters),
+                                          start=start,
+                                          timeout=timeout,
+                                          rerank_plan=rerank_plan)
+  if previous_results != None and search_results.get('responseSet'):
+    search_results = extend_pool(previous_results, search_results)
+  # partial results, from a search that a corpus didn't answer in time, and
+  # the local index's stand-ins for Vectara's aren't cached, so the next
+  # search can find more
+  if not (search_results.get('partial') or search_results.get('degraded')):
+    search_cache.put(search_cache.make_key(search_text, filters, rerank, start),
+                     search_results, tags=[filter_by_channel])
+  return search_results
+
+def search_with_local_index(search_text, rerank, filters, start, timeout = None, rerank_plan = None):
+  """Searches Vectara and the local index for the page of results at ``start``.
+
+  An exact-token query (see ``exact_token_query``) gets the local index's
+  matches first, and after those come Vectara's results.  Other queries get
+  the local index's keyword matches blended into Vectara's on the first page
+  of unreranked results, or in the whole candidate set of reranked ones;
+  later unreranked pages are Vectara's result at ``start``.  If Vectara
+  doesn't answer within ``timeout`` seconds (``search_timeout`` by default;
+  with no timeout it's waited for as long as it takes), or fails, the local
+  index's matches for any word of the query stand in, marked ``degraded``.
+  ``rerank_plan`` is passed on to ``search``.
+  """
+  exact = exact_token_query(search_text)
+  # reranked searches fetch the whole candidate set and page it locally
+  limit = start + 1
+  if rerank:
+    limit = rerank_plan['candidates'] if rerank_plan != None else 100
+  with metrics.stage("local_search"):
+    local_results = local_index.search(search_text, filters, limit, match='phrase' if exact else 'all')
+  if local_results == None:
+    # a filter the local index can't apply
+    return search(search_text=search_text, rerank=rerank, num_results=1,
+                  metadata_filters=list(filters), start=start, timeout=timeout,
+                  rerank_plan=rerank_plan)[1]
+  local_hits = len(local_results['responseSet'][0]['response'])
+  if exact and not rerank and local_hits > start:
+    metrics.count_local_search("exact")
+    return page_of(local_results, start, 1)
+  # Vectara's results come after the local exact matches, and past the first
+  # page they're shown as they are, so an unreranked page only ever asks
+  # Vectara for its one result
+  vectara_start = 0
+  if not rerank:
+    vectara_start = start - local_hits if exact else start
+
+  error = None
+  try:
+    _, search_results = search(search_text=search_text, rerank=rerank, num_results=1,
+                               metadata_filters=list(filters), start=vectara_start,
+                               timeout=timeout if timeout != None else search_timeout,
+                               rerank_plan=rerank_plan)
+  except TimeoutError as e:
+    logging.warning("Vectara didn't answer %s in time", search_text)
+    search_results, error = None, e
+  except Exception as e:
+    logging.exception("Searching Vectara for %s failed", search_text)
+    search_results, error = None, e
+  if search_results == None or 'responseSet' not in search_results:
+    with metrics.stage("local_search"):
+      fallback = local_index.search(search_text, filters, limit, match='any')
+    if not fallback['responseSet'][0]['response']:
+      if error != None:
+        raise error
+      return search_results
+    metrics.count_local_search("fallback")
+    fallback['degraded'] = True
+    return fallback if rerank else page_of(fallback, start, 1)
+
+  if not (rerank or start == 0):
+    return search_results
+  metrics.count_local_search("exact" if exact and local_hits else "blended")
+  blended = blend_results(search_results, local_results, exact=exact)
+  return blended if rerank else page_of(blended, start, 1)
+
+def progressive_query_and_respond(say, search_text, rerank, start_date = None, end_date = None,
+                                  filter_by_user = None, filter_by_channel = None,
+                                  post_endpoint = SLACK_POST_MESSAGE):
+  """Answers a new search in steps, so the user isn't left waiting on the reranker.
+
+  A placeholder is posted first.  The unreranked search, which only fetches
+  the top hit, and the reranked one run side by side, each hedged, and the
+  placeholder is replaced by whichever answers first, and then, if that was
+  the unreranked one, by the reranked results.  Whatever hasn't answered by
+  the deadline is given up on.
+  """
+  filters = [x for x in [filter_by_channel, filter_by_user, start_date, end_date] if x is not None]
+  deadline = time.monotonic() + query_deadline
+  reply = ProgressiveReply(say, post_endpoint)
+  with metrics.stage("placeholder"):
+    reply.post(text="Searching for *{}*...".format(search_text))
+
+  def show(search_results, reranked):
+    with metrics.stage("render"):
+      rendered = render_search_results(search_results, search_text, rerank=reranked,
+                                       start_date=start_date, end_date=end_date,
+                                       filter_by_user=filter_by_user,
+                                       filter_by_channel=filter_by_channel)
+    with metrics.stage("update"):
+      reply.update(**rendered)
+
+  reranked = None
+  if rerank:
+    reranked = in_background(search_and_cache, search_text, True, filters, 0, filter_by_channel,
+                             timeout=deadline - time.monotonic())
+  shown = False
+  try:
+    with metrics.stage("search"):
+      quick_results = search_and_cache(search_text, False, filters, 0, filter_by_channel,
+                                       timeout=deadline - time.monotonic())
+    if reranked == None or not reranked.done():
+      show(quick_results, False)
+      shown = True
+  except TimeoutError:
+    logging.warning("Unreranked search for %s didn't finish in time", search_text)
+  except Exception:
+    logging.exception("Unreranked search for %s failed", search_text)
+  if reranked != None:
+    try:
+      with metrics.stage("search_reranked"):
+        reranked_results = reranked.result(timeout=max(0.0, deadline - time.monotonic()))
+      show(reranked_results, True)
+      shown = True
+    except (TimeoutError, FutureTimeoutError):
+      logging.warning("Reranked search for %s didn't finish in time", search_text)
+    except Exception:
+      logging.exception("Reranked search for %s failed", search_text)
+  if not shown:
+    reply.update(text="Sorry, the search took too long, please try again")
+
+# the components' own counters are exported with the rest of the metrics
+for name, component in [("token_manager", token_manager), ("indexer", indexer), ("aggregator", aggregator),
+                        ("search_cache", search_cache), ("scheduler", scheduler),
+                        ("local_index", local_index), ("deduplicator", deduplicator),
+                        ("content_filter", content_filter), ("home_view", home_view),
+                        ("reranker", reranker)]:
+  if component != None:
+    metrics.register_stats(name, component.stats)
 
 if __name__ == "__main__":
+    # flush queued messages to Vectara on shutdown, including on SIGTERM;
+    # atexit runs these last first, so pending edits reach the indexer
+    atexit.register(indexer.stop)
+    if aggregator != None:
+      atexit.register(aggregator.stop)
+    atexit.register(edits.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    indexer.start()
+    metrics.start_server()
     handler = SocketModeHandler(app, os.environ.get('SLACK_APP_TOKEN'))
     handler.start()
@@ -0,0 +1,438 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+from slack_bolt.async_app import AsyncApp
+from slack_bolt import BoltResponse
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.web.async_client import AsyncWebClient
+import vectara_async
+from vectara_async import index_message, delete_document, search, reranker
+from slack_helpers import (get_channel_filter,
+                           extract_filters_from_state, decode_cursor,
+                           get_original_query_text, parse_search_command,
+                           index_request_for_message, edited_message,
+                           delete_request_for_event, delete_request_for_message,
+                           search_window)
+from result_renderer import render_search_results
+from progressive_reply import AsyncProgressiveReply
+from indexing_pipeline import AsyncIndexingPipeline, AsyncEditDebouncer, DELETE
+from aggregation import AsyncMessageAggregator, aggregation_enabled
+from index_journal import IndexJournal
+from search_cache import SearchCache
+from event_dedup import EventDeduplicator, event_key
+from content_filter import ContentFilter, BOT, SUBTYPE
+from local_index import open_local_index, exact_token_query, blend_results, page_of
+from rerank_planner import extend_pool
+from home_view import HomeView
+import metrics
+from scheduler import (scheduler, scheduled_as, per_channel, INTERACTIVE, ACTION,
+                       SLACK_POST_MESSAGE, SLACK_RESPONSE_URL, SLACK_VIEWS_PUBLISH,
+                       AsyncSchedulerRateLimitRetryHandler)
+
+# The asyncio version of slackbot.py: the same handlers, but every Slack and
+# Vectara call is awaited on one event loop instead of blocking a thread.
+# start.sh runs this instead of slackbot.py when SLACKBOT_MODE=async.
+
+if os.environ.get('SLACK_API_URL'):
+  # a stand-in for Slack, see benchmarks/fake_servers.py
+  app = AsyncApp(client=AsyncWebClient(token=os.environ.get('SLACK_BOT_TOKEN'),
+                                       base_url=os.environ.get('SLACK_API_URL')))
+else:
+  app = AsyncApp(token=os.environ.get('SLACK_BOT_TOKEN'))
+# 429s from Slack pause that API method for every handler, not just the caller
+app.client.retry_handlers.append(AsyncSchedulerRateLimitRetryHandler())
+search_cache = SearchCache()
+# see slackbot.py
+progressive = os.environ.get('SLACKBOT_PROGRESSIVE') == 'true'
+query_deadline = float(os.environ.get('VECTARA_QUERY_DEADLINE', 10))
+search_timeout = None
+if os.environ.get('VECTARA_QUERY_DEADLINE') or os.environ.get('VECTARA_HEDGE_DELAY'):
+  search_timeout = query_deadline
+# see slackbot.py; SQLite answers in well under a millisecond, so the local
+# index is used from the event loop like the journal
+local_index = open_local_index()
+content_filter = ContentFilter()
+
+def corpus_stats():
+  """What the App Home says about the corpus, see ``slackbot.corpus_stats``."""
+  if local_index == None:
+    return None
+  return {"Messages indexed in the last {:g} days".format(local_index.max_age_days):
+          "{:,}".format(local_index.stats()['messages'])}
+
+home_view = HomeView(corpus_stats)
+
+# messages are journaled to disk until Vectara accepts them; set
+# VECTARA_JOURNAL_PATH to an empty string to turn this off
+journal_path = os.environ.get('VECTARA_JOURNAL_PATH', 'index_journal.sqlite3')
+
+def invalidate_cached_results(request):
+  """See ``slackbot.invalidate_cached_results``."""
+  if request.get('action') == DELETE:
+    search_cache.clear()
+  else:
+    search_cache.invalidate_tag(get_channel_filter(request['metadata']['channel']))
+
+indexer = AsyncIndexingPipeline(
+  index_message,
+  delete_document,
+  journal=IndexJournal(journal_path) if journal_path else None,
+  on_indexed=invalidate_cached_results)
+aggregator = AsyncMessageAggregator(indexer.submit) if aggregation_enabled() else None
+submit_message = aggregator.submit if aggregator != None else indexer.submit
+edits = AsyncEditDebouncer(submit_message)
+# see slackbot.py
+dedup_path = os.environ.get('SLACKBOT_DEDUP_PATH', 'events.sqlite3')
+deduplicator = EventDeduplicator(dedup_path) if dedup_path else None
+
+async def skip_duplicates(body, next, logger):
+  """Acks requests another worker, or an earlier delivery, already claimed."""
+  key = event_key(body)
+  # the claim can wait on another process's write, so keep it off the loop
+  if key != None and not await asyncio.to_thread(deduplicator.claim, key):
+    logger.info("Skipping %s, it was already handled", key)
+    return BoltResponse(status=200, body="")
+  try:
+    return await next()
+  except Exception:
+    if key != None:
+      await asyncio.to_thread(deduplicator.release, key)
+    raise
+
+async def release_failed_claim(error, body, logger):
+  """Releases a failed request's claim, see ``slackbot.release_failed_claim``."""
+  logger.error("Failed to run listener function (error: %s)", error, exc_info=error)
+  key = event_key(body)
+  if key != None:
+    await asyncio.to_thread(deduplicator.release, key)
+
+if deduplicator != None:
+  app.middleware(skip_duplicates)
+  app.error(release_failed_claim)
+
+async def standard_query_and_filter(ack, body, say, logger, use_filter_state = True):
+  """Helper function for most of the filters, see ``slackbot.standard_query_and_filter``."""
+  with metrics.stage("ack"):
+    await ack()
+  filters = extract_filters_from_state(body['state']) if use_filter_state else {}
+  original_search = get_original_query_text(body['message'])
+  with scheduled_as(ACTION):
+    await query_and_respond(say, original_search,
+                            start_date=filters.get('start_date'), end_date=filters.get('end_date'),
+                            filter_by_user=filters.get('user'), filter_by_channel=filters.get('channel'))
+
+@app.action("filter_by_channel")
+@metrics.timed("filter_by_channel")
+async def filter_by_channel(ack, body, say, logger):
+  """Triggered when a user asks for the results to be filtered to a specific channel."""
+  await standard_query_and_filter(ack, body, say, logger)
+
+@app.action("filter_by_user")
+@metrics.timed("filter_by_user")
+async def filter_by_user(ack, body, say, logger):
+  """Triggered when a user asks for the results to be filtered to a specific user."""
+  await standard_query_and_filter(ack, body, say, logger)
+
+@app.action("filter_start_date")
+@metrics.timed("filter_by_start_date")
+async def filter_by_start_date(ack, body, say, logger):
+  """Triggered when a user asks for the results to be filtered >= some date."""
+  await standard_query_and_filter(ack, body, say, logger)
+
+@app.action("filter_end_date")
+@metrics.timed("filter_by_end_date")
+async def filter_by_end_date(ack, body, say, logger):
+  """Triggered when a user asks for the results to be filtered <= some date."""
+  await standard_query_and_filter(ack, body, say, logger)
+
+@app.action("more_results")
+@metrics.timed("more_results")
+async def more_results(ack, body, say, logger):
+  """Triggered when a user asks for more results."""
+  with metrics.stage("ack"):
+    await ack()
+  cursor = decode_cursor(body['actions'][0]['value'])
+  search_text = cursor.get('q') or get_original_query_text(body['message'])
+  with scheduled_as(ACTION):
+    await query_and_respond(say, search_text, page=cursor['p'],
+                            filter_by_user=cursor['u'], filter_by_channel=cursor['c'],
+                            start_date=cursor['s'], end_date=cursor['e'])
+
+@app.command("/vectara")
+@metrics.timed("command_search")
+async def command_search(ack, respond, command):
+  with metrics.stage("ack"):
+    await ack()
+  text, user, channel = parse_search_command(command['text'])
+  with scheduled_as(INTERACTIVE):
+    await query_and_respond(respond, search_text = text,
+                            filter_by_user=user, filter_by_channel=channel,
+                            post_endpoint=SLACK_RESPONSE_URL)
+
+@app.event('app_home_opened')
+async def home(client, event, logger):
+  # the event also comes for the Messages tab, which the view isn't on
+  if event.get('tab') == 'messages':
+    return
+  publish = home_view.to_publish(event)
+  if publish == None:
+    return
+  version, view = publish
+  await scheduler.call_async(SLACK_VIEWS_PUBLISH, client.views_publish, user_id=event["user"], view=view)
+  home_view.sent(event["user"], version)
+
+@app.event('message')
+@metrics.timed("read_message")
+async def read_message(message, context, say):
+  """Triggered when a message is posted, see ``slackbot.read_message``."""
+  bot_user_id = context['bot_user_id']
+
+  if message.get('subtype') == 'message_changed':
+    update_message(message, bot_user_id)
+  elif message.get('subtype') == 'message_deleted':
+    delete_message(message)
+  elif 'text' in message:
+    message_text = message['text']
+    bot_user_id_reference = '<@{}>'.format(bot_user_id) #this is how a bot's mention shows up in the text
+
+    if (message['channel_type'] == 'im'):
+      search_text = message_text.replace(bot_user_id_reference,"").strip()
+      await query_and_respond(say, search_text)
+    elif message['channel_type'] == 'channel':
+      if bot_user_id_reference in message_text:
+        search_text = message_text.replace(bot_user_id_reference,"").strip()
+        await query_and_respond(say, search_text, filter_by_channel=get_channel_filter(message['channel']))
+      elif content_filter.skip_reason(message) == None:
+        request = index_request_for_message(message)
+        with metrics.stage("enqueue"):
+          await submit_message(**request)
+        if local_index != None:
+          local_index.add(request)
+  else:
+    logging.error("Unhandled channel type: %s",message['channel_type'])
+
+def update_message(event, bot_user_id):
+  """Reindexes an edited channel message, see ``slackbot.update_message``."""
+  message = edited_message(event)
+  previous = event.get('previous_message') or {}
+  if (message['channel_type'] != 'channel'
+      or message.get('text') == previous.get('text')
+      or '<@{}>'.format(bot_user_id) in message.get('text', '')):
+    return
+  id = delete_request_for_message(message)['id']
+  content_filter.forget(id)
+  reason = content_filter.skip_reason(message)
+  if reason in (BOT, SUBTYPE):
+    return
+  if reason != None:
+    edits.add(id, dict(delete_request_for_message(message), action=DELETE))
+    if local_index != None:
+      local_index.delete(id)
+    return
+  request = index_request_for_message(message)
+  edits.add(id, dict(request, upsert=True))
+  if local_index != None:
+    local_index.add(request)
+
+def delete_message(event):
+  """Removes a deleted channel message from Vectara, see ``slackbot.delete_message``."""
+  if event.get('channel_type') != 'channel':
+    return
+  request = delete_request_for_event(event)
+  content_filter.forget(request['id'])
+  edits.add(request['id'], dict(request, action=DELETE))
+  if local_index != None:
+    local_index.delete(request['id'])
+
+async def query_and_respond(say, search_text = None, rerank = None,
+                            start_date = None, end_date = None, filter_by_user = None,
+                            filter_by_channel = None, page = 0,
+                            post_endpoint = SLACK_POST_MESSAGE):
+    """Searches Vectara and posts result number ``page``, see ``slackbot.query_and_respond``."""
+    if rerank == None and os.environ.get('VECTARA_USE_RERANKER') == 'true':
+      rerank = True
+    filters = [x for x in [filter_by_channel, filter_by_user, start_date, end_date] if x is not None]
+
+    start, _ = search_window(page, rerank)
+    cache_key = search_cache.make_key(search_text, filters, rerank, start)
+    with metrics.stage("cache"):
+      search_results = search_cache.get(cache_key)
+    previous_results = None
+    rerank_plan = None
+    if rerank and reranker != None:
+      rerank_plan = reranker.plan(page, search_results)
+      if rerank_plan != None:
+        previous_results, search_results = search_results, None
+    if search_results is None:
+      if progressive and page == 0:
+        await progressive_query_and_respond(say, search_text, rerank, start_date=start_date,
+                                            end_date=end_date, filter_by_user=filter_by_user,
+                                            filter_by_channel=filter_by_channel,
+                                            post_endpoint=post_endpoint)
+        return
+      with metrics.stage("search"):
+        search_results = await search_and_cache(search_text, rerank, filters, start, filter_by_channel,
+                                                rerank_plan=rerank_plan,
+                                                previous_results=previous_results)
+
+    with metrics.stage("render"):
+      rendered = render_search_results(search_results, search_text, page=page, rerank=rerank,
+                                       start_date=start_date, end_date=end_date,
+                                       filter_by_user=filter_by_user,
+                                       filter_by_channel=filter_by_channel)
+    with metrics.stage("say"):
+      await scheduler.call_async(per_channel(post_endpoint, getattr(say, 'channel', None)), say, **rendered)
+
+async def search_and_cache(search_text, rerank, filters, start, filter_by_channel, timeout = None,
+                           rerank_plan = None, previous_results = None):
+  """Searches for one page of results and caches them, see ``slackbot.search_and_cache``."""
+  if rerank and reranker != None and rerank_plan == None:
+    rerank_plan = reranker.plan()
+  if local_index != None:
+    search_results = await search_with_local_index(search_text, rerank, filters, start, timeout,
+                                                   rerank_plan=rerank_plan)
+  else:
+    search_query, search_results = await search(search_text=search_text,
+                                                rerank=rerank,
+                                                num_results=1,
+                                                metadata_filters=list(filters),
+                                                start=start,
+                                                timeout=timeout,
+                                                rerank_plan=rerank_plan)
+  if previous_results != None and search_results.get('responseSet'):
+    search_results = extend_pool(previous_results, search_results)
+  if not (search_results.get('partial') or search_results.get('degraded')):
+    search_cache.put(search_cache.make_key(search_text, filters, rerank, start),
+                     search_results, tags=[filter_by_channel])
+  return search_results
+
+async def search_with_local_index(search_text, rerank, filters, start, timeout = None, rerank_plan = None):
+  """Searches Vectara and the local index, see ``slackbot.search_with_local_index``."""
+  exact = exact_token_query(search_text)
+  limit = start + 1
+  if rerank:
+    limit = rerank_plan['candidates'] if rerank_plan != None else 100
+  with metrics.stage("local_search"):
+    local_results = local_index.search(search_text, filters, limit, match='phrase' if exact else 'all')
+  if local_results == None:
+    return (await search(search_text=search_text, rerank=rerank, num_results=1,
+                         metadata_filters=list(filters), start=start, timeout=timeout,
+                         rerank_plan=rerank_plan))[1]
+  local_hits = len(local_results['responseSet'][0]['response'])
+  if exact and not rerank and local_hits > start:
+    metrics.count_local_search("exact")
+    return page_of(local_results, start, 1)
+  # Vectara's results come after the local exact matches, and past the first
+  # page they're shown as they are, so an unreranked page only ever asks
+  # Vectara for its one result
+  vectara_start = 0
+  if not rerank:
+    vectara_start = start - local_hits if exact else start
+
+  error = None
+  try:
+    _, search_results = await search(search_text=search_text, rerank=rerank, num_results=1,
+                                     metadata_filters=list(filters), start=vectara_start,
+                                     timeout=timeout if timeout != None else search_timeout,
+                                     rerank_plan=rerank_plan)
+  except TimeoutError as e:
+    logging.warning("Vectara didn't answer %s in time", search_text)
+    search_results, error = None, e
+  except Exception as e:
+    logging.exception("Searching Vectara for %s failed", search_text)
+    search_results, error = None, e
+  if search_results == None or 'responseSet' not in search_results:
+    with metrics.stage("local_search"):
+      fallback = local_index.search(search_text, filters, limit, match='any')
+    if not fallback['responseSet'][0]['response']:
+      if error != None:
+        raise error
+      return search_results
+    metrics.count_local_search("fallback")
+    fallback['degraded'] = True
+    return fallback if rerank else page_of(fallback, start, 1)
+
+  if not (rerank or start == 0):
+    return search_results
+  metrics.count_local_search("exact" if exact and local_hits else "blended")
+  blended = blend_results(search_results, local_results, exact=exact)
+  return blended if rerank else page_of(blended, start, 1)
+
+async def progressive_query_and_respond(say, search_text, rerank, start_date = None, end_date = None,
+                                        filter_by_user = None, filter_by_channel = None,
+                                        post_endpoint = SLACK_POST_MESSAGE):
+  """Answers a new search in steps, see ``slackbot.progressive_query_and_respond``."""
+  filters = [x for x in [filter_by_channel, filter_by_user, start_date, end_date] if x is not None]
+  deadline = time.monotonic() + query_deadline
+  reply = AsyncProgressiveReply(say, post_endpoint)
+  with metrics.stage("placeholder"):
+    await reply.post(text="Searching for *{}*...".format(search_text))
+
+  async def show(search_results, reranked):
+    with metrics.stage("render"):
+      rendered = render_search_results(search_results, search_text, rerank=reranked,
+                                       start_date=start_date, end_date=end_date,
+                                       filter_by_user=filter_by_user,
+                                       filter_by_channel=filter_by_channel)
+    with metrics.stage("update"):
+      await reply.update(**rendered)
+
+  reranked = None
+  if rerank:
+    reranked = asyncio.ensure_future(search_and_cache(search_text, True, filters, 0, filter_by_channel,
+                                                      timeout=deadline - time.monotonic()))
+  shown = False
+  try:
+    with metrics.stage("search"):
+      quick_results = await search_and_cache(search_text, False, filters, 0, filter_by_channel,
+                                             timeout=deadline - time.monotonic())
+    if reranked == None or not reranked.done():
+      await show(quick_results, False)
+      shown = True
+  except TimeoutError:
+    logging.warning("Unreranked search for %s didn't finish in time", search_text)
+  except Exception:
+    logging.exception("Unreranked search for %s failed", search_text)
+  if reranked != None:
+    try:
+      with metrics.stage("search_reranked"):
+        reranked_results = await reranked
+      await show(reranked_results, True)
+      shown = True
+    except TimeoutError:
+      logging.warning("Reranked search for %s didn't finish in time", search_text)
+    except Exception:
+      logging.exception("Reranked search for %s failed", search_text)
+  if not shown:
+    await reply.update(text="Sorry, the search took too long, please try again")
+
+async def main():
+    # SIGTERM cancels us, which runs the shutdown below
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    indexer.start()
+    metrics.start_server()
+    handler = AsyncSocketModeHandler(app, os.environ.get('SLACK_APP_TOKEN'))
+    try:
+      await handler.start_async()
+    finally:
+      # flush in-flight messages to Vectara on shutdown
+      await edits.stop()
+      if aggregator != None:
+        await aggregator.stop()
+      await indexer.stop()
+      await vectara_async.token_manager.close()
+      await vectara_async.transport.close()
+
+# the components' own counters are exported with the rest of the metrics
+for name, component in [("token_manager", vectara_async.token_manager), ("indexer", indexer), ("aggregator", aggregator),
+                        ("search_cache", search_cache), ("scheduler", scheduler),
+                        ("local_index", local_index), ("deduplicator", deduplicator),
+                        ("content_filter", content_filter), ("home_view", home_view),
+                        ("reranker", reranker)]:
+  if component != None:
+    metrics.register_stats(name, component.stats)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,4 +6,14 @@ export VECTARA_CORPUS_ID=
 export VECTARA_APP_ID=
 export VECTARA_APP_SECRET=
 export VECTARA_USE_RERANKER=true
-python3 slackbot.py
\ No newline at end of file
+# sync (one thread per request) or async (asyncio event loop)
+export SLACKBOT_MODE=sync
+# bot processes to run, more than one runs them under workers.py
+export SLACKBOT_WORKERS=1
+if [ "$SLACKBOT_WORKERS" -gt 1 ]; then
+  python3 workers.py
+elif [ "$SLACKBOT_MODE" = "async" ]; then
+  python3 slackbot_async.py
+else
+  python3 slackbot.py
+fi
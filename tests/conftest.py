@@ -0,0 +1,29 @@
+import importlib
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_servers import FakeSlack, FakeVectara, Recorder, ServerThread
+from benchmarks.load_benchmark import configure_environment
+
+@pytest.fixture(scope="session")
+def fake_services(tmp_path_factory):
+    """Local stand-ins for Vectara and Slack, with the bot configured to use them."""
+    recorder = Recorder()
+    vectara = FakeVectara(recorder)
+    slack = FakeSlack(recorder)
+    servers = [ServerThread(vectara.application()), ServerThread(slack.application())]
+    for server in servers:
+        server.start()
+    directory = tmp_path_factory.mktemp("bot")
+    configure_environment(servers[0].url, servers[1].url, '', '', str(directory / "local_index.sqlite3"))
+    yield vectara, slack
+    for server in servers:
+        server.stop()
+
+@pytest.fixture(params=["slackbot", "slackbot_async"])
+def bot(request, fake_services):
+    """The sync and then the asyncio bot module, imported against the fake services."""
+    return importlib.import_module(request.param)
@@ -0,0 +1,99 @@
+import asyncio
+from aggregation import MessageAggregator, AsyncMessageAggregator
+from indexing_pipeline import DELETE
+
+def message(id, text, timestamp=1000.0, channel="C1"):
+    return {"customer_id": 1, "corpus_id": 2, "id": id, "text": text, "title": "Message",
+            "metadata": {"channel": channel, "channel_type": "channel", "message_type": "message",
+                         "poster": "U1", "message_link": "link-" + id, "timestamp": timestamp}}
+
+def recording_aggregator(path, **limits):
+    submitted = []
+
+    def submit(**request):
+        submitted.append(request)
+        return True
+    limits = dict(dict(window=600, max_messages=50, max_chars=20000, max_age=60), **limits)
+    return MessageAggregator(submit, path=path, **limits), submitted
+
+def texts(request):
+    return [section['text'] for section in request['sections']]
+
+def test_messages_are_grouped(tmp_path):
+    aggregator, submitted = recording_aggregator(str(tmp_path / "aggregation.sqlite3"), max_messages=2)
+    aggregator.submit(**message("m1", "first"))
+    aggregator.submit(**message("m2", "second"))
+    aggregator.stop()
+    assert len(submitted) == 1
+    assert texts(submitted[0]) == ["first", "second"]
+
+def test_edit_and_delete_of_pending_group(tmp_path):
+    aggregator, submitted = recording_aggregator(str(tmp_path / "aggregation.sqlite3"))
+    aggregator.submit(**message("m1", "first"))
+    aggregator.submit(**message("m2", "second"))
+    aggregator.submit(**dict(message("m1", "first, edited"), upsert=True))
+    aggregator.submit(customer_id=1, corpus_id=2, id="m2", action=DELETE)
+    assert submitted == []
+    aggregator.stop()
+    assert [texts(request) for request in submitted] == [["first, edited"]]
+
+def test_edit_and_delete_after_restart(tmp_path):
+    path = str(tmp_path / "aggregation.sqlite3")
+    aggregator, submitted = recording_aggregator(path, max_messages=2)
+    aggregator.submit(**message("m1", "first"))
+    aggregator.submit(**message("m2", "second"))
+    aggregator.stop()
+    document_id = submitted[0]['id']
+
+    # another worker, or the next run, has only the store to go by
+    aggregator, submitted = recording_aggregator(path)
+    aggregator.submit(**dict(message("m2", "second, edited"), upsert=True))
+    assert submitted[0]['id'] == document_id and submitted[0]['upsert']
+    assert texts(submitted[0]) == ["first", "second, edited"]
+    aggregator.submit(customer_id=1, corpus_id=2, id="m1", action=DELETE)
+    assert texts(submitted[1]) == ["second, edited"]
+    aggregator.submit(customer_id=1, corpus_id=2, id="m2", action=DELETE)
+    assert submitted[2] == {"customer_id": 1, "corpus_id": 2, "id": document_id, "action": DELETE}
+    aggregator.stop()
+
+def test_edit_reaches_group_pending_in_another_worker(tmp_path):
+    path = str(tmp_path / "aggregation.sqlite3")
+    owner, owner_submitted = recording_aggregator(path)
+    other, other_submitted = recording_aggregator(path)
+    owner.submit(**message("m1", "first"))
+    other.submit(**dict(message("m1", "first, edited"), upsert=True))
+    assert other_submitted == []
+    owner.stop()
+    other.stop()
+    assert [texts(request) for request in owner_submitted] == [["first, edited"]]
+
+def test_unknown_and_forgotten_messages_are_passed_through(tmp_path):
+    aggregator, submitted = recording_aggregator(str(tmp_path / "aggregation.sqlite3"),
+                                                 max_messages=1, remember=1)
+    aggregator.submit(**message("m1", "first"))
+    aggregator.submit(**message("m2", "second", channel="C2"))
+    aggregator.submit(**dict(message("m1", "first, edited"), upsert=True))
+    aggregator.submit(**dict(message("m0", "older"), upsert=True))
+    aggregator.stop()
+    assert [request['id'] for request in submitted[2:]] == ["m1", "m0"]
+    assert aggregator.stats()["passed_through"] == 2
+
+def test_async_edit_after_restart(tmp_path):
+    path = str(tmp_path / "aggregation.sqlite3")
+    submitted = []
+
+    async def submit(**request):
+        submitted.append(request)
+        return True
+
+    async def run():
+        aggregator = AsyncMessageAggregator(submit, path=path, max_messages=2, max_age=60)
+        await aggregator.submit(**message("m1", "first"))
+        await aggregator.submit(**message("m2", "second"))
+        await aggregator.stop()
+        aggregator = AsyncMessageAggregator(submit, path=path, max_age=60)
+        await aggregator.submit(**dict(message("m1", "first, edited"), upsert=True))
+        await aggregator.stop()
+
+    asyncio.run(run())
+    assert texts(submitted[1]) == ["first, edited", "second"]
@@ -0,0 +1,20 @@
+import time
+from backfill import Backfill
+from local_index import LocalIndex
+
+class RecordingIndexer:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, **request):
+        self.submitted.append(request)
+        return True
+
+def test_backfilled_messages_reach_the_local_index(fake_services, tmp_path):
+    indexer = RecordingIndexer()
+    local_index = LocalIndex(str(tmp_path / "local_index.sqlite3"))
+    backfill = Backfill(None, indexer, None, local_index=local_index)
+    backfill._index("C1", {"user": "U1", "ts": str(time.time()), "text": "the staging deploy failed"})
+    backfill._index("C1", {"user": "U1", "ts": str(time.time()), "text": "ok"})
+    assert [request['text'] for request in indexer.submitted] == ["the staging deploy failed"]
+    assert local_index.stats()['messages'] == 1
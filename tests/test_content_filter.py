@@ -0,0 +1,107 @@
+import itertools
+import random
+import pytest
+from content_filter import (ContentFilter, _FingerprintIndex, simhash, BOT, SUBTYPE, LOW_INFORMATION,
+                            DUPLICATE, NEAR_DUPLICATE)
+
+ALERT = "disk usage on db-7 reached 91 percent of the data volume at 03:12 please check"
+_timestamps = itertools.count(1)
+
+def message(text, channel = "C1", **fields):
+    return {"type": "message", "channel": channel, "user": "U1", "text": text,
+            "ts": "{}.0".format(next(_timestamps)), **fields}
+
+def flip(fingerprint, *bits):
+    for bit in bits:
+        fingerprint ^= 1 << bit
+    return fingerprint
+
+def test_simhash_ignores_numbers():
+    assert simhash(ALERT.split()) == simhash(ALERT.replace("91", "97").replace("03:12", "04:40").split())
+
+def test_simhash_of_similar_texts_is_close():
+    words = ALERT.split()
+    changed = simhash(words[:-1] + ["investigate"])
+    unrelated = simhash("the quarterly planning meeting moved to thursday afternoon in room four".split())
+    assert bin(simhash(words) ^ changed).count('1') < bin(simhash(words) ^ unrelated).count('1')
+
+@pytest.mark.parametrize("bits", [(), (0,), (5, 40), (1, 17, 63)])
+def test_fingerprints_within_the_distance_are_found(bits):
+    index = _FingerprintIndex(capacity=10, distance=3)
+    fingerprint = random.Random(1).getrandbits(64)
+    index.add("m1", "C1", b"digest", fingerprint)
+    assert index.find("C1", b"other", flip(fingerprint, *bits)) == NEAR_DUPLICATE
+
+@pytest.mark.parametrize("bits", [(0, 1, 2, 3), (0, 16, 32, 48), (3, 20, 37, 54, 63)])
+def test_fingerprints_past_the_distance_arent(bits):
+    index = _FingerprintIndex(capacity=10, distance=3)
+    fingerprint = random.Random(2).getrandbits(64)
+    index.add("m1", "C1", b"digest", fingerprint)
+    assert index.find("C1", b"other", flip(fingerprint, *bits)) == None
+
+def test_fingerprints_are_per_scope():
+    index = _FingerprintIndex(capacity=10, distance=3)
+    index.add("m1", "C1", b"digest", 12345)
+    assert index.find("C2", b"digest", 12345) == None
+    assert index.find("C1", b"digest", 12345) == DUPLICATE
+
+def test_least_recently_seen_are_evicted_at_capacity():
+    index = _FingerprintIndex(capacity=2, distance=3)
+    rng = random.Random(3)
+    one, two, three = (rng.getrandbits(64) for _ in range(3))
+    index.add("m1", "C1", b"one", one)
+    index.add("m2", "C1", b"two", two)
+    # seeing m1 again keeps it
+    assert index.find("C1", b"one", None) == DUPLICATE
+    index.add("m3", "C1", b"three", three)
+    assert len(index) == 2
+    assert index.find("C1", b"two", two) == None
+    assert index.find("C1", b"changed", flip(one, 7)) == NEAR_DUPLICATE
+    # and the evicted one's bands are gone too
+    assert all(all("m2" not in ids for ids in bands.values()) for bands in index._by_band)
+
+def test_forgotten_messages_arent_found():
+    index = _FingerprintIndex(capacity=10, distance=3)
+    index.add("m1", "C1", b"digest", 12345)
+    index.forget("m1")
+    assert index.find("C1", b"digest", 12345) == None
+    assert len(index) == 0
+
+def test_each_skip_reason():
+    content_filter = ContentFilter(min_words=2, subtypes=["thread_broadcast"], capacity=100, distance=3)
+    assert content_filter.skip_reason(message("deploy finished", bot_id="B1")) == BOT
+    assert content_filter.skip_reason(message("deploy finished", subtype="bot_message")) == BOT
+    assert content_filter.skip_reason(message("joined the channel", subtype="channel_join")) == SUBTYPE
+    assert content_filter.skip_reason(message("deploy finished", subtype="thread_broadcast")) == None
+    assert content_filter.skip_reason(message("ok thanks")) == LOW_INFORMATION
+    assert content_filter.skip_reason(message("<@U2> :tada:")) == LOW_INFORMATION
+    assert content_filter.skip_reason(message("Deploy finished!")) == DUPLICATE
+    assert content_filter.skip_reason(message(ALERT)) == None
+    assert content_filter.skip_reason(message(ALERT.replace("91", "95").replace("03:12", "03:30"))) == NEAR_DUPLICATE
+    assert content_filter.skip_reason(message("<@U2> " + ALERT.replace("91", "93"))) == NEAR_DUPLICATE
+    stats = content_filter.stats()
+    assert stats["checked"] == 10
+    assert (stats["skipped_bot"], stats["skipped_subtype"], stats["skipped_low_information"],
+            stats["skipped_duplicate"], stats["skipped_near_duplicate"]) == (2, 1, 2, 1, 2)
+
+def test_short_messages_are_only_exact_duplicates():
+    content_filter = ContentFilter(min_words=2, subtypes=[], capacity=100, distance=3)
+    assert content_filter.skip_reason(message("restart the api server")) == None
+    assert content_filter.skip_reason(message("restart the web server")) == None
+
+def test_repeats_in_other_channels_are_indexed():
+    content_filter = ContentFilter(min_words=2, subtypes=[], capacity=100, distance=3)
+    assert content_filter.skip_reason(message(ALERT, channel="C1")) == None
+    assert content_filter.skip_reason(message(ALERT, channel="C2")) == None
+
+def test_edited_message_is_forgotten():
+    content_filter = ContentFilter(min_words=2, subtypes=[], capacity=100, distance=3)
+    original = message(ALERT, client_msg_id="m1")
+    assert content_filter.skip_reason(original) == None
+    content_filter.forget("m1")
+    assert content_filter.skip_reason(message(ALERT)) == None
+
+def test_zero_capacity_turns_off_duplicate_checks():
+    content_filter = ContentFilter(min_words=2, subtypes=[], capacity=0, distance=3)
+    assert content_filter.skip_reason(message(ALERT)) == None
+    assert content_filter.skip_reason(message(ALERT)) == None
@@ -0,0 +1,50 @@
+import pytest
+from benchmarks.harness import message_changed_event
+from indexing_pipeline import DELETE
+from local_index import LocalIndex
+
+class RecordingEdits:
+    def __init__(self):
+        self.added = []
+
+    def add(self, key, request):
+        self.added.append((key, request))
+
+@pytest.fixture
+def edits(bot, monkeypatch, tmp_path):
+    recording = RecordingEdits()
+    monkeypatch.setattr(bot, 'edits', recording)
+    monkeypatch.setattr(bot, 'local_index', LocalIndex(str(tmp_path / "local_index.sqlite3")))
+    return recording
+
+def local_hits(bot, text):
+    return bot.local_index.search(text, [], 10)['responseSet'][0]['response']
+
+def test_edit_is_reindexed(bot, edits):
+    event = message_changed_event("edit-reindexed", "the deploy to staging failed again",
+                                  "the deploy to staging failed")['event']
+    bot.update_message(event, "U0BOT")
+    [(key, request)] = edits.added
+    assert request['upsert'] and request['text'] == "the deploy to staging failed again"
+    assert len(local_hits(bot, "again")) == 1
+
+def test_edit_of_bot_post_is_ignored(bot, edits):
+    event = message_changed_event("edit-bot", "Search results for: *deploy* updated",
+                                  "Searching for *deploy*...")['event']
+    del event['message']['user']
+    event['message']['bot_id'] = "B0BENCHBOT"
+    bot.update_message(event, "U0BOT")
+    # an integration that posts as a user is still a bot
+    event['message']['user'] = "U0INTEGRATION"
+    bot.update_message(event, "U0BOT")
+    assert edits.added == []
+    assert local_hits(bot, "deploy") == []
+
+def test_edit_to_low_information_text_is_deleted(bot, edits):
+    bot.local_index.add({"id": "edit-low", "text": "the deploy to staging failed",
+                         "metadata": {"channel": "C0BENCH"}})
+    event = message_changed_event("edit-low", "ok thanks", "the deploy to staging failed")['event']
+    bot.update_message(event, "U0BOT")
+    [(key, request)] = edits.added
+    assert request['action'] == DELETE and request['id'] == key
+    assert local_hits(bot, "deploy") == []
@@ -0,0 +1,36 @@
+import asyncio
+import logging
+import time
+from event_dedup import EventDeduplicator, event_key
+
+def test_claim_is_taken_once(tmp_path):
+    path = str(tmp_path / "events.sqlite3")
+    first, second = EventDeduplicator(path), EventDeduplicator(path)
+    assert first.claim("event:E1")
+    assert not second.claim("event:E1")
+    assert second.claim("event:E2")
+    assert first.stats()["keys"] == 2
+
+def test_expired_claim_can_be_taken_again(tmp_path):
+    deduplicator = EventDeduplicator(str(tmp_path / "events.sqlite3"), ttl=0.05)
+    assert deduplicator.claim("event:E1")
+    assert not deduplicator.claim("event:E1")
+    time.sleep(0.1)
+    assert deduplicator.claim("event:E1")
+
+def test_released_claim_can_be_taken_again(tmp_path):
+    deduplicator = EventDeduplicator(str(tmp_path / "events.sqlite3"))
+    assert deduplicator.claim("event:E1")
+    deduplicator.release("event:E1")
+    assert deduplicator.claim("event:E1")
+    assert deduplicator.stats()["released"] == 1
+
+def test_failed_listener_releases_its_claim(bot, monkeypatch, tmp_path):
+    deduplicator = EventDeduplicator(str(tmp_path / "events.sqlite3"))
+    monkeypatch.setattr(bot, 'deduplicator', deduplicator)
+    body = {"event_id": "E1", "event": {"type": "app_mention"}}
+    assert deduplicator.claim(event_key(body))
+    released = bot.release_failed_claim(RuntimeError("boom"), body, logging.getLogger(__name__))
+    if asyncio.iscoroutine(released):
+        asyncio.run(released)
+    assert deduplicator.claim(event_key(body))
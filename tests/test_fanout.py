@@ -0,0 +1,110 @@
+import asyncio
+import time
+import pytest
+import vectara_async
+import vectara_functions
+from vectara_functions import build_fanout_requests, build_search_request, merge_search_results
+
+def corpus_results(corpus_id, *scores):
+    """An answer from ``corpus_id`` with one document per score, named after both."""
+    ids = ["{}-{}".format(corpus_id, score) for score in scores]
+    return {"responseSet": [{"response": [{"text": id, "score": score, "documentIndex": i}
+                                          for i, (id, score) in enumerate(zip(ids, scores))],
+                             "document": [{"id": id, "metadata": []} for id in ids]}]}
+
+def shown(results):
+    """The document id of each response, in order, checking they line up."""
+    response_set = results['responseSet'][0]
+    ids = [response_set['document'][response['documentIndex']]['id'] for response in response_set['response']]
+    assert ids == [response['text'] for response in response_set['response']]
+    assert len(response_set['document']) == len(ids)
+    return ids
+
+@pytest.fixture
+def query(monkeypatch):
+    monkeypatch.setenv('VECTARA_CUSTOMER_ID', '1')
+    monkeypatch.setenv('VECTARA_CORPUS_ID', '1')
+
+    def query(start = 0, num_results = 3, rerank = False):
+        return build_search_request("deploy", rerank, num_results, start=start)
+    return query
+
+def test_each_corpus_is_asked_for_everything_up_to_the_page(query):
+    requests = build_fanout_requests(query(start=4, num_results=2), [1, 2])
+    assert [request['query'][0]['corpus_key'][0]['corpus_id'] for request in requests] == [1, 2]
+    assert {(request['query'][0]['start'], request['query'][0]['num_results']) for request in requests} == {(0, 6)}
+
+def test_responses_are_ranked_across_corpora(query):
+    merged = merge_search_results(query(num_results=4), [1, 2],
+                                  [corpus_results(1, 0.9, 0.5, 0.2), corpus_results(2, 0.8, 0.6)])
+    assert shown(merged) == ["1-0.9", "2-0.8", "2-0.6", "1-0.5"]
+    assert 'partial' not in merged
+
+def test_start_pages_the_merged_ranking(query):
+    answers = [corpus_results(1, 0.9, 0.5, 0.2), corpus_results(2, 0.8, 0.6)]
+    assert shown(merge_search_results(query(start=2, num_results=2), [1, 2], answers)) == ["2-0.6", "1-0.5"]
+    assert shown(merge_search_results(query(start=4, num_results=2), [1, 2], answers)) == ["1-0.2"]
+
+def test_missing_corpus_makes_a_partial_result(query):
+    merged = merge_search_results(query(), [1, 2], [None, corpus_results(2, 0.8, 0.6)])
+    assert shown(merged) == ["2-0.8", "2-0.6"]
+    assert merged['partial'] == True
+
+def test_no_answers_raise_timeout(query):
+    with pytest.raises(TimeoutError):
+        merge_search_results(query(), [1, 2], [None, None])
+
+@pytest.fixture(params=["threads", "asyncio"])
+def fanout(request, monkeypatch):
+    """Runs ``search_fanout`` against corpora answering after ``delays[corpus_id]``
+    seconds with ``answers[corpus_id]``, or failing if that's an exception."""
+    answers = {}
+    delays = {}
+
+    def answer(data):
+        corpus_id = data['query'][0]['corpus_key'][0]['corpus_id']
+        if isinstance(answers[corpus_id], Exception):
+            raise answers[corpus_id]
+        return data, answers[corpus_id]
+
+    def search_raw(headers, data):
+        time.sleep(delays.get(data['query'][0]['corpus_key'][0]['corpus_id'], 0))
+        return answer(data)
+
+    async def async_search_raw(headers, data):
+        await asyncio.sleep(delays.get(data['query'][0]['corpus_key'][0]['corpus_id'], 0))
+        return answer(data)
+
+    if request.param == "threads":
+        monkeypatch.setattr(vectara_functions, 'search_raw', search_raw)
+
+        def search(data_dict, corpus_ids, deadline):
+            return vectara_functions.search_fanout({}, data_dict, corpus_ids, deadline)
+    else:
+        monkeypatch.setattr(vectara_async, 'search_raw', async_search_raw)
+
+        def search(data_dict, corpus_ids, deadline):
+            return asyncio.run(vectara_async.search_fanout({}, data_dict, corpus_ids, deadline))
+    return answers, delays, search
+
+def test_fanout_merges_every_corpus(fanout, query):
+    answers, delays, search = fanout
+    answers.update({1: corpus_results(1, 0.9, 0.2), 2: corpus_results(2, 0.5), 3: corpus_results(3, 0.7)})
+    assert shown(search(query(), [1, 2, 3], 2.0)) == ["1-0.9", "3-0.7", "2-0.5"]
+
+def test_fanout_leaves_out_late_and_failed_corpora(fanout, query):
+    answers, delays, search = fanout
+    answers.update({1: corpus_results(1, 0.9), 2: corpus_results(2, 0.8), 3: RuntimeError("down")})
+    delays[1] = 1.0
+    started = time.monotonic()
+    merged = search(query(), [1, 2, 3], 0.2)
+    assert time.monotonic() - started < 0.8
+    assert shown(merged) == ["2-0.8"]
+    assert merged['partial'] == True
+
+def test_fanout_with_no_answers_raises_timeout(fanout, query):
+    answers, delays, search = fanout
+    answers.update({1: corpus_results(1, 0.9), 2: {"error": "unavailable"}})
+    delays[1] = 1.0
+    with pytest.raises(TimeoutError):
+        search(query(), [1, 2], 0.1)
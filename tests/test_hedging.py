@@ -0,0 +1,135 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from hedging import Hedger, LatencyTracker
+
+class SlowCalls:
+    """A callable whose ``n``th call sleeps ``delays[n]`` seconds and then
+    returns ``n``, or raises ``errors[n]`` if there is one."""
+
+    def __init__(self, *delays, errors = None):
+        self.delays = delays
+        self.errors = errors or {}
+        self.started = []
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            n = len(self.started)
+            self.started.append(time.monotonic())
+        return n
+
+    def __call__(self):
+        n = self._next()
+        time.sleep(self.delays[n])
+        if n in self.errors:
+            raise self.errors[n]
+        return n
+
+    async def call_async(self):
+        n = self._next()
+        await asyncio.sleep(self.delays[n])
+        if n in self.errors:
+            raise self.errors[n]
+        return n
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as executor:
+        yield executor
+
+def hedged(hedger, executor, function, deadline = 2.0):
+    return hedger.call(executor, "search", function, deadline=time.monotonic() + deadline)
+
+def test_fast_call_isnt_hedged(executor):
+    hedger = Hedger(default_delay=0.2)
+    calls = SlowCalls(0.01)
+    assert hedged(hedger, executor, calls) == 0
+    assert len(calls.started) == 1
+    assert hedger.stats()["hedged"] == 0
+
+def test_slow_call_is_hedged_and_the_first_answer_wins(executor):
+    hedger = Hedger(default_delay=0.05)
+    calls = SlowCalls(0.5, 0.01)
+    started = time.monotonic()
+    assert hedged(hedger, executor, calls) == 1
+    assert time.monotonic() - started < 0.4
+    # the hedge went out after the delay, and the slow copy's answer is dropped
+    assert calls.started[1] - calls.started[0] >= 0.04
+    stats = hedger.stats()
+    assert (stats["calls"], stats["hedged"], stats["hedges_won"]) == (1, 1, 1)
+
+def test_original_can_still_win_after_hedging(executor):
+    hedger = Hedger(default_delay=0.05)
+    assert hedged(hedger, executor, SlowCalls(0.1, 0.5)) == 0
+    stats = hedger.stats()
+    assert (stats["hedged"], stats["hedges_won"]) == (1, 0)
+
+def test_hedge_delay_follows_the_p95_once_measured(executor):
+    hedger = Hedger(default_delay=5.0, min_samples=3)
+    assert hedger.hedge_delay("search") == 5.0
+    for _ in range(3):
+        hedged(hedger, executor, SlowCalls(0.02))
+    assert 0.02 <= hedger.hedge_delay("search") < 0.1
+    # so a call slower than the recent ones is hedged
+    assert hedged(hedger, executor, SlowCalls(0.5, 0.01)) == 1
+
+def test_error_is_raised_once_no_copy_is_left(executor):
+    hedger = Hedger(default_delay=0.05)
+    with pytest.raises(ValueError):
+        hedged(hedger, executor, SlowCalls(0.1, 0.1, errors={0: ValueError("first"), 1: ValueError("second")}))
+    # but a failure doesn't hide the other copy's answer
+    assert hedged(hedger, executor, SlowCalls(0.1, 0.2, errors={0: ValueError("first")})) == 1
+
+def test_deadline_raises_timeout(executor):
+    hedger = Hedger(default_delay=0.05)
+    with pytest.raises(TimeoutError):
+        hedged(hedger, executor, SlowCalls(0.5, 0.5), deadline=0.15)
+    assert hedger.stats()["timeouts"] == 1
+
+def test_async_hedge_wins_and_the_slow_copy_is_cancelled():
+    hedger = Hedger(default_delay=0.05)
+    calls = SlowCalls(5.0, 0.01)
+
+    async def main():
+        started = time.monotonic()
+        result = await hedger.call_async("search", calls.call_async, deadline=started + 2.0)
+        # nothing is left running on the loop
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.sleep(0)
+        return result, time.monotonic() - started, [task for task in pending if not task.done()]
+
+    result, elapsed, pending = asyncio.run(main())
+    assert (result, pending) == (1, [])
+    assert elapsed < 1.0
+    assert hedger.stats()["hedges_won"] == 1
+
+def test_async_error_propagates():
+    hedger = Hedger(default_delay=0.05)
+    calls = SlowCalls(0.01, errors={0: ValueError("failed")})
+    with pytest.raises(ValueError):
+        asyncio.run(hedger.call_async("search", calls.call_async, deadline=time.monotonic() + 2.0))
+
+def test_percentiles_are_nearest_rank():
+    tracker = LatencyTracker()
+    for seconds in range(100, 0, -1):
+        tracker.record(seconds)
+    assert tracker.percentile(0.95) == 95
+    assert tracker.percentile(0.5) == 50
+    assert tracker.percentile(1.0) == 100
+    assert tracker.percentile(0.0) == 1
+
+def test_percentile_needs_enough_samples():
+    tracker = LatencyTracker()
+    assert tracker.percentile(0.95) == None
+    tracker.record(1.0)
+    assert tracker.percentile(0.95) == 1.0
+    assert tracker.percentile(0.95, min_samples=2) == None
+
+def test_only_the_window_counts():
+    tracker = LatencyTracker(window=10)
+    for seconds in [100.0] * 10 + [1.0] * 10:
+        tracker.record(seconds)
+    assert tracker.percentile(1.0) == 1.0
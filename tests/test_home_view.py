@@ -0,0 +1,79 @@
+import time
+from home_view import HomeView
+
+def opened(user, view = None):
+    event = {"type": "app_home_opened", "user": user, "tab": "home"}
+    if view != None:
+        event["view"] = {"private_metadata": view["private_metadata"]}
+    return event
+
+def publish(home_view, event):
+    """Publishes like the bots do, returning the view sent, or None."""
+    publish = home_view.to_publish(event)
+    if publish == None:
+        return None
+    version, view = publish
+    home_view.sent(event["user"], version)
+    return view
+
+def test_view_is_stamped_with_its_version():
+    home_view = HomeView(ttl=60, max_users=10, stats_interval=0)
+    view = publish(home_view, opened("U1"))
+    assert view["type"] == "home"
+    assert view["private_metadata"] == home_view.version
+    assert view["blocks"]
+
+def test_view_is_only_published_again_when_it_changes():
+    stats = {"Messages": 10}
+    home_view = HomeView(corpus_stats=lambda: dict(stats), ttl=60, max_users=10, stats_interval=0.01)
+    first = publish(home_view, opened("U1"))
+    assert publish(home_view, opened("U1")) == None
+    time.sleep(0.02)
+    # the same stats make the same version
+    assert publish(home_view, opened("U1")) == None
+    stats["Messages"] = 11
+    time.sleep(0.02)
+    second = publish(home_view, opened("U1"))
+    assert second["private_metadata"] != first["private_metadata"]
+    assert "*Messages:* 11" in str(second["blocks"])
+    # without stats, then with 10 and 11 messages
+    assert home_view.stats()["builds"] == 3
+
+def test_failing_stats_keep_the_last_view():
+    calls = []
+
+    def corpus_stats():
+        calls.append(1)
+        if len(calls) > 1:
+            raise RuntimeError("Vectara is down")
+        return {"Messages": 10}
+    home_view = HomeView(corpus_stats=corpus_stats, ttl=60, max_users=10, stats_interval=0.01)
+    view = publish(home_view, opened("U1"))
+    time.sleep(0.02)
+    assert publish(home_view, opened("U2")) == view
+
+def test_private_metadata_skips_users_published_to_elsewhere():
+    # say another worker, or this one before a restart
+    view = publish(HomeView(ttl=60, max_users=10, stats_interval=0), opened("U1"))
+    home_view = HomeView(ttl=60, max_users=10, stats_interval=0)
+    assert publish(home_view, opened("U1", view)) == None
+    stale = dict(view, private_metadata="old")
+    assert publish(home_view, opened("U2", stale)) == view
+    assert home_view.stats()["users"] == 2
+
+def test_users_are_published_to_again_after_the_ttl():
+    home_view = HomeView(ttl=0.05, max_users=10, stats_interval=0)
+    assert publish(home_view, opened("U1")) != None
+    assert publish(home_view, opened("U1")) == None
+    time.sleep(0.06)
+    assert publish(home_view, opened("U1")) != None
+
+def test_only_the_last_users_are_remembered():
+    home_view = HomeView(ttl=60, max_users=2, stats_interval=0)
+    for user in ["U1", "U2", "U3"]:
+        publish(home_view, opened(user))
+    assert home_view.stats()["users"] == 2
+    assert publish(home_view, opened("U3")) == None
+    assert publish(home_view, opened("U1")) != None
+    stats = home_view.stats()
+    assert (stats["published"], stats["skipped"]) == (4, 1)
@@ -0,0 +1,44 @@
+import time
+from index_journal import IndexJournal
+
+def test_acked_entries_are_gone(tmp_path):
+    journal = IndexJournal(str(tmp_path / "journal.sqlite3"))
+    first = journal.append({"id": "m1"})
+    journal.append({"id": "m2"})
+    journal.ack(first)
+    assert [request for _, request in journal.due()] == [{"id": "m2"}]
+    assert journal.stats()["pending"] == 1
+
+def test_failed_entries_back_off(tmp_path):
+    journal = IndexJournal(str(tmp_path / "journal.sqlite3"), retry_base=0.2, retry_max=0.3)
+    entry_id = journal.append({"id": "m1"})
+    delays = [journal.retry_later(entry_id) for _ in range(4)]
+    # jittered down to half, and never past retry_max
+    assert 0.1 <= delays[0] <= 0.2
+    assert all(delay <= 0.3 for delay in delays)
+    assert journal.due() == []
+    time.sleep(0.35)
+    assert [entry for entry, _ in journal.due()] == [entry_id]
+
+def test_pending_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal = IndexJournal(path)
+    journal.append({"id": "m1"})
+    journal.close()
+    assert [request for _, request in IndexJournal(path).due()] == [{"id": "m1"}]
+
+def test_oldest_entries_are_evicted(tmp_path):
+    journal = IndexJournal(str(tmp_path / "journal.sqlite3"), max_entries=2)
+    for i in range(3):
+        journal.append({"id": "m{}".format(i)})
+    assert [request['id'] for _, request in journal.due()] == ["m1", "m2"]
+    assert journal.stats()["evicted"] == 1
+
+def test_compaction_returns_space(tmp_path):
+    journal = IndexJournal(str(tmp_path / "journal.sqlite3"))
+    entry_ids = [journal.append({"id": "m{}".format(i), "text": "x" * 1000}) for i in range(500)]
+    grown = journal.stats()["size_bytes"]
+    for entry_id in entry_ids:
+        journal.ack(entry_id)
+    journal.compact()
+    assert journal.stats()["size_bytes"] < grown / 2
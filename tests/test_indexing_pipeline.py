@@ -0,0 +1,76 @@
+import asyncio
+import threading
+from collections import Counter
+from index_journal import IndexJournal
+from indexing_pipeline import IndexingPipeline, AsyncIndexingPipeline
+
+def counting_index_fn(calls, lock):
+    def index_fn(**request):
+        with lock:
+            calls[request['id']] += 1
+        return None, True
+    return index_fn
+
+def test_replay_does_not_resend_live_submissions(tmp_path):
+    calls = Counter()
+    pipeline = IndexingPipeline(index_fn=counting_index_fn(calls, threading.Lock()),
+                                num_workers=4, drain_size=50, max_drain_age=0.001,
+                                journal=IndexJournal(str(tmp_path / "journal.sqlite3")),
+                                replay_interval=0.0005)
+    pipeline.start()
+
+    def submit(first):
+        for i in range(first, first + 1000):
+            pipeline.submit(id="m{}".format(i), text="message {}".format(i))
+
+    submitters = [threading.Thread(target=submit, args=(i * 1000,)) for i in range(4)]
+    for submitter in submitters:
+        submitter.start()
+    for submitter in submitters:
+        submitter.join()
+    pipeline.stop()
+    assert len(calls) == 4000
+    assert [id for id, count in calls.items() if count > 1] == []
+    assert pipeline.journal.stats()["pending"] == 0
+
+def test_failed_messages_are_replayed(tmp_path):
+    attempts = Counter()
+
+    def index_fn(**request):
+        attempts[request['id']] += 1
+        return None, attempts[request['id']] > 1
+
+    journal = IndexJournal(str(tmp_path / "journal.sqlite3"), retry_base=0.01)
+    pipeline = IndexingPipeline(index_fn=index_fn, num_workers=1, max_drain_age=0.001,
+                                journal=journal, replay_interval=0.005)
+    pipeline.submit(id="m1", text="hello")
+    for _ in range(200):
+        if journal.stats()["pending"] == 0:
+            break
+        threading.Event().wait(0.01)
+    pipeline.stop()
+    assert attempts["m1"] == 2
+    assert journal.stats()["retried"] == 1
+
+def test_async_replay_does_not_resend_live_submissions(tmp_path):
+    calls = Counter()
+
+    async def index_fn(**request):
+        calls[request['id']] += 1
+        await asyncio.sleep(0.001)
+        return None, True
+
+    async def run():
+        pipeline = AsyncIndexingPipeline(index_fn, max_in_flight=16,
+                                         journal=IndexJournal(str(tmp_path / "journal.sqlite3")),
+                                         replay_interval=0.0005)
+        await asyncio.gather(*(pipeline.submit(id="m{}".format(i), text="message {}".format(i))
+                               for i in range(1000)))
+        await asyncio.sleep(0.05)
+        await pipeline.stop()
+        return pipeline
+
+    pipeline = asyncio.run(run())
+    assert len(calls) == 1000
+    assert [id for id, count in calls.items() if count > 1] == []
+    assert pipeline.journal.stats()["pending"] == 0
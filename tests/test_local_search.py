@@ -0,0 +1,64 @@
+import asyncio
+import time
+import pytest
+from local_index import LocalIndex
+
+def vectara_results(*ids):
+    return {"responseSet": [{"response": [{"text": "vectara " + id, "score": 1.0, "metadata": [],
+                                           "documentIndex": i} for i, id in enumerate(ids)],
+                             "document": [{"id": id, "metadata": []} for id in ids]}]}
+
+@pytest.fixture
+def searches(bot, monkeypatch, tmp_path, timeouts):
+    """Replaces Vectara with one that has results v0, v1, ... and records
+    each search's ``(start, num_results)``."""
+    calls = []
+
+    def answer(start=0, num_results=10, rerank=False, **kwargs):
+        calls.append((start, num_results))
+        timeouts.append(kwargs.get('timeout'))
+        count = 5 if rerank else num_results
+        return None, vectara_results(*["v{}".format(i) for i in range(start, start + count)])
+
+    async def async_answer(**kwargs):
+        return answer(**kwargs)
+
+    monkeypatch.setattr(bot, 'search', async_answer if asyncio.iscoroutinefunction(bot.search) else answer)
+    monkeypatch.setattr(bot, 'local_index', LocalIndex(str(tmp_path / "local_index.sqlite3")))
+    for i in range(3):
+        bot.local_index.add({"id": "l{}".format(i), "text": "deploy failed with ERR-42 ({})".format(i),
+                             "metadata": {"timestamp": time.time() - 60 * i}})
+    return calls
+
+@pytest.fixture
+def timeouts():
+    """The ``timeout`` each search of ``searches`` was given."""
+    return []
+
+def search_with_local_index(bot, *args, **kwargs):
+    results = bot.search_with_local_index(*args, **kwargs)
+    if asyncio.iscoroutine(results):
+        results = asyncio.run(results)
+    return [document['id'] for document in results['responseSet'][0]['document']]
+
+def test_later_pages_ask_vectara_for_one_result(bot, searches):
+    assert search_with_local_index(bot, "why did the deploy fail", False, [], 0) != []
+    assert search_with_local_index(bot, "why did the deploy fail", False, [], 40) == ["v40"]
+    assert searches == [(0, 1), (40, 1)]
+
+def test_exact_query_pages_past_local_matches(bot, searches):
+    assert search_with_local_index(bot, "ERR-42", False, [], 2)[0].startswith("l")
+    assert search_with_local_index(bot, "ERR-42", False, [], 4) == ["v1"]
+    assert searches == [(1, 1)]
+
+def test_reranked_exact_query_is_followed_by_vectara_results(bot, searches):
+    ids = search_with_local_index(bot, "ERR-42", True, [], 0, rerank_plan={"candidates": 10})
+    assert sorted(ids[:3]) == ["l0", "l1", "l2"]
+    assert ids[3:] == ["v0", "v1", "v2", "v3", "v4"]
+
+def test_searches_only_get_a_deadline_when_asked(bot, searches, timeouts, monkeypatch):
+    search_with_local_index(bot, "why did the deploy fail", False, [], 0)
+    search_with_local_index(bot, "why did the deploy fail", False, [], 0, 2.5)
+    monkeypatch.setattr(bot, 'search_timeout', 10.0)
+    search_with_local_index(bot, "why did the deploy fail", False, [], 0)
+    assert timeouts == [None, 2.5, 10.0]
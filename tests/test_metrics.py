@@ -0,0 +1,23 @@
+from prometheus_client import CollectorRegistry
+import metrics
+from search_cache import SearchCache
+from scheduler import Scheduler
+
+def test_component_stats_are_exported(monkeypatch):
+    monkeypatch.setattr(metrics, '_stats_sources', {})
+    registry = CollectorRegistry()
+    registry.register(metrics._StatsCollector())
+    cache = SearchCache()
+    cache.put("key", {"responseSet": []})
+    cache.get("key")
+    metrics.register_stats("search_cache", cache.stats)
+    metrics.register_stats("scheduler", Scheduler().stats)
+    metrics.register_stats("broken", lambda: 1 / 0)
+
+    def value(component, stat):
+        return registry.get_sample_value('slackbot_component_stats',
+                                         {"component": component, "stat": stat})
+    assert value("search_cache", "hits") == 1.0
+    assert value("search_cache", "entries") == 1.0
+    cache.get("missing")
+    assert value("search_cache", "misses") == 1.0
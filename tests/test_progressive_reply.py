@@ -0,0 +1,146 @@
+import asyncio
+import time
+import pytest
+import progressive_reply
+from progressive_reply import ProgressiveReply, AsyncProgressiveReply
+from scheduler import Scheduler, SLACK_POST_MESSAGE
+
+class FakeClient:
+    def __init__(self, say):
+        self.say = say
+
+    def chat_update(self, **message):
+        self.say.calls.append(("update", message))
+        if self.say.fail_updates:
+            raise RuntimeError("message_not_found")
+
+class FakeSay:
+    """Records what a handler's ``say`` (or with ``response_url``, its
+    ``respond``) was asked to do."""
+
+    def __init__(self, response_url = None, fail_updates = False):
+        self.channel = "C1"
+        self.response_url = response_url
+        self.fail_updates = fail_updates
+        self.client = FakeClient(self)
+        self.calls = []
+
+    def __call__(self, **message):
+        self.calls.append(("say", message))
+        if self.response_url != None and message.get('replace_original') and self.fail_updates:
+            raise RuntimeError("expired_url")
+        return {"channel": "C1", "ts": "{}.0".format(len(self.calls))}
+
+class AsyncFakeClient(FakeClient):
+    async def chat_update(self, **message):
+        return super().chat_update(**message)
+
+class AsyncFakeSay(FakeSay):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.client = AsyncFakeClient(self)
+
+    async def __call__(self, **message):
+        return super().__call__(**message)
+
+@pytest.fixture(autouse=True)
+def unlimited(monkeypatch):
+    monkeypatch.setattr(progressive_reply, 'scheduler', Scheduler({}))
+
+@pytest.fixture(params=["sync", "async"])
+def reply(request):
+    """Makes a ``ProgressiveReply``, or an ``AsyncProgressiveReply`` whose
+    methods are run to completion, for a ``FakeSay``."""
+
+    def make(**kwargs):
+        if request.param == "sync":
+            say = FakeSay(**kwargs)
+            return say, ProgressiveReply(say, SLACK_POST_MESSAGE)
+        say = AsyncFakeSay(**kwargs)
+        reply = AsyncProgressiveReply(say, SLACK_POST_MESSAGE)
+
+        class Runner:
+            def post(self, **message):
+                asyncio.run(reply.post(**message))
+
+            def update(self, **message):
+                asyncio.run(reply.update(**message))
+        return say, Runner()
+    return make
+
+def test_post_then_update_in_place(reply):
+    say, progressive = reply()
+    progressive.post(text="Searching...")
+    progressive.update(text="Results", blocks=[], unfurl_links=False)
+    assert say.calls == [("say", {"text": "Searching..."}),
+                         ("update", {"channel": "C1", "ts": "1.0", "text": "Results", "blocks": []})]
+
+def test_response_url_replies_are_replaced(reply):
+    say, progressive = reply(response_url="https://hooks.slack.com/commands/1")
+    progressive.post(text="Searching...")
+    progressive.update(text="Results")
+    assert say.calls == [("say", {"text": "Searching..."}),
+                         ("say", {"replace_original": True, "text": "Results"})]
+
+def test_failed_update_is_posted_instead(reply):
+    say, progressive = reply(fail_updates=True)
+    progressive.post(text="Searching...")
+    progressive.update(text="Results")
+    assert say.calls[-1] == ("say", {"text": "Results"})
+    assert len(say.calls) == 3
+
+def test_failed_replacement_is_posted_instead(reply):
+    say, progressive = reply(response_url="https://hooks.slack.com/commands/1", fail_updates=True)
+    progressive.post(text="Searching...")
+    progressive.update(text="Results")
+    assert say.calls[-1] == ("say", {"text": "Results"})
+
+@pytest.fixture
+def slow_search(bot, monkeypatch):
+    """Replaces the bot's searches with ones taking ``delays[rerank]``
+    seconds, or raising ``TimeoutError`` past their timeout, and its
+    rendering with the search's name."""
+    delays = {}
+
+    def answer(rerank, timeout):
+        if delays[rerank] > timeout:
+            raise TimeoutError()
+        return "reranked" if rerank else "unreranked"
+
+    def search_and_cache(search_text, rerank, *args, timeout, **kwargs):
+        time.sleep(min(delays[rerank], timeout))
+        return answer(rerank, timeout)
+
+    async def async_search_and_cache(search_text, rerank, *args, timeout, **kwargs):
+        await asyncio.sleep(min(delays[rerank], timeout))
+        return answer(rerank, timeout)
+
+    monkeypatch.setattr(bot, 'search_and_cache', async_search_and_cache
+                        if asyncio.iscoroutinefunction(bot.search_and_cache) else search_and_cache)
+    monkeypatch.setattr(bot, 'render_search_results', lambda results, *args, **kwargs: {"text": results})
+    return delays
+
+def respond_progressively(bot, say, *args, **kwargs):
+    result = bot.progressive_query_and_respond(say, *args, **kwargs)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+    return [(kind, message["text"]) for kind, message in say.calls]
+
+def fake_say_for(bot):
+    return AsyncFakeSay() if asyncio.iscoroutinefunction(bot.progressive_query_and_respond) else FakeSay()
+
+def test_quick_results_are_shown_until_reranked_ones_arrive(bot, slow_search):
+    slow_search.update({False: 0.01, True: 0.2})
+    assert respond_progressively(bot, fake_say_for(bot), "deploy", True) == [
+        ("say", "Searching for *deploy*..."), ("update", "unreranked"), ("update", "reranked")]
+
+def test_reranked_results_arriving_first_are_shown_alone(bot, slow_search):
+    slow_search.update({False: 0.2, True: 0.01})
+    assert respond_progressively(bot, fake_say_for(bot), "deploy", True) == [
+        ("say", "Searching for *deploy*..."), ("update", "reranked")]
+
+def test_searches_past_the_deadline_are_given_up(bot, slow_search, monkeypatch):
+    monkeypatch.setattr(bot, 'query_deadline', 0.1)
+    slow_search.update({False: 0.5, True: 0.5})
+    assert respond_progressively(bot, fake_say_for(bot), "deploy", True) == [
+        ("say", "Searching for *deploy*..."), ("update", "Sorry, the search took too long, please try again")]
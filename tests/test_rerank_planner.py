@@ -0,0 +1,80 @@
+import threading
+from rerank_planner import RerankPlanner, extend_pool
+
+def results(*hits):
+    """A Vectara response of ``(document_id, text, score)`` hits, in order."""
+    documents = []
+    responses = []
+    for document_id, text, score in hits:
+        if document_id not in documents:
+            documents.append(document_id)
+        responses.append({"text": text, "score": score, "documentIndex": documents.index(document_id)})
+    return {"responseSet": [{"response": responses, "document": [{"id": id} for id in documents]}]}
+
+def planner(**options):
+    return RerankPlanner(**dict(dict(budget=1.5, initial=10, maximum=100), **options))
+
+def test_first_plan_uses_the_initial_pool():
+    assert planner().plan() == {"candidates": 10, "sizing": "initial"}
+
+def test_pool_fits_the_budget():
+    reranker = planner()
+    reranker.observe(10, 0.5, reranked=False)
+    reranker.observe(10, 0.7, reranked=True)
+    # 0.02s a candidate on top of 0.5s, in a 1.5s budget
+    assert reranker.plan() == {"candidates": 50, "sizing": "budget"}
+
+def test_skip_margin_query_comes_out_of_the_budget():
+    reranker = planner(skip_margin=0.5)
+    reranker.observe(10, 0.5, reranked=False)
+    reranker.observe(10, 0.7, reranked=True)
+    assert reranker.plan() == {"candidates": 25, "sizing": "budget"}
+
+def plan_in_time(reranker, **kwargs):
+    """``reranker.plan``, failing rather than hanging if it doesn't return."""
+    plans = []
+    thread = threading.Thread(target=lambda: plans.append(reranker.plan(**kwargs)), daemon=True)
+    thread.start()
+    thread.join(5)
+    assert plans, "plan() didn't return"
+    return plans[0]
+
+def test_spent_budget_still_plans_the_smallest_pool():
+    reranker = planner()
+    for _ in range(3):
+        reranker.observe(10, 3.0, reranked=False)
+    reranker.observe(10, 4.0, reranked=True)
+    assert plan_in_time(reranker)["candidates"] == 5
+    assert plan_in_time(reranker, page=12)["candidates"] == 20
+
+def test_slow_candidates_still_plan_the_smallest_pool():
+    reranker = planner()
+    reranker.observe(1, 10.0, reranked=True)
+    assert plan_in_time(reranker)["candidates"] == 5
+
+def test_pool_reaching_the_page_isnt_widened():
+    reranker = planner()
+    pool = results(*[("d{}".format(i), "t", 1.0) for i in range(10)])
+    reranker.record("query", {"candidates": 10, "sizing": "initial", "reranked": True}, pool)
+    assert reranker.plan(page=5, search_results=pool) == None
+    assert reranker.plan(page=10, search_results=pool) == {"candidates": 20, "sizing": "widened"}
+
+def test_short_pool_holds_every_result():
+    reranker = planner()
+    pool = results(("d0", "t", 1.0))
+    reranker.record("query", {"candidates": 10, "sizing": "initial", "reranked": True}, pool)
+    assert reranker.plan(page=3, search_results=pool) == None
+
+def test_should_skip_on_a_clear_winner():
+    assert planner(skip_margin=0.3).should_skip(results(("a", "x", 0.9), ("b", "y", 0.5)))
+    assert not planner(skip_margin=0.3).should_skip(results(("a", "x", 0.9), ("b", "y", 0.7)))
+    assert not planner(skip_margin=0.3).should_skip(results(("a", "x", 0.9)))
+    assert not planner().should_skip(results(("a", "x", 0.9), ("b", "y", 0.1)))
+
+def test_extend_pool_keeps_shown_results_first():
+    previous = results(("a", "one", 0.9), ("b", "two", 0.8))
+    widened = results(("b", "two", 0.95), ("c", "three", 0.9), ("a", "one", 0.5), ("a", "four", 0.4))
+    pool = extend_pool(previous, widened)
+    response_set = pool["responseSet"][0]
+    hits = [(response_set["document"][r["documentIndex"]]["id"], r["text"]) for r in response_set["response"]]
+    assert hits == [("a", "one"), ("b", "two"), ("c", "three"), ("a", "four")]
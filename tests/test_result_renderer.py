@@ -0,0 +1,28 @@
+import pytest
+from benchmarks.render_benchmark import legacy_escape_markdown
+from result_renderer import escape_markdown
+
+SAMPLES = [
+    "plain text",
+    "**bold** and _italic_ and ~strike~ and `code` and |pipes|",
+    "a lone * and a lone _",
+    "back\\slash \\*escaped\\*",
+    "> quoted line",
+    ">>> quoted block",
+    "see [the docs](https://example.com/a_b) for more",
+    "https://example.com/some_path_with*stars and after_",
+    "<https://example.com/x_y|label> and <@U123> and <#C123|general>",
+    "steam://run/12_34 then *bold*",
+    "url at the end https://example.com/a_b.",
+    "***__~~``||",
+    "[unclosed (link",
+    "",
+]
+
+@pytest.mark.parametrize("text", SAMPLES)
+@pytest.mark.parametrize("options", [{}, {"ignore_links": False}, {"as_needed": True}])
+def test_escape_matches_the_legacy_escaper(text, options):
+    assert escape_markdown(text, **options) == legacy_escape_markdown(text, **options)
+
+def test_links_are_left_alone():
+    assert escape_markdown("https://example.com/a_b *x*") == "https://example.com/a_b \\*x\\*"
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import time
+from scheduler import (Scheduler, per_channel, slack_endpoint, INTERACTIVE, ACTION, INDEXING,
+                       SLACK_POST_MESSAGE)
+
+def acquire_in_order(scheduler, endpoint, priorities):
+    """Queues one thread per priority on ``endpoint`` and returns the order they got through."""
+    served = []
+    threads = []
+    for priority in priorities:
+        thread = threading.Thread(target=lambda priority=priority: served.append(
+            (scheduler.acquire(endpoint, priority), priority)))
+        thread.start()
+        threads.append(thread)
+        # wait until it's queued, so arrival order is the order above
+        while len(scheduler._endpoint(endpoint).waiters) < len(threads):
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join(5)
+    return [priority for _, priority in served]
+
+def test_waiters_are_served_by_priority_then_arrival():
+    scheduler = Scheduler({"endpoint": (50, 1)})
+    scheduler.backoff("endpoint", 0.1)
+    order = acquire_in_order(scheduler, "endpoint", [INDEXING, ACTION, INTERACTIVE, INDEXING])
+    assert order == [INTERACTIVE, ACTION, INDEXING, INDEXING]
+    assert scheduler.stats()["waits"]["indexing"]["calls"] == 2
+
+def test_each_channel_gets_the_endpoints_rate():
+    scheduler = Scheduler({SLACK_POST_MESSAGE: (10, 1)})
+    assert scheduler.acquire(per_channel(SLACK_POST_MESSAGE, "C1")) < 0.05
+    assert scheduler.acquire(per_channel(SLACK_POST_MESSAGE, "C2")) < 0.05
+    assert scheduler.acquire(per_channel(SLACK_POST_MESSAGE, "C1")) >= 0.05
+
+def test_backoff_pauses_the_endpoint_and_its_channels():
+    scheduler = Scheduler({SLACK_POST_MESSAGE: (100, 5)})
+    scheduler.acquire(per_channel(SLACK_POST_MESSAGE, "C1"))
+    # Slack's 429 names the endpoint, not the channel
+    scheduler.backoff(slack_endpoint("https://slack.com/api/chat.postMessage"), 0.2)
+    assert scheduler.acquire(per_channel(SLACK_POST_MESSAGE, "C1")) >= 0.15
+    # and channels that haven't posted yet
+    scheduler.backoff(SLACK_POST_MESSAGE, 0.2)
+    assert scheduler.acquire(per_channel(SLACK_POST_MESSAGE, "C2")) >= 0.15
+    assert scheduler.acquire(SLACK_POST_MESSAGE) < 0.05
+    assert scheduler.stats()["throttled"] == {SLACK_POST_MESSAGE: 2}
+
+def test_backoff_holds_async_callers_too():
+    scheduler = Scheduler({SLACK_POST_MESSAGE: (100, 5)})
+    scheduler.backoff(SLACK_POST_MESSAGE, 0.2)
+    waited = asyncio.run(scheduler.acquire_async(per_channel(SLACK_POST_MESSAGE, "C1")))
+    assert waited >= 0.15
+
+def test_unlisted_endpoints_are_unlimited():
+    scheduler = Scheduler({})
+    assert sum(scheduler.acquire("endpoint") for _ in range(100)) < 0.05
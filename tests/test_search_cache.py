@@ -0,0 +1,34 @@
+import time
+from search_cache import SearchCache
+
+def test_repeated_query_is_a_hit():
+    cache = SearchCache(ttl=60, max_entries=10, max_bytes=10000)
+    cache.put(cache.make_key("Who went to Hawaii?", [], False), {"results": 1})
+    assert cache.get(cache.make_key("who went to  hawaii", [], False)) == {"results": 1}
+
+def test_tag_invalidation_drops_only_that_channel():
+    cache = SearchCache(ttl=60, max_entries=10, max_bytes=10000)
+    general = "doc.channel = 'C1'"
+    cache.put("filtered", {"results": 1}, tags=[general])
+    cache.put("other", {"results": 2}, tags=["doc.channel = 'C2'"])
+    cache.put("unfiltered", {"results": 3}, tags=[None])
+    cache.invalidate_tag(general)
+    assert cache.get("filtered") == None
+    assert cache.get("other") == {"results": 2}
+    assert cache.get("unfiltered") == {"results": 3}
+    assert cache.stats()["invalidations"] == 1
+
+def test_entries_expire():
+    cache = SearchCache(ttl=0.05, max_entries=10, max_bytes=10000)
+    cache.put("key", {"results": 1})
+    time.sleep(0.1)
+    assert cache.get("key") == None
+
+def test_least_recently_used_is_evicted():
+    cache = SearchCache(ttl=60, max_entries=2, max_bytes=10000)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") == None and cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,63 @@
+import asyncio
+import vectara_async
+import vectara_functions
+from vectara_async import AsyncTokenManager, AsyncVectaraTransport, TransportResponse
+from vectara_functions import TokenManager, VectaraTransport, auth_headers
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+def issuing_tokens():
+    issued = []
+
+    def fetch():
+        issued.append("token-{}".format(len(issued)))
+        return {"access_token": issued[-1], "expires_in": 3600}
+    return issued, fetch
+
+def test_rejected_token_is_replaced_and_the_call_retried(monkeypatch):
+    issued, fetch = issuing_tokens()
+    manager = TokenManager(fetch=fetch, background_refresh=False)
+    monkeypatch.setattr(vectara_functions, 'token_manager', manager)
+    sent = []
+
+    def post(url, endpoint, data, headers):
+        sent.append(headers["Authorization"])
+        return Response(401 if len(sent) == 1 else 200)
+
+    transport = VectaraTransport(base_url="http://vectara.invalid")
+    monkeypatch.setattr(transport, '_post', post)
+    response = transport.post("/v1/query", "{}", auth_headers(manager.get_token(), 1))
+    assert response.status_code == 200
+    assert sent == ["Bearer token-0", "Bearer token-1"]
+
+def test_token_is_only_dropped_if_still_cached():
+    issued, fetch = issuing_tokens()
+    manager = TokenManager(fetch=fetch, background_refresh=False)
+    manager.get_token()
+    manager.invalidate("token-0")
+    assert manager.get_token() == "token-1"
+    manager.invalidate("token-0")
+    assert manager.get_token() == "token-1"
+
+def test_async_rejected_token_is_replaced_and_the_call_retried(monkeypatch):
+    issued, fetch = issuing_tokens()
+
+    async def async_fetch():
+        return fetch()
+    manager = AsyncTokenManager(fetch=async_fetch, background_refresh=False)
+    monkeypatch.setattr(vectara_async, 'token_manager', manager)
+    sent = []
+
+    async def post(url, endpoint, data, headers):
+        sent.append(headers["Authorization"])
+        return TransportResponse(401 if len(sent) == 1 else 200, "", "{}")
+
+    async def run():
+        transport = AsyncVectaraTransport(base_url="http://vectara.invalid")
+        monkeypatch.setattr(transport, '_post', post)
+        return await transport.post("/v1/query", "{}", auth_headers(await manager.get_token(), 1))
+
+    assert asyncio.run(run()).status_code == 200
+    assert sent == ["Bearer token-0", "Bearer token-1"]
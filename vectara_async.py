@@ -0,0 +1,374 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import aiohttp
+from scheduler import scheduler, retry_after_seconds
+from hedging import Hedger
+from rerank_planner import RerankPlanner, adaptive_reranking
+import metrics
+from vectara_functions import (auth_headers, bearer_token, build_delete_request, build_fanout_requests,
+                               build_index_request, build_search_request, merge_search_results,
+                               search_corpus_ids, search_deadline, token_endpoint)
+
+class TransportResponse:
+    """The parts of an HTTP response callers look at, read before the connection is released."""
+
+    def __init__(self, status_code: int, reason: str, text: str):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+    @property
+    def content(self):
+        return self.text.encode()
+
+    def __repr__(self):
+        return "<TransportResponse [{}]>".format(self.status_code)
+
+class AsyncVectaraTransport:
+    """The asyncio counterpart of ``VectaraTransport``, built on aiohttp.
+
+    One ``ClientSession`` with a bounded, keep-alive connector is shared by
+    token fetches, searches and indexing.  It is created lazily because
+    aiohttp sessions have to be created inside the running event loop.
+    """
+
+    def __init__(self, base_url: str = None, limit: int = None,
+                 limit_per_host: int = None, connect_timeout: float = None,
+                 read_timeout: float = None, keepalive_timeout: float = None,
+                 max_rate_limit_retries: int = 3):
+        if base_url == None:
+            base_url = os.environ.get('VECTARA_API_URL', "https://api.vectara.io")
+        if limit == None:
+            limit = int(os.environ.get('VECTARA_POOL_CONNECTIONS', 4)) * int(os.environ.get('VECTARA_POOL_MAXSIZE', 16))
+        if limit_per_host == None:
+            limit_per_host = int(os.environ.get('VECTARA_POOL_MAXSIZE', 16))
+        if connect_timeout == None:
+            connect_timeout = float(os.environ.get('VECTARA_CONNECT_TIMEOUT', 5))
+        if read_timeout == None:
+            read_timeout = float(os.environ.get('VECTARA_READ_TIMEOUT', 30))
+        if keepalive_timeout == None:
+            keepalive_timeout = float(os.environ.get('VECTARA_KEEPALIVE_TIMEOUT', 60))
+        self.base_url = base_url.rstrip('/')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session == None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def post(self, path: str, data: str, headers: dict, base_url: str = None) -> TransportResponse:
+        """POSTs ``data`` to ``path`` relative to ``base_url``, see ``VectaraTransport.post``."""
+        url = "{}{}".format((base_url or self.base_url).rstrip('/'), path)
+        result = await self._post(url, "vectara:" + path, data, headers)
+        token = bearer_token(headers)
+        if result.status_code == 401 and token != None:
+            logging.warning("Vectara rejected the access token, fetching a new one")
+            token_manager.invalidate(token)
+            headers = dict(headers, Authorization="Bearer {}".format(await token_manager.get_token()))
+            result = await self._post(url, "vectara:" + path, data, headers)
+        return result
+
+    async def _post(self, url: str, endpoint: str, data: str, headers: dict) -> TransportResponse:
+        for _ in range(self.max_rate_limit_retries + 1):
+            await scheduler.acquire_async(endpoint)
+            async with self.session.post(url, data=data, headers=headers) as response:
+                result = TransportResponse(response.status, response.reason, await response.text())
+                if response.status != 429:
+                    break
+                scheduler.backoff(endpoint, retry_after_seconds(response.headers))
+        return result
+
+    async def close(self):
+        if self._session != None:
+            await self._session.close()
+            self._session = None
+
+transport = AsyncVectaraTransport()
+
+def set_transport(new_transport: AsyncVectaraTransport):
+    """Swaps the transport used for searching and indexing, returning the old one."""
+    global transport
+    old_transport = transport
+    transport = new_transport
+    return old_transport
+
+async def _fetch_jwt_token(auth_url: str = None):
+    """Connect to the server and get a JWT token.
+
+    Returns the full token dict, including ``expires_in``."""
+    auth = aiohttp.BasicAuth(os.environ.get('VECTARA_APP_ID'), os.environ.get('VECTARA_APP_SECRET'))
+    async with transport.session.post(token_endpoint(auth_url),
+                                      data={"grant_type": "client_credentials"},
+                                      auth=auth) as response:
+        response.raise_for_status()
+        return await response.json()
+
+class AsyncTokenManager:
+    """The asyncio counterpart of ``TokenManager``.
+
+    Concurrent callers await the same in-flight fetch, and a background task
+    refreshes the token ``refresh_margin`` seconds before it expires.
+    """
+
+    def __init__(self, fetch=_fetch_jwt_token, refresh_margin: float = None,
+                 background_refresh: bool = True):
+        if refresh_margin == None:
+            refresh_margin = float(os.environ.get('VECTARA_TOKEN_REFRESH_MARGIN', 60))
+        self._fetch = fetch
+        self._refresh_margin = refresh_margin
+        self._background_refresh = background_refresh
+        self._token = None
+        self._refresh_at = 0.0
+        self._in_flight = None
+        self._refresh_task = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    async def get_token(self) -> str:
+        """Returns a valid access token, fetching one only if none is cached."""
+        if self._token != None and time.monotonic() < self._refresh_at:
+            self.hits += 1
+            return self._token
+        if self._in_flight == None:
+            self.misses += 1
+            self._in_flight = asyncio.ensure_future(self._do_fetch())
+        else:
+            # somebody else's fetch is serving us
+            self.hits += 1
+        # shield, so one caller being cancelled doesn't cancel everyone's fetch
+        return await asyncio.shield(self._in_flight)
+
+    async def _do_fetch(self) -> str:
+        try:
+            token = await self._fetch()
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._in_flight = None
+        expires_in = float(token.get('expires_in') or 3600)
+        # Never leave less than half the lifetime, even with short lived tokens
+        margin = min(self._refresh_margin, expires_in / 2)
+        self._token = token['access_token']
+        self._refresh_at = time.monotonic() + expires_in - margin
+        if self._background_refresh:
+            if self._refresh_task != None:
+                self._refresh_task.cancel()
+            self._refresh_task = asyncio.ensure_future(self._refresh_after(expires_in - margin))
+        return self._token
+
+    async def _refresh_after(self, delay: float):
+        await asyncio.sleep(delay)
+        # detach, so the fetch scheduling the next refresh doesn't cancel us
+        self._refresh_task = None
+        if self._in_flight != None:
+            return
+        self.refreshes += 1
+        self._in_flight = asyncio.ensure_future(self._do_fetch())
+        try:
+            await self._in_flight
+        except Exception:
+            # The cached token is now stale, so the next caller fetches inline
+            logging.exception("Background refresh of the Vectara token failed")
+            self._refresh_at = 0.0
+
+    def invalidate(self, token: str = None):
+        """Drops the cached token, see ``TokenManager.invalidate``."""
+        if token != None and token != self._token:
+            return
+        self._token = None
+        self._refresh_at = 0.0
+
+    async def close(self):
+        """Stops the background refresh task."""
+        if self._refresh_task != None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+token_manager = AsyncTokenManager()
+
+async def _get_jwt_token():
+    """Returns a cached JWT token, see ``AsyncTokenManager``."""
+    return await token_manager.get_token()
+
+@metrics.timed("search_raw")
+async def search_raw(headers: dict, data: dict):
+    """ Takes headers and the JSON body and performs a search against Vectara """
+    payload = json.dumps(data)
+    logging.debug("Raw search payload: %s",payload)
+    metrics.observe_payload("query_request", len(payload))
+
+    with metrics.stage("query_reranked" if 'rerankingConfig' in data['query'][0] else "query"):
+        response = await transport.post("/v1/query", data=payload, headers=headers)
+    content = response.content
+    metrics.observe_payload("query_response", len(content))
+    with metrics.stage("parse"):
+        search_results = json.loads(content)
+    return data, search_results
+
+async def _search_corpus(headers: dict, data: dict):
+    """ The asyncio counterpart of ``vectara_functions._search_corpus`` """
+    corpus_id = data['query'][0]['corpus_key'][0]['corpus_id']
+    try:
+        _, search_results = await search_raw(headers, data)
+    except Exception:
+        logging.exception("Searching corpus %d failed", corpus_id)
+        return None
+    if 'responseSet' not in search_results:
+        logging.error("Searching corpus %d failed: %s", corpus_id, search_results)
+        return None
+    return search_results
+
+async def search_fanout(headers: dict, data_dict: dict, corpus_ids: list, deadline: float):
+    """ The asyncio counterpart of ``vectara_functions.search_fanout``, which
+    cancels the requests still running at the deadline """
+    tasks = [asyncio.ensure_future(_search_corpus(headers, request))
+             for request in build_fanout_requests(data_dict, corpus_ids)]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    results = [task.result() if task in done else None for task in tasks]
+    for corpus_id, task in zip(corpus_ids, tasks):
+        if task in pending:
+            logging.warning("Corpus %d didn't answer within %.2fs", corpus_id, deadline)
+    return merge_search_results(data_dict, corpus_ids, results)
+
+hedger = Hedger()
+reranker = RerankPlanner() if adaptive_reranking() else None
+
+async def _query(headers: dict, data_dict: dict, deadline: float = None):
+    """ The asyncio counterpart of ``vectara_functions._query`` """
+    corpus_ids = search_corpus_ids()
+    if len(corpus_ids) > 1:
+        fanout_deadline = search_deadline()
+        if deadline != None:
+            fanout_deadline = min(fanout_deadline, deadline - time.monotonic())
+        return data_dict, await search_fanout(headers, data_dict, corpus_ids, fanout_deadline)
+    if deadline != None:
+        kind = "query_reranked" if 'rerankingConfig' in data_dict['query'][0] else "query"
+        return await hedger.call_async(kind, search_raw, headers, data_dict, deadline=deadline)
+    return await search_raw(headers, data_dict)
+
+async def _planned_search(headers: dict, search_text: str, metadata_filters: list,
+                          rerank_plan: dict, deadline: float = None):
+    """ The asyncio counterpart of ``vectara_functions._planned_search`` """
+    decision = dict(rerank_plan, reranked=True)
+    candidates = decision['candidates']
+    if reranker.skip_margin != None:
+        # build_search_request appends to the filter list, and it's needed again
+        data_dict = build_search_request(search_text, False, candidates,
+                                         metadata_filters=None if metadata_filters == None else list(metadata_filters))
+        started = time.monotonic()
+        data_dict, search_results = await _query(headers, data_dict, deadline)
+        if 'responseSet' not in search_results:
+            return data_dict, search_results
+        reranker.observe(candidates, time.monotonic() - started, reranked=False)
+        decision['margin'] = reranker.top_score_margin(search_results)
+        decision['reranked'] = not reranker.should_skip(search_results)
+    if decision['reranked']:
+        data_dict = build_search_request(search_text, True, candidates, metadata_filters=metadata_filters,
+                                         rerank_candidates=candidates)
+        started = time.monotonic()
+        data_dict, search_results = await _query(headers, data_dict, deadline)
+        if 'responseSet' not in search_results:
+            return data_dict, search_results
+        reranker.observe(candidates, time.monotonic() - started, reranked=True)
+    reranker.record(search_text, decision, search_results)
+    return data_dict, search_results
+
+async def search(search_text: str, rerank: bool, num_results: int, metadata_filters: list = None,
+                 start: int = 0, timeout: float = None, rerank_plan: dict = None):
+    """ The asyncio counterpart of ``vectara_functions.search`` """
+    deadline = None
+    if timeout != None:
+        deadline = time.monotonic() + timeout
+    with metrics.stage("token"):
+        jwt_token = await _get_jwt_token()
+    api_key_header = auth_headers(jwt_token, os.environ.get('VECTARA_CUSTOMER_ID'))
+    if rerank and rerank_plan != None and reranker != None:
+        return await _planned_search(api_key_header, search_text, metadata_filters, rerank_plan, deadline)
+    data_dict = build_search_request(search_text, rerank, num_results,
+                                     metadata_filters=metadata_filters, start=start)
+    return await _query(api_key_header, data_dict, deadline)
+
+@metrics.timed("index_message")
+async def index_message(customer_id: int, corpus_id: int, text: str,
+                        id: str, title: str, metadata: dict = None,
+                        idx_address: str = None, upsert: bool = False,
+                        sections: list = None):
+    """ The asyncio counterpart of ``vectara_functions.index_message`` """
+    if upsert:
+        response, success = await delete_document(customer_id, corpus_id, id, idx_address=idx_address)
+        if not success:
+            return response, False
+    with metrics.stage("token"):
+        jwt_token = await _get_jwt_token()
+    post_headers = auth_headers(jwt_token, customer_id)
+    payload = json.dumps(build_index_request(customer_id, corpus_id, text, id, title, metadata,
+                                             sections))
+
+    logging.debug("Raw indexing request: %s",payload)
+    metrics.observe_payload("index_request", len(payload))
+
+    with metrics.stage("index"):
+        response = await transport.post(
+            "/v1/index",
+            data=payload,
+            headers=post_headers,
+            base_url=f"https://{idx_address}" if idx_address != None else None)
+    logging.debug("Raw indexing response: %s", response)
+
+    if response.status_code != 200:
+        metrics.count_error()
+        logging.error("REST upload failed with code %d, reason %s, text %s",
+                       response.status_code,
+                       response.reason,
+                       response.text)
+        return response, False
+    return response, True
+
+@metrics.timed("delete_document")
+async def delete_document(customer_id: int, corpus_id: int, id: str,
+                          idx_address: str = None):
+    """ The asyncio counterpart of ``vectara_functions.delete_document`` """
+    with metrics.stage("token"):
+        jwt_token = await _get_jwt_token()
+    post_headers = auth_headers(jwt_token, customer_id)
+    payload = json.dumps(build_delete_request(customer_id, corpus_id, id))
+
+    with metrics.stage("delete"):
+        response = await transport.post(
+            "/v1/delete-doc",
+            data=payload,
+            headers=post_headers,
+            base_url=f"https://{idx_address}" if idx_address != None else None)
+    logging.debug("Raw delete response: %s", response)
+
+    if response.status_code != 200:
+        metrics.count_error()
+        logging.error("Deleting %s failed with code %d, reason %s, text %s",
+                      id, response.status_code, response.reason, response.text)
+        return response, False
+    return response, True
@@ -1,47 +1,264 @@
+import contextvars
+import copy
 import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
+from requests.adapters import HTTPAdapter
 from authlib.integrations.requests_client import OAuth2Session
+from scheduler import scheduler, retry_after_seconds
+from hedging import Hedger
+from rerank_planner import RerankPlanner, adaptive_reranking
+import metrics
 
-def _get_jwt_token(auth_url: str = None):
-    """Connect to the server and get a JWT token."""
-
+def token_endpoint(auth_url: str = None) -> str:
+    """Returns the OAuth token endpoint for the configured Vectara customer."""
     if os.environ.get('VECTARA_AUTH_URL') != None:
         auth_url = os.environ.get('VECTARA_AUTH_URL')
     if auth_url == None:
       auth_url = "https://vectara-prod-{}.auth.us-west-2.amazoncognito.com".format(os.environ.get('VECTARA_CUSTOMER_ID'))
+    return f"{auth_url}/oauth2/token"
+
+def _fetch_jwt_token(auth_url: str = None):
+    """Connect to the server and get a JWT token.
 
-    token_endpoint = f"{auth_url}/oauth2/token"
+    Returns the full token dict, including ``expires_in``."""
     session = OAuth2Session(
         os.environ.get('VECTARA_APP_ID'), os.environ.get('VECTARA_APP_SECRET'), scope="")
-    token = session.fetch_token(token_endpoint, grant_type="client_credentials")
-    return token["access_token"]
+    token = session.fetch_token(token_endpoint(auth_url), grant_type="client_credentials")
+    return token
+
+class TokenManager:
+    """Caches the Vectara OAuth token and refreshes it shortly before it expires.
+
+    Concurrent callers share a single in-flight fetch: the first caller to
+    find the cache empty fetches the token and everybody else waits on it.
+    Once a token is cached, a background timer refreshes it ``refresh_margin``
+    seconds before ``expires_in`` so callers never hit the auth endpoint.
+    """
+
+    def __init__(self, fetch=_fetch_jwt_token, refresh_margin: float = None,
+                 background_refresh: bool = True):
+        if refresh_margin == None:
+            refresh_margin = float(os.environ.get('VECTARA_TOKEN_REFRESH_MARGIN', 60))
+        self._fetch = fetch
+        self._refresh_margin = refresh_margin
+        self._background_refresh = background_refresh
+        self._cond = threading.Condition()
+        self._token = None
+        self._refresh_at = 0.0
+        self._fetching = False
+        self._timer = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def get_token(self) -> str:
+        """Returns a valid access token, fetching one only if none is cached."""
+        with self._cond:
+            while True:
+                if self._token != None and time.monotonic() < self._refresh_at:
+                    self.hits += 1
+                    return self._token
+                if not self._fetching:
+                    break
+                # Somebody else is already talking to the auth endpoint
+                self._cond.wait()
+            self.misses += 1
+            self._fetching = True
+        return self._do_fetch()
+
+    def _do_fetch(self) -> str:
+        try:
+            token = self._fetch()
+        except Exception:
+            with self._cond:
+                self.failures += 1
+                self._fetching = False
+                self._cond.notify_all()
+            raise
+        expires_in = float(token.get('expires_in') or 3600)
+        # Never leave less than half the lifetime, even with short lived tokens
+        margin = min(self._refresh_margin, expires_in / 2)
+        with self._cond:
+            self._token = token['access_token']
+            self._refresh_at = time.monotonic() + expires_in - margin
+            self._fetching = False
+            self._cond.notify_all()
+            if self._background_refresh:
+                self._schedule_refresh(expires_in - margin)
+        return self._token
+
+    def _schedule_refresh(self, delay: float):
+        if self._timer != None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self):
+        """Runs on the timer thread and replaces the cached token."""
+        with self._cond:
+            if self._fetching:
+                return
+            self._fetching = True
+            self.refreshes += 1
+        try:
+            self._do_fetch()
+        except Exception:
+            # The cached token is now stale, so the next caller fetches inline
+            logging.exception("Background refresh of the Vectara token failed")
+            with self._cond:
+                self._refresh_at = 0.0
+
+    def invalidate(self, token: str = None):
+        """Drops the cached token, e.g. after the API rejected it with a 401.
+
+        With ``token``, only if that's still the cached one, so callers that
+        were all rejected together don't drop the token the first replaced it with.
+        """
+        with self._cond:
+            if token != None and token != self._token:
+                return
+            self._token = None
+            self._refresh_at = 0.0
+
+    def close(self):
+        """Stops the background refresh timer."""
+        with self._cond:
+            if self._timer != None:
+                self._timer.cancel()
+                self._timer = None
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+            }
+
+token_manager = TokenManager()
+
+def _get_jwt_token():
+    """Returns a cached JWT token, see ``TokenManager``."""
+    return token_manager.get_token()
 
+def bearer_token(headers: dict):
+    """The access token ``auth_headers`` put in ``headers``, or None."""
+    authorization = headers.get("Authorization") or ""
+    if not authorization.startswith("Bearer "):
+        return None
+    return authorization[len("Bearer "):]
+
+class VectaraTransport:
+    """A pooled, keep-alive HTTP transport shared by searching and indexing.
+
+    Every request reuses connections from one ``requests.Session`` instead of
+    doing a TCP+TLS handshake per message.  Point ``base_url`` at a local
+    server (or call ``set_transport``) to run against a stand-in.
+    """
+
+    def __init__(self, base_url: str = None, pool_connections: int = None,
+                 pool_maxsize: int = None, connect_timeout: float = None,
+                 read_timeout: float = None, max_rate_limit_retries: int = 3):
+        if base_url == None:
+            base_url = os.environ.get('VECTARA_API_URL', "https://api.vectara.io")
+        if pool_connections == None:
+            pool_connections = int(os.environ.get('VECTARA_POOL_CONNECTIONS', 4))
+        if pool_maxsize == None:
+            pool_maxsize = int(os.environ.get('VECTARA_POOL_MAXSIZE', 16))
+        if connect_timeout == None:
+            connect_timeout = float(os.environ.get('VECTARA_CONNECT_TIMEOUT', 5))
+        if read_timeout == None:
+            read_timeout = float(os.environ.get('VECTARA_READ_TIMEOUT', 30))
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.session = requests.Session()
+        # pool_connections is the number of hosts kept, pool_maxsize the
+        # number of connections kept per host. block=True makes callers wait
+        # for a free connection rather than opening throwaway ones.
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+
+    def post(self, path: str, data: str, headers: dict, base_url: str = None):
+        """POSTs ``data`` to ``path`` relative to ``base_url``.
+
+        The call waits its turn in the scheduler, and a 429 pauses the
+        endpoint for everybody before being retried.  A 401 means the token
+        in ``headers`` was revoked or expired early, so it's dropped and the
+        call retried once with a new one."""
+        url = "{}{}".format((base_url or self.base_url).rstrip('/'), path)
+        response = self._post(url, "vectara:" + path, data, headers)
+        token = bearer_token(headers)
+        if response.status_code == 401 and token != None:
+            logging.warning("Vectara rejected the access token, fetching a new one")
+            token_manager.invalidate(token)
+            headers = dict(headers, Authorization="Bearer {}".format(token_manager.get_token()))
+            response = self._post(url, "vectara:" + path, data, headers)
+        return response
+
+    def _post(self, url: str, endpoint: str, data: str, headers: dict):
+        for _ in range(self.max_rate_limit_retries + 1):
+            scheduler.acquire(endpoint)
+            response = self.session.post(url, data=data, headers=headers,
+                                         verify=True, timeout=self.timeout)
+            if response.status_code != 429:
+                break
+            scheduler.backoff(endpoint, retry_after_seconds(response.headers))
+        return response
+
+    def close(self):
+        self.session.close()
+
+transport = VectaraTransport()
+
+def set_transport(new_transport: VectaraTransport):
+    """Swaps the transport used for searching and indexing, returning the old one."""
+    global transport
+    old_transport = transport
+    transport = new_transport
+    return old_transport
+
+@metrics.timed("search_raw")
 def search_raw(headers: dict, data: dict):
     """ Takes headers and the JSON body and performs a search against Vectara """
     payload = json.dumps(data)
     logging.debug("Raw search payload: %s",payload)
-    
-    response = requests.post(
-        "https://api.vectara.io/v1/query",
-        data=payload,
-        verify=True,
-        headers=headers)
-    search_results = json.loads(response.content)
+    metrics.observe_payload("query_request", len(payload))
+
+    # the reranker runs inside Vectara, so reranked queries are their own stage
+    with metrics.stage("query_reranked" if 'rerankingConfig' in data['query'][0] else "query"):
+        response = transport.post("/v1/query", data=payload, headers=headers)
+    content = response.content
+    metrics.observe_payload("query_response", len(content))
+    with metrics.stage("parse"):
+        search_results = json.loads(content)
     return data, search_results
 
-def search(search_text: str, rerank: bool, num_results: int, metadata_filters: list = None):
-    """ Takes headers and the JSON body and performs a search against Vectara """
-    jwt_token = _get_jwt_token()
-    api_key_header = {
-        "Authorization": f"Bearer {jwt_token}",
-        "customer-id": os.environ.get('VECTARA_CUSTOMER_ID')
-    }
+def build_search_request(search_text: str, rerank: bool, num_results: int,
+                         metadata_filters: list = None, start: int = 0,
+                         rerank_candidates: int = 100):
+    """ Builds the JSON body of a Vectara query
+
+    Reranked queries fetch the top ``rerank_candidates`` for paging locally,
+    whatever ``start`` and ``num_results`` are.
+    """
     data_dict = {
         "query": [
             {
                 "query": search_text,
+                "start": start,
                 "num_results": num_results,
                 "corpus_key": [
                     {
@@ -56,49 +273,260 @@ def search(search_text: str, rerank: bool, num_results: int, metadata_filters: l
     if rerank == True:
         data_dict['query'][0]['rerankingConfig'] = { "reranker_id": 272725717 }
         data_dict['query'][0]['start'] = 0
-        data_dict['query'][0]['num_results'] = 100
+        data_dict['query'][0]['num_results'] = rerank_candidates
     if metadata_filters != None:
         metadata_filters.extend(['part.is_title IS NULL'])
         filter_string = " AND ".join(metadata_filters)
         data_dict['query'][0]['corpus_key'][0]['metadata_filter'] = filter_string
-    return search_raw(api_key_header, data_dict)
+    return data_dict
 
-def index_message(customer_id: int, corpus_id: int, text: str,
-                  id: str, title: str, metadata: dict = None,
-                  idx_address: str = "api.vectara.io"):
-    """ Indexes a document to Vectara """
-    jwt_token = _get_jwt_token()
-    post_headers = {
+def auth_headers(jwt_token: str, customer_id) -> dict:
+    return {
         "Authorization": f"Bearer {jwt_token}",
         "customer-id": f"{customer_id}"
     }
 
+def search_corpus_ids() -> list:
+    """The corpora to search: VECTARA_SEARCH_CORPUS_IDS, comma separated, or
+    else the VECTARA_CORPUS_ID messages are indexed to."""
+    corpus_ids = os.environ.get('VECTARA_SEARCH_CORPUS_IDS')
+    if corpus_ids:
+        return [int(corpus_id) for corpus_id in corpus_ids.split(',') if corpus_id.strip()]
+    return [int(os.environ.get('VECTARA_CORPUS_ID'))]
+
+def search_deadline() -> float:
+    """Seconds a multi-corpus search waits for its corpora to answer."""
+    return float(os.environ.get('VECTARA_SEARCH_DEADLINE', 5))
+
+def build_fanout_requests(data_dict: dict, corpus_ids: list) -> list:
+    """ Copies a query for each corpus
+
+    Each copy asks for every result up to the page the query wanted, since
+    which results make up that page is only known once they're merged.
+    """
+    query = data_dict['query'][0]
+    corpus_requests = []
+    for corpus_id in corpus_ids:
+        corpus_request = copy.deepcopy(data_dict)
+        corpus_query = corpus_request['query'][0]
+        corpus_query['corpus_key'][0]['corpus_id'] = corpus_id
+        corpus_query['start'] = 0
+        corpus_query['num_results'] = query['start'] + query['num_results']
+        corpus_requests.append(corpus_request)
+    return corpus_requests
+
+def merge_search_results(data_dict: dict, corpus_ids: list, results: list) -> dict:
+    """ Merges the answers of a multi-corpus search into one response set
+
+    ``results`` holds each corpus's answer, or None if it didn't answer in
+    time.  The responses are ranked by score and the page ``data_dict``
+    asked for is kept.  If a corpus is missing the result has ``partial``
+    set; if all of them are, there's nothing to show and it raises.
+    """
+    responses = []
+    documents = []
+    for corpus_id, result in zip(corpus_ids, results):
+        if result == None:
+            metrics.count_corpus_miss(corpus_id)
+            continue
+        if not result['responseSet']:
+            continue
+        response_set = result['responseSet'][0]
+        offset = len(documents)
+        documents.extend(response_set['document'])
+        responses.extend(dict(response, documentIndex=response['documentIndex'] + offset)
+                         for response in response_set['response'])
+    if all(result == None for result in results):
+        raise TimeoutError("None of corpora {} answered in time".format(corpus_ids))
+    query = data_dict['query'][0]
+    responses.sort(key=lambda response: response['score'], reverse=True)
+    responses = responses[query['start']:query['start'] + query['num_results']]
+    # only the documents of the responses we kept, renumbered
+    kept = {}
+    for response in responses:
+        response['documentIndex'] = kept.setdefault(response['documentIndex'], len(kept))
+    merged = {"responseSet": [{"response": responses,
+                               "document": [documents[index] for index in kept]}]}
+    if any(result == None for result in results):
+        merged["partial"] = True
+    return merged
+
+# Thread pools, created on first use: "search" runs the single requests of
+# fan-outs and hedges, "background" the searches started by in_background.
+# Those wait on "search" themselves, so they can't share it without risking
+# a pool full of tasks all waiting on each other.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _executor(name: str) -> ThreadPoolExecutor:
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(
+                max_workers=int(os.environ.get('VECTARA_SEARCH_WORKERS', 16)),
+                thread_name_prefix="vectara-" + name)
+        return _pools[name]
+
+hedger = Hedger()
+reranker = RerankPlanner() if adaptive_reranking() else None
+
+def _search_corpus(headers: dict, data: dict):
+    """One corpus's answer to a multi-corpus search, or None if it failed."""
+    corpus_id = data['query'][0]['corpus_key'][0]['corpus_id']
+    try:
+        _, search_results = search_raw(headers, data)
+    except Exception:
+        logging.exception("Searching corpus %d failed", corpus_id)
+        return None
+    if 'responseSet' not in search_results:
+        logging.error("Searching corpus %d failed: %s", corpus_id, search_results)
+        return None
+    return search_results
+
+def search_fanout(headers: dict, data_dict: dict, corpus_ids: list, deadline: float):
+    """ Runs a query against every corpus at once, see ``merge_search_results``
+
+    Corpora that haven't answered after ``deadline`` seconds are left out;
+    their requests finish in the background and are ignored.
+    """
+    pool = _executor("search")
+    # each request keeps our scheduler priority and metrics labels
+    futures = [pool.submit(contextvars.copy_context().run, _search_corpus, headers, request)
+               for request in build_fanout_requests(data_dict, corpus_ids)]
+    done, _ = wait(futures, timeout=deadline)
+    results = [future.result() if future in done else None for future in futures]
+    for corpus_id, future in zip(corpus_ids, futures):
+        if future not in done:
+            logging.warning("Corpus %d didn't answer within %.2fs", corpus_id, deadline)
+    return merge_search_results(data_dict, corpus_ids, results)
+
+def _query(headers: dict, data_dict: dict, deadline: float = None):
+    """ Runs one Vectara query, across every corpus and hedged as configured """
+    corpus_ids = search_corpus_ids()
+    if len(corpus_ids) > 1:
+        fanout_deadline = search_deadline()
+        if deadline != None:
+            fanout_deadline = min(fanout_deadline, deadline - time.monotonic())
+        return data_dict, search_fanout(headers, data_dict, corpus_ids, fanout_deadline)
+    if deadline != None:
+        kind = "query_reranked" if 'rerankingConfig' in data_dict['query'][0] else "query"
+        return hedger.call(_executor("search"), kind, search_raw, headers, data_dict, deadline=deadline)
+    return search_raw(headers, data_dict)
+
+def _planned_search(headers: dict, search_text: str, metadata_filters: list,
+                    rerank_plan: dict, deadline: float = None):
+    """ A reranked search of the candidates ``rerank_plan`` counted, see rerank_planner.py """
+    decision = dict(rerank_plan, reranked=True)
+    candidates = decision['candidates']
+    if reranker.skip_margin != None:
+        # build_search_request appends to the filter list, and it's needed again
+        data_dict = build_search_request(search_text, False, candidates,
+                                         metadata_filters=None if metadata_filters == None else list(metadata_filters))
+        started = time.monotonic()
+        data_dict, search_results = _query(headers, data_dict, deadline)
+        if 'responseSet' not in search_results:
+            return data_dict, search_results
+        reranker.observe(candidates, time.monotonic() - started, reranked=False)
+        decision['margin'] = reranker.top_score_margin(search_results)
+        decision['reranked'] = not reranker.should_skip(search_results)
+    if decision['reranked']:
+        data_dict = build_search_request(search_text, True, candidates, metadata_filters=metadata_filters,
+                                         rerank_candidates=candidates)
+        started = time.monotonic()
+        data_dict, search_results = _query(headers, data_dict, deadline)
+        if 'responseSet' not in search_results:
+            return data_dict, search_results
+        reranker.observe(candidates, time.monotonic() - started, reranked=True)
+    reranker.record(search_text, decision, search_results)
+    return data_dict, search_results
+
+def search(search_text: str, rerank: bool, num_results: int, metadata_filters: list = None,
+           start: int = 0, timeout: float = None, rerank_plan: dict = None):
+    """ Takes headers and the JSON body and performs a search against Vectara
+
+    ``start`` skips that many results, which is how unreranked searches page.
+    Reranked searches fetch the top 100 so they can be paged locally, or with
+    a ``rerank_plan`` from ``reranker.plan`` as many as that says, see
+    rerank_planner.py.  With several ``search_corpus_ids`` they're all
+    searched at once, see ``search_fanout``.  With a ``timeout`` the query is
+    hedged (see ``hedging.Hedger``) and raises ``TimeoutError`` after that
+    many seconds.
+    """
+    deadline = None
+    if timeout != None:
+        deadline = time.monotonic() + timeout
+    with metrics.stage("token"):
+        jwt_token = _get_jwt_token()
+    api_key_header = auth_headers(jwt_token, os.environ.get('VECTARA_CUSTOMER_ID'))
+    if rerank and rerank_plan != None and reranker != None:
+        return _planned_search(api_key_header, search_text, metadata_filters, rerank_plan, deadline)
+    data_dict = build_search_request(search_text, rerank, num_results,
+                                     metadata_filters=metadata_filters, start=start)
+    return _query(api_key_header, data_dict, deadline)
+
+def in_background(function, *args, **kwargs):
+    """ Starts ``function``, which searches, on the search threads and returns its Future """
+    return _executor("background").submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+def build_index_request(customer_id: int, corpus_id: int, text: str,
+                        id: str, title: str, metadata: dict = None,
+                        sections: list = None):
+    """ Builds the JSON body that indexes one message as a Vectara document
+
+    ``sections`` indexes several messages as one document instead, each a
+    ``{"text": ..., "metadata": ...}`` dict, and ``text`` is ignored.
+    """
     document = {}
     document["document_id"] = id
     # Note that the document ID must be unique for a given corpus
     document["title"] = title
     document["metadata_json"] = json.dumps(metadata)
-    sections = []
-    section = {}
-    section["text"] = text
-    sections.append(section)
-    document["section"] = sections
+    if sections == None:
+        sections = [{"text": text}]
+    document["section"] = [
+        {"text": section["text"], "metadata_json": json.dumps(section["metadata"])}
+        if section.get("metadata") != None else {"text": section["text"]}
+        for section in sections
+    ]
 
     request = {}
     request['customer_id'] = customer_id
     request['corpus_id'] = corpus_id
     request['document'] = document
+    return request
+
+@metrics.timed("index_message")
+def index_message(customer_id: int, corpus_id: int, text: str,
+                  id: str, title: str, metadata: dict = None,
+                  idx_address: str = None, upsert: bool = False,
+                  sections: list = None):
+    """ Indexes a document to Vectara
 
-    logging.debug("Raw indexing request: %s",json.dumps(request))
+    Vectara won't overwrite a document, so ``upsert`` deletes any existing
+    document with this id first.  See ``build_index_request`` for ``sections``.
+    """
+    if upsert:
+        response, success = delete_document(customer_id, corpus_id, id, idx_address=idx_address)
+        if not success:
+            return response, False
+    with metrics.stage("token"):
+        jwt_token = _get_jwt_token()
+    post_headers = auth_headers(jwt_token, customer_id)
+    payload = json.dumps(build_index_request(customer_id, corpus_id, text, id, title, metadata,
+                                             sections))
 
-    response = requests.post(
-        f"https://{idx_address}/v1/index",
-        data=json.dumps(request),
-        verify=True,
-        headers=post_headers)
+    logging.debug("Raw indexing request: %s",payload)
+    metrics.observe_payload("index_request", len(payload))
+
+    with metrics.stage("index"):
+        response = transport.post(
+            "/v1/index",
+            data=payload,
+            headers=post_headers,
+            base_url=f"https://{idx_address}" if idx_address != None else None)
     logging.debug("Raw indexing response: %s", response)
 
     if response.status_code != 200:
+        metrics.count_error()
         logging.error("REST upload failed with code %d, reason %s, text %s",
                        response.status_code,
                        response.reason,
@@ -106,6 +534,38 @@ def index_message(customer_id: int, corpus_id: int, text: str,
         return response, False
     return response, True
 
+def build_delete_request(customer_id: int, corpus_id: int, id: str):
+    """ Builds the JSON body that deletes a document from Vectara """
+    return {
+        "customer_id": customer_id,
+        "corpus_id": corpus_id,
+        "document_id": id
+    }
+
+@metrics.timed("delete_document")
+def delete_document(customer_id: int, corpus_id: int, id: str,
+                    idx_address: str = None):
+    """ Deletes a document from Vectara """
+    with metrics.stage("token"):
+        jwt_token = _get_jwt_token()
+    post_headers = auth_headers(jwt_token, customer_id)
+    payload = json.dumps(build_delete_request(customer_id, corpus_id, id))
+
+    with metrics.stage("delete"):
+        response = transport.post(
+            "/v1/delete-doc",
+            data=payload,
+            headers=post_headers,
+            base_url=f"https://{idx_address}" if idx_address != None else None)
+    logging.debug("Raw delete response: %s", response)
+
+    if response.status_code != 200:
+        metrics.count_error()
+        logging.error("Deleting %s failed with code %d, reason %s, text %s",
+                      id, response.status_code, response.reason, response.text)
+        return response, False
+    return response, True
+
 def get_metadata_value(document_metadata, metadata_name):
   """ This function takes the name of metadata and returns its value or 'Unknown' """
   val = None
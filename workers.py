@@ -0,0 +1,113 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Runs several bot processes and restarts any that die.
+#
+#   SLACKBOT_WORKERS=4 python3 workers.py
+#
+# Each worker opens its own Socket Mode connection and Slack spreads events
+# across them.  The workers share the event de-duplication store
+# (SLACKBOT_DEDUP_PATH), so an event that reaches two of them is handled once.
+# Each gets its own index journal, so a restarted worker replays just its
+# own backlog, and, with METRICS_PORT set, its own port counting up from it.
+
+# Slack allows an app 10 Socket Mode connections
+MAX_WORKERS = 10
+
+def worker_environment(worker_id: int, environ=os.environ) -> dict:
+    """The environment worker number ``worker_id`` runs with."""
+    env = dict(environ, SLACKBOT_WORKER_ID=str(worker_id))
+    journal_path = environ.get('VECTARA_JOURNAL_PATH', 'index_journal.sqlite3')
+    if journal_path:
+        root, ext = os.path.splitext(journal_path)
+        env['VECTARA_JOURNAL_PATH'] = "{}.{}{}".format(root, worker_id, ext)
+    if environ.get('METRICS_PORT'):
+        env['METRICS_PORT'] = str(int(environ['METRICS_PORT']) + worker_id)
+    return env
+
+class Supervisor:
+    """Keeps ``workers`` copies of ``command`` running until stopped.
+
+    A worker that exits is restarted after ``restart_delay`` seconds, doubling
+    (up to ``max_restart_delay``) while it keeps dying within a minute.
+    """
+
+    def __init__(self, command: list, workers: int, restart_delay: float = 1.0,
+                 max_restart_delay: float = 60.0, stop_timeout: float = 30.0):
+        self.command = command
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stop_timeout = stop_timeout
+        self._processes = {}
+        self._started_at = {}
+        self._delays = {}
+        self._restart_at = {}
+        self._stopping = False
+        self.restarts = 0
+
+    def _spawn(self, worker_id: int):
+        self._processes[worker_id] = subprocess.Popen(self.command, env=worker_environment(worker_id))
+        self._started_at[worker_id] = time.monotonic()
+        logging.info("Started worker %d, pid %d", worker_id, self._processes[worker_id].pid)
+
+    def run(self):
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        while not self._stopping:
+            now = time.monotonic()
+            for worker_id, process in list(self._processes.items()):
+                if process.poll() == None:
+                    continue
+                if worker_id not in self._restart_at:
+                    # a worker that ran for a while gets restarted promptly
+                    if now - self._started_at[worker_id] > 60:
+                        self._delays[worker_id] = self.restart_delay
+                    delay = self._delays.get(worker_id, self.restart_delay)
+                    self._delays[worker_id] = min(self.max_restart_delay, delay * 2)
+                    self._restart_at[worker_id] = now + delay
+                    logging.error("Worker %d exited with %d, restarting it in %.1fs",
+                                  worker_id, process.returncode, delay)
+                elif now >= self._restart_at[worker_id]:
+                    del self._restart_at[worker_id]
+                    self.restarts += 1
+                    self._spawn(worker_id)
+            time.sleep(0.5)
+
+    def stop(self):
+        """Asks every worker to shut down, which flushes its indexing, and waits for them."""
+        self._stopping = True
+        for process in self._processes.values():
+            if process.poll() == None:
+                process.terminate()
+        deadline = time.monotonic() + self.stop_timeout
+        for worker_id, process in self._processes.items():
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.error("Worker %d didn't stop in time, killing it", worker_id)
+                process.kill()
+                process.wait()
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    workers = min(MAX_WORKERS, int(os.environ.get('SLACKBOT_WORKERS') or os.cpu_count() or 1))
+    # the workers divide the rate limits between them, see scheduler.py
+    os.environ['SLACKBOT_WORKERS'] = str(workers)
+    script = 'slackbot_async.py' if os.environ.get('SLACKBOT_MODE') == 'async' else 'slackbot.py'
+    supervisor = Supervisor([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script)],
+                            workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        supervisor.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        supervisor.stop()
+
+if __name__ == "__main__":
+    main()